@@ -0,0 +1,327 @@
+"""
+Model backends for the data generation runner.
+
+Every backend exposes the same async interface, query(prompt, images=None), and returns
+a QueryResult holding the text of the model's answer. The runner only talks to this
+interface, so concurrency, caching, etc. work the same way for every provider.
+
+Available backends:
+- OpenAIBackend: GPT models through the OpenAI SDK
+- AnthropicBackend: Claude models through the Anthropic SDK
+- RequestsBackend: GPT models through raw HTTP requests (as originally used in the GPT image script),
+  sent over the pooled keep-alive transport in http_transport.py
+- FakeBackend: local stand-in that never touches the network, useful for dry runs
+
+The images passed to query() are base64-encoded strings, as returned by encode_images_from_folder.
+
+Backends created with stream=True receive the answer as a stream, which lets them measure the
+time to the first token of the answer.
+"""
+
+import asyncio
+import json
+import time
+from dataclasses import dataclass, field
+
+from http_transport import get_transport
+from rate_limit import ProviderHTTPError
+
+
+@dataclass
+class QueryResult:
+    text: str                                       # the model's answer
+    usage: dict = field(default_factory=dict)       # token usage reported by the provider, if any
+    headers: dict = field(default_factory=dict)     # lowercased response headers, used to track rate limits
+    retries: int = 0                                # number of retries it took to get the answer
+    cached: bool = False                            # whether the answer came from the response cache
+    latency: float = None                           # seconds from sending the request to the full answer
+    time_to_first_token: float = None               # seconds until the first answer token, streaming only
+
+
+def lowercase_headers(headers):
+    # header names are case-insensitive, lowercasing them lets the rate limiter look them up in a plain dict
+    return {name.lower(): value for name, value in headers.items()}
+
+
+class OpenAIBackend:
+    provider = "openai"
+
+    def __init__(self, model, temperature=0, max_tokens=800, api_key=None, stream=False):
+        from openai import AsyncOpenAI
+
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.image_media_type = "image/png"
+        self.api_key = api_key
+        self.stream = stream
+        # api_key defaults to os.environ.get("OPENAI_API_KEY"), retries are handled by rate_limit.py
+        self.client = AsyncOpenAI(api_key=api_key, max_retries=0)
+
+    def request_body(self, prompt, images=None):
+        # the chat completions request, also used for the batch files in batch_mode.py.
+        # OpenAI caches prompt prefixes automatically, the text goes first since it is the same in every run
+        content = [{"type": "text", "text": prompt}]
+        for image in images or []:
+            content.append({"type": "image_url",
+                            "image_url": {"url": f"data:{self.image_media_type};base64,{image}"}})
+
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "user", "content": content if images else prompt}
+            ],
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature
+        }
+
+    async def query(self, prompt, images=None):
+        started = time.monotonic()
+        body = self.request_body(prompt, images)
+        if self.stream:
+            body.update(stream=True, stream_options={"include_usage": True})
+
+        # the raw response gives access to the rate limit headers
+        raw_response = await self.client.chat.completions.with_raw_response.create(**body)
+        headers = lowercase_headers(raw_response.headers)
+
+        if not self.stream:
+            completion = raw_response.parse()
+            usage = completion.usage.model_dump() if completion.usage else {}
+            return QueryResult(completion.choices[0].message.content, usage, headers,
+                               latency=time.monotonic() - started)
+
+        parts, usage, first_token = [], {}, None
+        async for chunk in raw_response.parse():
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token is None:
+                    first_token = time.monotonic() - started
+                parts.append(chunk.choices[0].delta.content)
+            if chunk.usage:     # the usage arrives in a final chunk without choices
+                usage = chunk.usage.model_dump()
+        return QueryResult("".join(parts), usage, headers, latency=time.monotonic() - started,
+                           time_to_first_token=first_token)
+
+
+class AnthropicBackend:
+    provider = "anthropic"
+
+    def __init__(self, model, temperature=0, max_tokens=800, api_key=None, stream=False, prompt_caching=False):
+        from anthropic import AsyncAnthropic
+
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.image_media_type = "image/png"
+        self.api_key = api_key
+        self.stream = stream
+        # mark the shared prompt prefix as a cache breakpoint, off by default, see request_body
+        self.prompt_caching = prompt_caching
+        # api_key defaults to os.environ.get("ANTHROPIC_API_KEY"), retries are handled by rate_limit.py
+        self.client = AsyncAnthropic(api_key=api_key, max_retries=0)
+
+    def request_body(self, prompt, images=None):
+        # the messages request, also used for the batch files in batch_mode.py
+        content = [{"type": "text", "text": prompt}]
+        for image in images or []:
+            content.append({"type": "image",
+                            "source": {"type": "base64", "media_type": self.image_media_type, "data": image}})
+
+        if self.prompt_caching:
+            # the text comes first since it is the only part that every run of a question shares, the images
+            # that follow are shuffled per run. one breakpoint after the text caches exactly that prefix.
+            # writing to the cache costs 1.25 times the input price and a read 0.1 times, and prefixes below
+            # the provider's minimum length (1024 tokens for the Sonnet models) are not cached at all, so this
+            # only saves money when the shared prefix is long and reused within the cache lifetime (5 minutes)
+            content[0]["cache_control"] = {"type": "ephemeral"}
+
+        return {
+            "model": self.model,
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
+            "messages": [
+                {"role": "user", "content": content if images else prompt}
+            ]
+        }
+
+    async def query(self, prompt, images=None):
+        started = time.monotonic()
+        # prompt caching is a beta feature in the pinned SDK version
+        messages = self.client.beta.prompt_caching.messages if self.prompt_caching else self.client.messages
+
+        # the raw response gives access to the rate limit headers
+        raw_response = await messages.with_raw_response.create(**self.request_body(prompt, images),
+                                                               stream=self.stream)
+        headers = lowercase_headers(raw_response.headers)
+
+        if not self.stream:
+            message = raw_response.parse()
+            usage = message.usage.model_dump() if message.usage else {}
+            return QueryResult(message.content[0].text, usage, headers, latency=time.monotonic() - started)
+
+        parts, usage, first_token = [], {}, None
+        async for event in raw_response.parse():
+            if event.type == "message_start":
+                usage = event.message.usage.model_dump()
+            elif event.type == "content_block_delta" and event.delta.type == "text_delta":
+                if first_token is None:
+                    first_token = time.monotonic() - started
+                parts.append(event.delta.text)
+            elif event.type == "message_delta":
+                usage["output_tokens"] = event.usage.output_tokens
+        return QueryResult("".join(parts), usage, headers, latency=time.monotonic() - started,
+                           time_to_first_token=first_token)
+
+
+class RequestsBackend:
+    provider = "openai"
+    url = "https://api.openai.com/v1/chat/completions"
+
+    def __init__(self, model, temperature=0, max_tokens=800, api_key=None, stream=False, pool_size=16):
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        # the original GPT image script labelled the PNGs as JPEG, kept for comparability with earlier data
+        self.image_media_type = "image/jpeg"
+        self.api_key = api_key
+        self.stream = stream
+        self.transport = get_transport(pool_size)   # shared keep-alive connection pool
+
+    def request_body(self, prompt, images=None):
+        content = [{"type": "text", "text": prompt}]
+        for image in images or []:
+            content.append({"type": "image_url",
+                            "image_url": {"url": f"data:{self.image_media_type};base64,{image}"}})
+
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "user", "content": content}
+            ],
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature
+        }
+
+    async def query(self, prompt, images=None):
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}",
+        }
+        payload = self.request_body(prompt, images)
+        started = time.monotonic()
+
+        if self.stream and hasattr(self.transport, "stream_post"):
+            payload.update(stream=True, stream_options={"include_usage": True})
+            return await self.query_stream(headers, payload, started)
+
+        response = await self.transport.post(self.url, headers=headers, json=payload)
+
+        # a throttled or failed call is raised instead of being indexed as if it were an answer
+        if response.status_code != 200:
+            raise ProviderHTTPError(response.status_code, lowercase_headers(response.headers), response.text)
+
+        output = response.json()
+        return QueryResult(output['choices'][0]['message']['content'], output.get('usage', {}),
+                           lowercase_headers(response.headers), latency=time.monotonic() - started)
+
+    async def query_stream(self, headers, payload, started):
+        # read the server-sent events of a streamed answer, one 'data: {...}' line per chunk
+        parts, usage, first_token = [], {}, None
+        async with self.transport.stream_post(self.url, headers=headers, json=payload) as response:
+            if response.status_code != 200:
+                body = (await response.aread()).decode("utf-8", errors="replace")
+                raise ProviderHTTPError(response.status_code, lowercase_headers(response.headers), body)
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                chunk = json.loads(line[len("data: "):])
+                if chunk.get("choices") and chunk["choices"][0]["delta"].get("content"):
+                    if first_token is None:
+                        first_token = time.monotonic() - started
+                    parts.append(chunk["choices"][0]["delta"]["content"])
+                if chunk.get("usage"):
+                    usage = chunk["usage"]
+            headers = lowercase_headers(response.headers)
+
+        return QueryResult("".join(parts), usage, headers, latency=time.monotonic() - started,
+                           time_to_first_token=first_token)
+
+
+class FakeBackend:
+    provider = "fake"
+
+    def __init__(self, model="fake-model", temperature=0, max_tokens=800, api_key=None, stream=False,
+                 responder=None, delay=0):
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.image_media_type = "image/png"
+        self.api_key = api_key
+        self.stream = stream
+        self.responder = responder  # optional function (prompt, images) -> answer text
+        self.delay = delay          # simulated latency in seconds
+
+    def request_body(self, prompt, images=None):
+        # a chat completions style request, so the local batch stand-in can read it back
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "user", "content": prompt, "images": images or []}
+            ],
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature
+        }
+
+    async def query(self, prompt, images=None):
+        started = time.monotonic()
+        # half of the delay stands in for the time to first token, the other half for generating the answer
+        await asyncio.sleep(self.delay / 2)
+        first_token = time.monotonic() - started
+        await asyncio.sleep(self.delay / 2)
+        if self.responder is not None:
+            text = self.responder(prompt, images)
+        else:
+            text = f"Fake answer to a prompt of {len(prompt)} characters and {len(images or [])} images."
+        # rough token counts, about four characters per token
+        usage = {"input_tokens": len(prompt) // 4, "output_tokens": len(text) // 4}
+        return QueryResult(text, usage, latency=time.monotonic() - started,
+                           time_to_first_token=first_token if self.stream else None)
+
+
+def cache_read_tokens(usage):
+    # input tokens read from the provider's prompt cache, from an Anthropic or OpenAI usage record
+    if usage.get("cache_read_input_tokens") is not None:
+        return usage["cache_read_input_tokens"]
+    details = usage.get("prompt_tokens_details") or {}
+    return details.get("cached_tokens") or 0
+
+
+def input_tokens(usage):
+    # input tokens including those read from or written to the prompt cache, from an Anthropic or OpenAI usage record
+    if "prompt_tokens" in usage:
+        return usage["prompt_tokens"]
+    if "input_tokens" not in usage:
+        return None
+    return (usage["input_tokens"] + (usage.get("cache_read_input_tokens") or 0)
+            + (usage.get("cache_creation_input_tokens") or 0))
+
+
+def output_tokens(usage):
+    # generated tokens, from an Anthropic or OpenAI usage record
+    return usage.get("output_tokens", usage.get("completion_tokens"))
+
+
+backend_classes = {
+    "openai": OpenAIBackend,
+    "anthropic": AnthropicBackend,
+    "requests": RequestsBackend,
+    "fake": FakeBackend,
+}
+
+
+def make_backend(backend_name, model, temperature=0, max_tokens=800, api_key=None, stream=False):
+    # look up a backend by name, e.g. make_backend("anthropic", "claude-3-5-sonnet-20240620")
+    if backend_name not in backend_classes:
+        raise ValueError(f"Unknown backend '{backend_name}', choose from {list(backend_classes)}")
+    return backend_classes[backend_name](model, temperature, max_tokens, api_key, stream)
@@ -0,0 +1,295 @@
+"""
+Offline batch mode for overnight sweeps.
+
+Instead of querying the model interactively, every prompt of a condition is compiled into a
+batch file (OpenAI Batch JSONL or Anthropic Message Batches requests), which is submitted to
+the provider's batch API. The script then polls until the batch has ended and maps the answers
+back to their q_number and run, storing them in the checkpoint log and the usual raw data CSV.
+Batch requests are billed at a lower price and do not count against the interactive rate limits.
+
+The batch id is saved in a manifest next to the batch file, so if the script is stopped while
+waiting, running it again picks up the submitted batch instead of submitting a new one.
+Delete the manifest to submit a fresh batch for the same configuration.
+
+LocalBatchAPI is a stand-in for the provider APIs that answers the batch file with any backend
+(e.g. FakeBackend), so the whole flow can be tried offline.
+"""
+
+import json
+import os
+import time
+
+from backends import FakeBackend, QueryResult
+from http_transport import get_session
+from checkpoint import CheckpointLog
+from query_engine import run_queries
+from runner import PromptJob, build_jobs, group_responses, job_record, write_raw_data
+from telemetry import TelemetryLog, generation_record
+
+
+def custom_id(job):
+    # batch APIs identify each request by a custom id, which maps the answer back to its cell
+    return f"{job.q_number}_run{job.run}"
+
+
+def write_batch_file(backend, jobs, batch_path):
+    # one JSON line per job, in the request format of the backend's provider
+    os.makedirs(os.path.dirname(batch_path) or '.', exist_ok=True)
+    with open(batch_path, 'w', encoding='utf-8') as file:
+        for job in jobs:
+            body = backend.request_body(job.prompt, job.images)
+            if backend.provider == "anthropic":
+                request = {"custom_id": custom_id(job), "params": body}
+            else:
+                request = {"custom_id": custom_id(job), "method": "POST", "url": "/v1/chat/completions", "body": body}
+            file.write(json.dumps(request) + "\n")
+    print(f"Batch of {len(jobs)} requests has been written to {batch_path}")
+
+
+class OpenAIBatchAPI:
+
+    def __init__(self, api_key=None):
+        from openai import OpenAI
+
+        self.client = OpenAI(api_key=api_key)   # api_key defaults to os.environ.get("OPENAI_API_KEY")
+
+    def submit(self, batch_path):
+        with open(batch_path, 'rb') as file:
+            batch_file = self.client.files.create(file=file, purpose="batch")
+        batch = self.client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions",
+                                           completion_window="24h")
+        return batch.id
+
+    def status(self, batch_id):
+        # returns (status, whether the batch has ended)
+        batch = self.client.batches.retrieve(batch_id)
+        return batch.status, batch.status in ("completed", "failed", "expired", "cancelled")
+
+    def results(self, batch_id):
+        # returns {custom_id: QueryResult} for every request that succeeded
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.output_file_id is None:
+            return {}
+        return parse_openai_results(self.client.files.content(batch.output_file_id).text)
+
+
+class AnthropicBatchAPI:
+    # the Message Batches API is called over HTTP, since the pinned Anthropic SDK predates it
+    url = "https://api.anthropic.com/v1/messages/batches"
+
+    def __init__(self, api_key=None):
+        self.headers = {
+            "x-api-key": api_key or os.environ.get("ANTHROPIC_API_KEY", ""),
+            "anthropic-version": "2023-06-01",
+            "content-type": "application/json",
+        }
+        self.session = get_session()
+
+    def submit(self, batch_path):
+        with open(batch_path, 'r', encoding='utf-8') as file:
+            batch_requests = [json.loads(line) for line in file]
+        response = self.session.post(self.url, headers=self.headers, json={"requests": batch_requests})
+        response.raise_for_status()
+        return response.json()["id"]
+
+    def status(self, batch_id):
+        response = self.session.get(f"{self.url}/{batch_id}", headers=self.headers)
+        response.raise_for_status()
+        status = response.json()["processing_status"]
+        return status, status == "ended"
+
+    def results(self, batch_id):
+        response = self.session.get(f"{self.url}/{batch_id}", headers=self.headers)
+        response.raise_for_status()
+        results_url = response.json()["results_url"]
+
+        response = self.session.get(results_url, headers=self.headers)
+        response.raise_for_status()
+        results = {}
+        for line in response.text.splitlines():
+            entry = json.loads(line)
+            if entry["result"]["type"] == "succeeded":
+                message = entry["result"]["message"]
+                results[entry["custom_id"]] = QueryResult(message["content"][0]["text"], message.get("usage", {}))
+        return results
+
+
+class LocalBatchAPI:
+    """Offline stand-in that answers a batch file with a backend and stores OpenAI style results."""
+
+    def __init__(self, backend=None, concurrency=8):
+        self.backend = backend or FakeBackend()
+        self.concurrency = concurrency
+
+    def submit(self, batch_path):
+        with open(batch_path, 'r', encoding='utf-8') as file:
+            batch_requests = [json.loads(line) for line in file]
+
+        async def answer(request):
+            prompt, images = prompt_from_request(request)
+            return await self.backend.query(prompt, images)
+
+        results = run_queries([(request,) for request in batch_requests], answer, self.concurrency)
+
+        results_path = f"{os.path.splitext(batch_path)[0]}_results.jsonl"
+        with open(results_path, 'w', encoding='utf-8') as file:
+            for request, result in zip(batch_requests, results):
+                body = {"choices": [{"message": {"role": "assistant", "content": result.text}}], "usage": result.usage}
+                file.write(json.dumps({"custom_id": request["custom_id"],
+                                       "response": {"status_code": 200, "body": body}}) + "\n")
+        return results_path     # the results file doubles as the batch id
+
+    def status(self, batch_id):
+        return "completed", True
+
+    def results(self, batch_id):
+        with open(batch_id, 'r', encoding='utf-8') as file:
+            return parse_openai_results(file.read())
+
+
+def prompt_from_request(request):
+    # recover the prompt text and base64 images from an OpenAI or Anthropic batch request line
+    body = request.get("body") or request["params"]
+    message = body["messages"][0]
+    if isinstance(message["content"], str):
+        return message["content"], message.get("images") or None
+
+    prompt, images = "", []
+    for block in message["content"]:
+        if block["type"] == "text":
+            prompt = block["text"]
+        elif block["type"] == "image_url":
+            images.append(block["image_url"]["url"].split("base64,", 1)[1])
+        elif block["type"] == "image":
+            images.append(block["source"]["data"])
+    return prompt, images or None
+
+
+def parse_openai_results(results_text):
+    # map the lines of an OpenAI batch output file to {custom_id: QueryResult}, skipping failed requests
+    results = {}
+    for line in results_text.splitlines():
+        entry = json.loads(line)
+        response = entry.get("response")
+        if response and response["status_code"] == 200:
+            body = response["body"]
+            results[entry["custom_id"]] = QueryResult(body["choices"][0]["message"]["content"], body.get("usage") or {})
+    return results
+
+
+def batch_api_for(backend):
+    # the batch API matching a backend's provider
+    if backend.provider == "anthropic":
+        return AnthropicBatchAPI(backend.api_key)
+    if backend.provider == "openai":
+        return OpenAIBatchAPI(backend.api_key)
+    return LocalBatchAPI(backend)
+
+
+def run_batch(backend, condition, model_runs=10, cot=False, model_name=None, data_folder='../data',
+              batch_api=None, poll_interval=60, master_seed=None):
+    """
+    Collect the answers for one condition through a provider batch API.
+
+    Parameters:
+    -----------
+    backend : object
+        Backend from backends.py, used to format the requests and to pick the batch API
+    condition : str
+        Experimental condition, 'standard', 'distractor', or 'image'
+    model_runs : int
+        Number of answers to be collected per question
+    cot : bool
+        Whether to add the Chain-of-Thought instruction to the prompt
+    model_name : str, optional
+        Name used in the output filenames, defaults to the model with a '_cot' suffix if cot is True
+    data_folder : str
+        Path to the data folder
+    batch_api : object, optional
+        OpenAIBatchAPI, AnthropicBatchAPI, or LocalBatchAPI, defaults to the one matching the backend
+    poll_interval : float
+        Seconds between batch status checks
+    master_seed : int, optional
+        Derive every cell's option order from this seed, see build_jobs in runner.py
+
+    Returns:
+    --------
+    list of lists or None
+        The raw data rows, or None if some requests failed and the raw data CSV was not written
+    """
+    if model_name is None:
+        model_name = f"{backend.model}_cot" if cot else backend.model
+    if batch_api is None:
+        batch_api = batch_api_for(backend)
+
+    batch_folder = os.path.join(data_folder, "batches")
+    batch_path = os.path.join(batch_folder, f"{model_name}_{condition}_batch.jsonl")
+    manifest_path = os.path.join(batch_folder, f"{model_name}_{condition}_manifest.json")
+
+    if os.path.exists(manifest_path):
+        # a batch was already submitted for this configuration, wait for that one
+        with open(manifest_path, 'r', encoding='utf-8') as file:
+            manifest = json.load(file)
+        print(f"Resuming batch {manifest['batch_id']}")
+    else:
+        jobs = build_jobs(condition, model_runs, cot, master_seed=master_seed)
+        write_batch_file(backend, jobs, batch_path)
+        batch_id = batch_api.submit(batch_path)
+        print(f"Batch {batch_id} has been submitted")
+
+        # the manifest keeps what is needed to map the answers back, without the images
+        manifest = {
+            "batch_id": batch_id,
+            "jobs": [{"q_number": job.q_number, "run": job.run, "prompt": job.prompt,
+                      "presentation_order": job.presentation_order, "permutation": job.permutation,
+                      "seed": job.seed, "image_count": len(job.images or [])}
+                     for job in jobs],
+        }
+        with open(manifest_path, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file)
+
+    status, ended = batch_api.status(manifest["batch_id"])
+    while not ended:
+        print(f"Batch status: {status}, checking again in {poll_interval} seconds")
+        time.sleep(poll_interval)
+        status, ended = batch_api.status(manifest["batch_id"])
+    print(f"Batch has ended with status: {status}")
+
+    results = batch_api.results(manifest["batch_id"])
+
+    # store the answers in the checkpoint log, so the interactive runner can fill in any failed requests
+    jobs = [PromptJob(entry["q_number"], entry["run"], entry["prompt"], entry["presentation_order"],
+                      permutation=entry.get("permutation"), seed=entry.get("seed")) for entry in manifest["jobs"]]
+    image_counts = [entry.get("image_count", 0) for entry in manifest["jobs"]]
+    log_path = os.path.join(data_folder, f"{model_name}_{condition}_log.jsonl")
+    telemetry_path = os.path.join(data_folder, "telemetry", "usage.jsonl")
+    with CheckpointLog(log_path) as log, TelemetryLog(telemetry_path) as telemetry:
+        for job, image_count in zip(jobs, image_counts):
+            if custom_id(job) in results:
+                record = job_record(backend, condition, cot, job, results[custom_id(job)])
+                log.append(record)
+                telemetry.append(generation_record(backend, record, image_count))
+
+    failed = [custom_id(job) for job in jobs if custom_id(job) not in results]
+    if failed:
+        print(f"{len(failed)} requests failed: {', '.join(failed)}. Run the test script for this configuration "
+              f"to query them interactively, it resumes from {log_path}")
+        return None
+
+    data_list = group_responses(backend.model, jobs, [results[custom_id(job)].text for job in jobs])
+    write_raw_data(data_list, model_name, condition, data_folder)
+    return data_list
+
+
+if __name__ == "__main__":
+    from backends import make_backend
+
+    backend_name = "fake"   # "openai", "anthropic", or "fake" (answered locally by LocalBatchAPI)
+    model = "fake-model"
+    condition = "standard"
+    temperature = 0
+    model_runs = 10     # number of answers to be collected per question
+    cot = False         # activate or deactivate the Chain-of-Thought prompt
+    master_seed = None  # set to an int to derive every cell's option order from it
+
+    run_batch(make_backend(backend_name, model, temperature), condition, model_runs, cot, master_seed=master_seed)
@@ -0,0 +1,94 @@
+"""
+Append-only checkpoint log for generation runs.
+
+Every response is written to a JSON lines log as soon as it arrives, so a crashed or
+interrupted run loses at most the few responses that were not yet synced to disk. Writes
+are flushed and fsynced in batches, either every `sync_every` records or every
+`sync_interval` seconds, whichever comes first, to avoid an fsync per response.
+
+When a run is restarted, the runner reads the log and skips every cell
+(model, condition, cot, q_number, run) that already has a response.
+"""
+
+import json
+import os
+import time
+
+
+def cell_key(model, condition, cot, q_number, run):
+    # identifies one response cell of a sweep
+    return model, condition, bool(cot), q_number, int(run)
+
+
+def record_key(record):
+    return cell_key(record["model"], record["condition"], record["cot"], record["q_number"], record["run"])
+
+
+def load_records(log_path):
+    """
+    Read the completed cells from a checkpoint log.
+
+    A line that was only partly written when the run was interrupted is ignored,
+    so that cell is simply queried again.
+
+    Returns:
+    --------
+    dict
+        Records keyed by cell_key, later records for the same cell replace earlier ones
+    """
+    records = {}
+    if not os.path.exists(log_path):
+        return records
+
+    with open(log_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue    # torn final line from an interrupted write
+            records[record_key(record)] = record
+    return records
+
+
+class CheckpointLog:
+    """Append-only JSON lines log with batched fsync, use as a context manager."""
+
+    def __init__(self, log_path, sync_every=20, sync_interval=2.0):
+        self.log_path = log_path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.file = None
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.log_path) or '.', exist_ok=True)
+        torn_line = False
+        if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > 0:
+            with open(self.log_path, 'rb') as file:
+                file.seek(-1, os.SEEK_END)
+                torn_line = file.read(1) != b"\n"
+
+        self.file = open(self.log_path, 'a', encoding='utf-8')
+        if torn_line:
+            # end the torn final line of an interrupted run, so the next record starts on its own line
+            self.file.write("\n")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.sync()
+        self.file.close()
+
+    def append(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        # flush Python's buffer, then make the OS write it to disk
+        if self.unsynced:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+        self.last_sync = time.monotonic()
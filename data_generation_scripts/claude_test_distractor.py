@@ -1,20 +1,14 @@
 """
 This script lets you generate data from the Claude models in the DISTRACTOR condition.
 You can configure model, temperature, and model_runs.
-The prompts are generated from the imported test_list.
+The prompts are generated from the imported test_list, and the model is queried by the shared runner.
 """
 
-import anthropic
-import random
-import csv
-import os
-from test_list_dict import test_list
+from backends import AnthropicBackend
+from runner import run_condition
 
 
-client = anthropic.Anthropic(
-    # defaults to os.environ.get("ANTHROPIC_API_KEY")
-    api_key="api-key-here"
-)
+api_key = "api-key-here"     # set to None to use os.environ.get("ANTHROPIC_API_KEY")
 
 
 condition = "distractor"
@@ -22,78 +16,15 @@ model_options = ["claude-3-sonnet-20240229", "claude-3-5-sonnet-20240620"]
 model = model_options[0]
 temperature = 0
 model_runs = 10     # number of answers to be collected per question
+concurrency = 8     # maximum number of queries in flight at once
+stream = False      # stream the answers, which also records the time to first token
+master_seed = None  # set to an int to derive every (question, run) option order from it, reproducibly
 
 
-def query_function(prompt):
-    message = client.messages.create(
-        model=model,
-        max_tokens=800,
-        temperature=temperature,
-        messages=[
-            {"role": "user", "content": f"{prompt}"}
-        ]
-    )
-    model_response = message.content[0].text
-    return model_response
+cot = False     # CoT prompting is not used in the distractor condition
 
 
-# column headers for the resulting CSV file
-claude_data_list = [["model", "q_number", "responses"]]
+backend = AnthropicBackend(model, temperature, api_key=api_key, stream=stream)
 
-
-# iterates through the test_list, creates prompt, prompts model, stores output
-for tasks in test_list:
-    # the test_list contains the info necessary to create all 20 task prompts
-    question_nr = tasks["q_number"]
-    task = tasks["task"]
-
-    new_data_entry = [model, question_nr]
-
-    source_tool = tasks["source_tool"]
-    object_list = [tasks["afforded_tool"], tasks["associated_tool1"],
-                   tasks["associated_tool2"], tasks["associated_tool3"],
-                   tasks["associated_tool4"], tasks["irrelevant_tool1"],
-                   tasks["irrelevant_tool2"], tasks["irrelevant_tool3"],
-                   tasks["irrelevant_tool4"]]
-
-    for i in range(model_runs):         # generate specified number of answers per task question
-        random.shuffle(object_list)     # shuffle order of option presentation each time
-
-        task_prompt = (f"Your task is to {task}. Normally, you would use {source_tool} to accomplish this task. "
-                       f"However, {source_tool} is not available to you. At your disposal, you have the objects "
-                       f"listed below. Which one of these would you use to accomplish the task? \n"
-                       f"{object_list[0]} \n"
-                       f"{object_list[1]} \n"
-                       f"{object_list[2]} \n"
-                       f"{object_list[3]} \n"    
-                       f"{object_list[4]} \n"
-                       f"{object_list[5]} \n"
-                       f"{object_list[6]} \n"
-                       f"{object_list[7]} \n"
-                       f"{object_list[8]}")
-
-        response = query_function(task_prompt)
-
-        # print if you want to see tasks and model answers as they are being generated
-        print(f"{task_prompt} \n\n{response}\n\n")
-
-        new_data_entry.append(response)
-
-    claude_data_list.append(new_data_entry)
-
-
-# view final model output
-for element in claude_data_list:
-    print(element)
-
-
-data_folder = '../data'                     # define the path to the data folder
-os.makedirs(data_folder, exist_ok=True)     # ensure the data folder exists
-
-# store output in csv in the data folder
-filename = os.path.join(data_folder, f"{model}_{condition}_raw_data.csv")
-with open(filename, 'w', newline='') as file:
-    writer = csv.writer(file)
-    writer.writerows(claude_data_list)
-
-print(f"Data has been written to {filename}")
+# builds the prompts, queries the model, and stores the output in the data folder
+run_condition(backend, condition, model_runs, cot, concurrency, master_seed=master_seed)
@@ -18,8 +18,8 @@ import os
 
 
 def encode_images_from_folder(folder_name):
-    # define the folder path relative to the working directory
-    folder_path = os.path.join(os.getcwd(), "../images", folder_name)
+    # define the folder path relative to this script, so it does not depend on the working directory
+    folder_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../images", folder_name)
 
     # only PNGs are here considered valid image extensions
     valid_extensions = ".png"
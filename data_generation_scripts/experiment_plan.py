@@ -0,0 +1,285 @@
+"""
+Experiment-matrix planner and scheduler.
+
+Instead of editing and running one test script per (model, condition, cot) configuration,
+the planner expands the cross product of models, conditions, CoT settings, and run counts into
+a list of experiments, and the scheduler runs all of their queries at once in a single event
+loop:
+- every provider has its own concurrency limit, so OpenAI and Anthropic queries run side by side,
+  and each model keeps to its own rate limit (see rate_limit.py)
+- the queries are started longest first (longest processing time first), so the long CoT and
+  image queries do not end up as a tail at the end of the sweep. Query durations are estimated
+  from the median latencies in the telemetry store where available, and otherwise from rough
+  factors for CoT and images
+- every experiment keeps its own checkpoint log, so an interrupted sweep resumes where it stopped,
+  and writes the same raw data CSV and metrics sidecar as its test script would
+- a query that still fails after its retries does not stop the others: the experiments whose
+  queries all succeeded write their outputs, and the failed cells are reported and run again,
+  from the checkpoint, on the next run of the plan
+
+CoT is only planned for the standard and image conditions, as in the test scripts. Note that
+gpt_test_distractor.py keeps the always-on CoT prompt of the original GPT distractor data, which
+the planner does not reproduce.
+
+Configure the matrix with the variables at the bottom and run this script. With dry_run = True it
+only prints the plan.
+"""
+
+import asyncio
+import contextlib
+import os
+from dataclasses import dataclass, field
+
+from backends import make_backend
+from checkpoint import CheckpointLog, cell_key, load_records
+from query_engine import run_async
+from rate_limit import get_limiter
+from response_cache import open_cache
+from runner import answer_job, build_jobs, conditions, job_record, print_answer, write_outputs
+from telemetry import TelemetryLog, generation_record, load_usage
+
+
+# conditions in which the Chain-of-Thought prompt is used
+cot_conditions = ["standard", "image"]
+
+# rough relative query durations, used when the telemetry store has no latencies for an experiment yet
+base_seconds = 5.0
+duration_factors = {"cot": 3.0, "image": 2.0, "distractor": 1.2}
+
+# maximum number of queries in flight per provider
+default_provider_concurrency = {"openai": 16, "anthropic": 8, "fake": 32}
+
+
+@dataclass
+class Experiment:
+    backend_name: str
+    model: str
+    condition: str
+    cot: bool
+    model_runs: int
+    temperature: float = 0
+    expected_seconds: float = None      # estimated duration of one query
+
+    # set up by run_plan
+    backend: object = field(default=None, repr=False)
+    provider: str = None
+    limiter: object = field(default=None, repr=False)
+    jobs: list = field(default_factory=list, repr=False)
+    missing_jobs: list = field(default_factory=list, repr=False)    # jobs without an answer in the checkpoint log
+    records: dict = field(default_factory=dict, repr=False)
+    log_path: str = None
+    log: object = field(default=None, repr=False)
+
+    @property
+    def model_name(self):
+        return f"{self.model}_cot" if self.cot else self.model
+
+
+def plan_experiments(models, conditions=conditions, cot_options=(False, True), model_runs=10, temperature=0):
+    """
+    Expand the experiment matrix into a list of experiments.
+
+    Parameters:
+    -----------
+    models : dict
+        {backend name: list of models}, e.g. {"openai": ["gpt-4o-2024-08-06"], "anthropic": [...]}
+    conditions : list of str
+        Conditions to run, any of 'standard', 'distractor', and 'image'
+    cot_options : tuple of bool
+        CoT settings to run, CoT is only planned in the cot_conditions
+    model_runs : int or dict
+        Number of answers per question, or {condition: number of answers}
+    temperature : float
+        Model temperature
+
+    Returns:
+    --------
+    list of Experiment
+    """
+    experiments = []
+    for backend_name, model_list in models.items():
+        for model in model_list:
+            for condition in conditions:
+                runs = model_runs[condition] if isinstance(model_runs, dict) else model_runs
+                for cot in cot_options:
+                    if cot and condition not in cot_conditions:
+                        continue
+                    experiments.append(Experiment(backend_name, model, condition, cot, runs, temperature))
+    return experiments
+
+
+def estimate_durations(experiments, usage=None):
+    # median latency per experiment from the telemetry store, rough factors for experiments without data
+    if usage is None:
+        usage = load_usage()
+    medians = {}
+    if not usage.empty:
+        generation = usage[(usage["kind"] == "generation") & ~usage["response_cached"]]
+        medians = generation.groupby(["model", "condition", "cot"])["latency"].median().dropna().to_dict()
+
+    for experiment in experiments:
+        key = (experiment.model, experiment.condition, experiment.cot)
+        if key in medians:
+            experiment.expected_seconds = medians[key]
+            continue
+        seconds = base_seconds
+        if experiment.cot:
+            seconds *= duration_factors["cot"]
+        seconds *= duration_factors.get(experiment.condition, 1.0)
+        experiment.expected_seconds = seconds
+    return experiments
+
+
+def print_plan(experiments, provider_concurrency):
+    print(f"{len(experiments)} experiments, {sum(len(experiment.jobs) for experiment in experiments)} queries:")
+    for experiment in sorted(experiments, key=lambda experiment: -experiment.expected_seconds):
+        print(f"  {experiment.backend_name:10} {experiment.model_name:32} {experiment.condition:10} "
+              f"{len(experiment.jobs):5} queries ({len(experiment.missing_jobs)} to go), "
+              f"~{experiment.expected_seconds:.1f} s each")
+
+    # lower bound of the remaining time: each provider's total query time spread over its concurrency
+    for provider in sorted({experiment.provider for experiment in experiments}):
+        total = sum(experiment.expected_seconds * len(experiment.missing_jobs) for experiment in experiments
+                    if experiment.provider == provider)
+        concurrency = provider_concurrency.get(provider, 8)
+        print(f"  {provider}: at least {total / concurrency / 60:.1f} minutes at concurrency {concurrency}")
+
+
+async def run_schedule(experiments, provider_concurrency, cache=None, telemetry=None):
+    """
+    Answer the unanswered jobs of all experiments in one event loop, longest jobs first,
+    with at most provider_concurrency[provider] queries in flight per provider.
+
+    Returns:
+    --------
+    list of tuple
+        (experiment, job, error) of every job that failed, the other jobs still finish
+    """
+    semaphores = {provider: asyncio.Semaphore(provider_concurrency.get(provider, 8))
+                  for provider in {experiment.provider for experiment in experiments}}
+
+    async def run_job(experiment, job):
+        async with semaphores[experiment.provider]:
+            result = await answer_job(experiment.backend, job, experiment.limiter, cache)
+        print_answer(job, result)
+        record = job_record(experiment.backend, experiment.condition, experiment.cot, job, result)
+        experiment.records[cell_key(experiment.model, experiment.condition, experiment.cot, job.q_number,
+                                    job.run)] = record
+        if experiment.log is not None:
+            experiment.log.append(record)
+        if telemetry is not None:
+            telemetry.append(generation_record(experiment.backend, record, len(job.images or [])))
+
+    # the semaphores let waiting queries in first come, first served, so starting the queries in
+    # order of their expected duration runs the longest queries first
+    queue = [(experiment, job) for experiment in experiments for job in experiment.missing_jobs]
+    queue.sort(key=lambda item: -item[0].expected_seconds)
+    results = await asyncio.gather(*(run_job(experiment, job) for experiment, job in queue), return_exceptions=True)
+    return [(experiment, job, result) for (experiment, job), result in zip(queue, results)
+            if isinstance(result, BaseException)]
+
+
+def run_plan(experiments, provider_concurrency=default_provider_concurrency, data_folder='../data',
+             master_seed=None, dry_run=False, checkpoint=True, cache=None, telemetry=True, parquet=False):
+    """
+    Run all experiments of a plan with one scheduler and store their raw data.
+
+    Parameters:
+    -----------
+    experiments : list of Experiment
+        The plan, as returned by plan_experiments()
+    provider_concurrency : dict
+        Maximum number of queries in flight per provider
+    data_folder : str
+        Path to the data folder
+    master_seed : int, optional
+        Derive every cell's option order from this seed, see build_jobs in runner.py
+    dry_run : bool
+        Only print the plan
+    checkpoint : bool
+        Whether to resume every experiment from its checkpoint log, {model_name}_{condition}_log.jsonl
+    cache : ResponseCache or bool, optional
+        Response cache for identical queries, off by default, True uses the cache in the data folder
+    telemetry : bool
+        Whether to append the usage of every call to {data_folder}/telemetry/usage.jsonl
+    parquet : bool
+        Whether to also store the raw data in long format Parquet, see long_format.py
+
+    Returns:
+    --------
+    dict
+        {(model_name, condition): raw data rows} of the experiments whose queries all succeeded
+    """
+    for experiment in experiments:
+        experiment.backend = make_backend(experiment.backend_name, experiment.model, experiment.temperature)
+        experiment.provider = experiment.backend.provider
+        experiment.limiter = get_limiter(experiment.backend)
+        experiment.jobs = build_jobs(experiment.condition, experiment.model_runs, experiment.cot,
+                                     master_seed=master_seed)
+        experiment.log_path = os.path.join(data_folder, f"{experiment.model_name}_{experiment.condition}_log.jsonl")
+        experiment.records = load_records(experiment.log_path) if checkpoint else {}
+        experiment.missing_jobs = [job for job in experiment.jobs
+                                   if cell_key(experiment.model, experiment.condition, experiment.cot, job.q_number,
+                                               job.run) not in experiment.records]
+
+    estimate_durations(experiments, load_usage(os.path.join(data_folder, "telemetry", "usage.jsonl")))
+    print_plan(experiments, provider_concurrency)
+    if dry_run:
+        return {}
+
+    cache = open_cache(cache, data_folder)
+
+    with contextlib.ExitStack() as stack:
+        if checkpoint:
+            for experiment in experiments:
+                experiment.log = stack.enter_context(CheckpointLog(experiment.log_path))
+        telemetry_log = None
+        if telemetry:
+            telemetry_log = stack.enter_context(TelemetryLog(os.path.join(data_folder, "telemetry", "usage.jsonl")))
+        failures = run_async(run_schedule(experiments, provider_concurrency, cache, telemetry_log))
+
+    if cache is not None:
+        print(f"Response cache: {cache.hits} hits, {cache.misses} misses")
+
+    # an experiment with failed cells writes no outputs, its answered cells are kept in the checkpoint log
+    failed = {}
+    for experiment, job, error in failures:
+        failed.setdefault(id(experiment), []).append((job, error))
+    for experiment in experiments:
+        if id(experiment) in failed:
+            cells = failed[id(experiment)]
+            job, error = cells[0]
+            print(f"{experiment.model_name} {experiment.condition}: {len(cells)} of {len(experiment.jobs)} cells "
+                  f"failed, e.g. {job.q_number} run {job.run}: {error!r}")
+    if failed:
+        print("Run the plan again to retry the failed cells, the answered cells resume from the checkpoint logs"
+              if checkpoint else "Run the plan again to retry the failed experiments")
+
+    outputs = {}
+    for experiment in experiments:
+        if id(experiment) in failed:
+            continue
+        records = [experiment.records[cell_key(experiment.model, experiment.condition, experiment.cot, job.q_number,
+                                               job.run)] for job in experiment.jobs]
+        outputs[(experiment.model_name, experiment.condition)] = write_outputs(
+            experiment.backend, experiment.condition, experiment.jobs, records, experiment.model_name, data_folder,
+            parquet)
+    return outputs
+
+
+if __name__ == "__main__":
+    # the API keys are read from os.environ.get("OPENAI_API_KEY") and os.environ.get("ANTHROPIC_API_KEY")
+    models = {
+        "openai": ["gpt-4o-2024-08-06"],
+        "anthropic": ["claude-3-5-sonnet-20240620"],
+    }
+    conditions_to_run = ["standard", "distractor", "image"]
+    cot_options = (False, True)     # CoT is only planned for the standard and image conditions
+    model_runs = 10                 # number of answers per question, or a dict per condition
+    temperature = 0
+    master_seed = None              # set to an int to derive every cell's option order from it
+    provider_concurrency = {"openai": 16, "anthropic": 8, "fake": 32}
+    dry_run = True                  # only print the plan
+
+    plan = plan_experiments(models, conditions_to_run, cot_options, model_runs, temperature)
+    run_plan(plan, provider_concurrency, master_seed=master_seed, dry_run=dry_run)
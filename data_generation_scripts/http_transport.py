@@ -0,0 +1,109 @@
+"""
+Shared, pooled HTTP transport for backends that call the provider APIs without an SDK.
+
+A new connection per request pays a fresh TCP and TLS handshake every time, which dominates
+the latency of short prompts. The transport keeps a pool of keep-alive connections that all
+queries share, and speaks HTTP/2 when the h2 package is installed (pip install httpx[http2]),
+so many concurrent requests are multiplexed over a few connections.
+
+httpx is used when available (it is installed with the OpenAI and Anthropic SDKs), otherwise
+a pooled requests.Session is used, run in worker threads. An httpx client belongs to one event
+loop, and is closed when that loop's run_queries (run_async in query_engine.py) finishes.
+"""
+
+import asyncio
+import importlib.util
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from query_engine import on_loop_exit
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# httpx only speaks HTTP/2 with the h2 package installed
+http2_available = importlib.util.find_spec("h2") is not None
+
+
+timeout_seconds = 600   # long CoT answers can take minutes
+
+
+class HTTPXTransport:
+    """Async httpx client with a connection pool, using HTTP/2 where available."""
+
+    def __init__(self, pool_size=16, http2=True):
+        self.pool_size = pool_size
+        self.http2 = http2 and http2_available
+        self.client = None
+        self.client_loop = None
+
+    def get_client(self):
+        # an httpx client belongs to one event loop, so a new client is made when the loop changes,
+        # and closed with its pooled connections when the loop's run finishes
+        loop = asyncio.get_running_loop()
+        if self.client_loop is not loop:
+            limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            self.client = httpx.AsyncClient(http2=self.http2, limits=limits, timeout=timeout_seconds)
+            self.client_loop = loop
+            on_loop_exit(self.close)
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+        self.client = None
+        self.client_loop = None
+
+    async def post(self, url, headers, json):
+        return await self.get_client().post(url, headers=headers, json=json)
+
+    async def get(self, url, headers):
+        return await self.get_client().get(url, headers=headers)
+
+    def stream_post(self, url, headers, json):
+        # async context manager yielding a response whose body is read as it arrives
+        return self.get_client().stream("POST", url, headers=headers, json=json)
+
+
+class RequestsTransport:
+    """Pooled requests.Session, with the blocking calls run in worker threads."""
+
+    def __init__(self, pool_size=16):
+        self.session = pooled_session(pool_size)
+
+    async def post(self, url, headers, json):
+        return await asyncio.to_thread(self.session.post, url, headers=headers, json=json, timeout=timeout_seconds)
+
+    async def get(self, url, headers):
+        return await asyncio.to_thread(self.session.get, url, headers=headers, timeout=timeout_seconds)
+
+
+def pooled_session(pool_size=16):
+    # a requests.Session keeps connections alive between calls, the adapter sets the pool size
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+transports = {}
+sessions = {}
+
+
+def get_transport(pool_size=16, http2=True):
+    # one shared async transport per pool configuration, used by every backend that bypasses the SDKs
+    key = (pool_size, http2)
+    if key not in transports:
+        transports[key] = HTTPXTransport(pool_size, http2) if httpx is not None else RequestsTransport(pool_size)
+    return transports[key]
+
+
+def get_session(pool_size=16):
+    # shared pooled session for synchronous callers, such as the batch API polling
+    if pool_size not in sessions:
+        sessions[pool_size] = pooled_session(pool_size)
+    return sessions[pool_size]
@@ -0,0 +1,166 @@
+"""
+Optional preprocessing of the task images before they are sent to a model.
+
+Every image request carries four images, and every question is asked model_runs times, so the
+image bytes dominate the upload size and the image tokens dominate the input cost. This module
+shrinks each image once, and caches the result:
+- downscales it to the size the provider bills for, so no pixels are sent that the provider
+  would resize away anyway (Anthropic: 1568 px long side and about 1.15 megapixels, billed per
+  pixel; OpenAI: 2048 px box then 768 px short side, billed per 512 px tile), and shrinks it
+  slightly when one side just spills over into an extra OpenAI tile
+- strips metadata such as ICC profiles, gamma, and dpi chunks
+- optionally re-encodes it as WebP or JPEG, lowering the quality towards a configurable floor
+  until it fits a target size
+
+Preprocessing requires Pillow (pip install pillow). It changes the image bytes the model sees,
+so do not mix preprocessed and original runs in the same comparison.
+"""
+
+import base64
+import hashlib
+import io
+import json
+import math
+import os
+from dataclasses import asdict, dataclass
+
+try:
+    from PIL import Image
+except ImportError:     # Pillow is only needed when preprocessing is switched on
+    Image = None
+
+
+script_folder = os.path.dirname(os.path.abspath(__file__))
+cache_folder = os.path.join(script_folder, "..", "data", "image_cache")
+
+# resizing limits of the providers' vision models
+provider_limits = {
+    "anthropic": {"max_side": 1568, "max_pixels": 1_150_000},
+    "openai": {"max_side": 2048, "max_short_side": 768, "tile": 512},
+}
+
+format_media_types = {"PNG": "image/png", "WEBP": "image/webp", "JPEG": "image/jpeg"}
+
+
+@dataclass
+class PreprocessSettings:
+    provider: str                   # "anthropic" or "openai", any other provider is not resized
+    image_format: str = "PNG"       # "PNG" (lossless), "WEBP", or "JPEG"
+    quality: int = 90               # starting quality for WebP and JPEG
+    min_quality: int = 60           # quality floor, the quality is never lowered below this
+    target_bytes: int = None        # lower the quality step by step until the image fits, if set
+    tile_tolerance: float = 0.1     # shrink by up to this fraction to save an OpenAI tile
+
+    @property
+    def media_type(self):
+        return format_media_types[self.image_format]
+
+
+def tile_scale(width, height, tile, tolerance):
+    # scale that removes an extra tile row or column when a side only just spills over into it
+    scale = 1.0
+    for side in (width, height):
+        full_tiles = side // tile
+        if full_tiles and side % tile and side * (1 - tolerance) <= full_tiles * tile:
+            scale = min(scale, full_tiles * tile / side)
+    return scale
+
+
+def target_size(width, height, settings):
+    # the size the image is downscaled to for the settings' provider, images are never upscaled
+    limits = provider_limits.get(settings.provider)
+    if limits is None:
+        return width, height
+
+    scale = min(1.0, limits["max_side"] / max(width, height))
+    if "max_pixels" in limits:
+        scale = min(scale, math.sqrt(limits["max_pixels"] / (width * height)))
+    if "max_short_side" in limits:
+        scale = min(scale, limits["max_short_side"] / min(width, height))
+    if "tile" in limits:
+        scale *= tile_scale(width * scale, height * scale, limits["tile"], settings.tile_tolerance)
+
+    return max(1, math.floor(width * scale)), max(1, math.floor(height * scale))
+
+
+def encode(image, settings, quality):
+    output = io.BytesIO()
+    if settings.image_format == "PNG":
+        image.save(output, format="PNG", optimize=True)
+    elif settings.image_format == "WEBP":
+        image.save(output, format="WEBP", quality=quality, method=4)
+    else:
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def preprocess_image(image_bytes, settings):
+    """
+    Downscale, strip, and re-encode one image.
+
+    Returns:
+    --------
+    bytes
+        The preprocessed image, in settings.image_format
+    """
+    if Image is None:
+        raise ImportError("Image preprocessing requires Pillow, install it with 'pip install pillow'")
+
+    image = Image.open(io.BytesIO(image_bytes))
+    image.load()
+    size = target_size(image.width, image.height, settings)
+    if size != image.size:
+        image = image.resize(size, Image.LANCZOS)
+
+    if settings.image_format == "JPEG" and image.mode != "RGB":
+        # JPEG has no transparency, so transparent areas are put on a white background
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+        image = background
+
+    # drop the metadata, Pillow would otherwise write e.g. the ICC profile back out
+    image.info = {}
+
+    quality = settings.quality
+    encoded = encode(image, settings, quality)
+    lossy = settings.image_format != "PNG"
+    while (lossy and settings.target_bytes and len(encoded) > settings.target_bytes
+           and quality > settings.min_quality):
+        quality = max(settings.min_quality, quality - 10)
+        encoded = encode(image, settings, quality)
+    return encoded
+
+
+class ImagePreprocessor:
+    """Preprocesses stored images with fixed settings, caching the results on disk and in memory."""
+
+    def __init__(self, settings, cache_folder=cache_folder):
+        self.settings = settings
+        self.cache_folder = cache_folder
+        self.processed = {}
+        settings_json = json.dumps(asdict(settings), sort_keys=True)
+        self.settings_hash = hashlib.sha256(settings_json.encode("utf-8")).hexdigest()[:16]
+
+    def encoded_image(self, stored_image):
+        """
+        Return the preprocessed image as a base64 string, for a StoredImage from image_store.py.
+        The cache key combines the original image's sha256 with the settings.
+        """
+        key = f"{stored_image.sha256}_{self.settings_hash}"
+        if key in self.processed:
+            return self.processed[key]
+
+        cache_path = os.path.join(self.cache_folder, f"{key}.{self.settings.image_format.lower()}")
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as file:
+                processed_bytes = file.read()
+        else:
+            processed_bytes = preprocess_image(base64.b64decode(stored_image.data), self.settings)
+            os.makedirs(self.cache_folder, exist_ok=True)
+            temporary_path = f"{cache_path}.tmp"
+            with open(temporary_path, 'wb') as file:
+                file.write(processed_bytes)
+            os.replace(temporary_path, cache_path)
+
+        self.processed[key] = base64.b64encode(processed_bytes).decode("ascii")
+        return self.processed[key]
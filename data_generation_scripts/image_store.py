@@ -0,0 +1,193 @@
+"""
+Precomputed store of the base64-encoded task images.
+
+Instead of listing, reading, and base64-encoding the PNGs of a question folder every time
+they are needed, the store is built once: all encoded images are concatenated into one
+binary file, with a JSON index mapping each q_number to its images in filename order:
+(filename, sha256 of the image file, media type, offset and length in the binary file).
+
+Loading the store memory-maps the binary file, so process-pool workers that load it share
+the same pages instead of each holding a copy. The store is rebuilt automatically when an
+image is added, removed, or changed. Run this script to (re)build it by hand.
+
+A build never changes files that other processes may be reading: the binary file is written to
+a temporary file and moved to a new name derived from its contents (images-<sha256>.bin), and
+the index, which names its binary file, is written to a temporary file and moved over
+index.json last. A reader always sees a complete index with the binary file it belongs to,
+also while other processes rebuild the store at the same time.
+
+The sha256 hashes identify the image contents, which makes them stable cache keys.
+"""
+
+import base64
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+from dataclasses import dataclass
+
+
+script_folder = os.path.dirname(os.path.abspath(__file__))
+images_folder = os.path.join(script_folder, "..", "images")
+store_folder = os.path.join(script_folder, "..", "data", "image_store")
+
+media_types = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp",
+               ".gif": "image/gif"}
+
+
+@dataclass
+class StoredImage:
+    filename: str
+    sha256: str
+    media_type: str
+    data: str       # base64-encoded image
+
+
+def image_files(images_folder=images_folder):
+    # {q_number: [file paths in filename order]} for every question folder with images
+    folders = {}
+    for folder_name in sorted(os.listdir(images_folder)):
+        folder_path = os.path.join(images_folder, folder_name)
+        if os.path.isdir(folder_path):
+            filenames = sorted(name for name in os.listdir(folder_path)
+                               if os.path.splitext(name)[1].lower() in media_types)
+            folders[folder_name] = [os.path.join(folder_path, name) for name in filenames]
+    return folders
+
+
+def file_signature(path):
+    # size and modification time, used to notice changed images without reading them
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def build_image_store(images_folder=images_folder, store_folder=store_folder):
+    """
+    Encode every image once and write the binary file and its index to store_folder.
+
+    Returns:
+    --------
+    dict
+        The index, {q_number: list of image entries}
+    """
+    os.makedirs(store_folder, exist_ok=True)
+    index = {}
+    offset = 0
+    blob_hash = hashlib.sha256()
+
+    blob_fd, blob_temp = tempfile.mkstemp(suffix=".tmp", dir=store_folder)
+    with open(blob_fd, 'wb') as blob_file:
+        for q_number, paths in image_files(images_folder).items():
+            index[q_number] = []
+            for path in paths:
+                with open(path, 'rb') as image_file:
+                    image_bytes = image_file.read()
+                encoded_image = base64.b64encode(image_bytes)
+                blob_file.write(encoded_image)
+                blob_hash.update(encoded_image)
+
+                index[q_number].append({
+                    "filename": os.path.basename(path),
+                    "sha256": hashlib.sha256(image_bytes).hexdigest(),
+                    "media_type": media_types[os.path.splitext(path)[1].lower()],
+                    "offset": offset,
+                    "length": len(encoded_image),
+                    "signature": file_signature(path),
+                })
+                offset += len(encoded_image)
+        blob_file.flush()
+        os.fsync(blob_file.fileno())
+
+    # an existing binary file with the same name has the same contents, and may be memory-mapped elsewhere
+    blob_name = f"images-{blob_hash.hexdigest()[:16]}.bin"
+    if os.path.exists(os.path.join(store_folder, blob_name)):
+        os.remove(blob_temp)
+    else:
+        os.replace(blob_temp, os.path.join(store_folder, blob_name))
+
+    index_fd, index_temp = tempfile.mkstemp(suffix=".tmp", dir=store_folder)
+    with open(index_fd, 'w') as index_file:
+        json.dump({"blob": blob_name, "images": index}, index_file, indent=1)
+        index_file.flush()
+        os.fsync(index_file.fileno())
+    os.replace(index_temp, os.path.join(store_folder, "index.json"))
+    remove_old_blobs(store_folder, blob_name)
+
+    print(f"Image store with {sum(len(entries) for entries in index.values())} images "
+          f"has been written to {store_folder}")
+    return index
+
+
+def remove_old_blobs(store_folder, current_blob):
+    # binary files of earlier builds, a file that is still open or memory-mapped elsewhere is left for later
+    for name in os.listdir(store_folder):
+        if name.startswith("images") and name.endswith(".bin") and name != current_blob:
+            try:
+                os.remove(os.path.join(store_folder, name))
+            except OSError:
+                pass
+
+
+def read_index(store_folder=store_folder):
+    # the stored index, {"blob": binary file name, "images": {q_number: list of image entries}}, None if
+    # there is none or it was written by an older version of the store
+    try:
+        with open(os.path.join(store_folder, "index.json"), 'r') as index_file:
+            stored = json.load(index_file)
+    except (OSError, json.JSONDecodeError):
+        return None
+    return stored if "blob" in stored else None
+
+
+def store_is_stale(index, images_folder=images_folder):
+    # true if images were added, removed, or changed since the store was built
+    current_files = image_files(images_folder)
+    if sorted(current_files) != sorted(index):
+        return True
+    for q_number, paths in current_files.items():
+        stored = [(entry["filename"], entry["signature"]) for entry in index[q_number]]
+        current = [(os.path.basename(path), file_signature(path)) for path in paths]
+        if stored != current:
+            return True
+    return False
+
+
+class ImageStore:
+    """Read access to a built image store, with the binary file memory-mapped."""
+
+    def __init__(self, store_folder=store_folder, stored=None):
+        stored = stored or read_index(store_folder)
+        self.index = stored["images"]
+
+        with open(os.path.join(store_folder, stored["blob"]), 'rb') as blob_file:
+            # an empty file cannot be memory-mapped
+            self.blob = mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ) if self.index else b""
+
+    def images(self, q_number):
+        # the stored images of a question, in filename order
+        return [StoredImage(entry["filename"], entry["sha256"], entry["media_type"],
+                            self.blob[entry["offset"]:entry["offset"] + entry["length"]].decode("ascii"))
+                for entry in self.index[q_number]]
+
+    def encoded_images(self, q_number):
+        # drop-in replacement for encode_images_from_folder(q_number)
+        return [image.data for image in self.images(q_number)]
+
+
+def load_image_store(store_folder=store_folder, images_folder=images_folder):
+    # load the image store, building or rebuilding it first if it is missing or out of date
+    for _ in range(3):
+        stored = read_index(store_folder)
+        if stored is None or store_is_stale(stored["images"], images_folder):
+            build_image_store(images_folder, store_folder)
+            stored = read_index(store_folder)
+        try:
+            return ImageStore(store_folder, stored)
+        except FileNotFoundError:
+            continue    # another process rebuilt the store with changed images in between, read its index
+    raise RuntimeError(f"The image store in {store_folder} keeps changing while it is loaded")
+
+
+if __name__ == "__main__":
+    build_image_store()
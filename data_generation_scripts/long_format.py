@@ -0,0 +1,164 @@
+"""
+Long-format columnar storage (Parquet) of the raw and binary data.
+
+The raw and binary data CSVs are wide: one row per question with one column per run, under a
+header that does not name the run columns (the binary CSV has no header at all). This module
+stores the same data in long format, one typed row per (model, condition, cot, q_number, run):
+- raw data: presentation_order, response, and latency, as {model_name}_{condition}_raw_data.parquet
+- binary data: correct (0/1), as {model_name}_{condition}_binary_data.parquet
+
+The readers return the long format as a DataFrame, reading the Parquet file when it exists and is
+at least as new as the CSV, and otherwise converting the CSV, so the evaluation and averaging
+scripts work with either. A CSV that was rewritten without its Parquet file, e.g. by a
+re-evaluation with parquet = False, is newer and wins over the stale Parquet file.
+Writing and reading Parquet requires pyarrow (pip install pyarrow), the CSV files are always
+written as before.
+"""
+
+import csv
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:     # pyarrow is only needed for the Parquet files
+    pa = None
+    pq = None
+
+
+def raw_schema():
+    return pa.schema([
+        ("model", pa.string()),
+        ("condition", pa.string()),
+        ("cot", pa.bool_()),
+        ("q_number", pa.string()),
+        ("run", pa.int32()),
+        ("presentation_order", pa.list_(pa.string())),
+        ("response", pa.string()),
+        ("latency", pa.float64()),
+    ])
+
+
+def binary_schema():
+    return pa.schema([
+        ("model", pa.string()),
+        ("condition", pa.string()),
+        ("cot", pa.bool_()),
+        ("q_number", pa.string()),
+        ("run", pa.int32()),
+        ("correct", pa.int8()),
+    ])
+
+
+def data_path(data_folder, model_name, condition, kind, extension):
+    # e.g. ../data/gpt-4o_standard_raw_data.parquet, kind is 'raw' or 'binary'
+    return os.path.join(data_folder, f"{model_name}_{condition}_{kind}_data.{extension}")
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("Parquet output requires pyarrow, install it with 'pip install pyarrow'")
+
+
+def write_table(rows, schema, path):
+    require_pyarrow()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    table = pa.Table.from_pylist(rows, schema=schema)
+    pq.write_table(table, path)
+    print(f"Data has been written to {path}")
+    return path
+
+
+def write_raw_parquet(records, model_name, condition, data_folder='../data'):
+    # long-format raw data from the runner's job records, one row per (q_number, run)
+    rows = [{"model": record["model"], "condition": record["condition"], "cot": record["cot"],
+             "q_number": record["q_number"], "run": record["run"],
+             "presentation_order": record["presentation_order"], "response": record["response"],
+             "latency": record.get("latency")} for record in records]
+    return write_table(rows, raw_schema(), data_path(data_folder, model_name, condition, "raw", "parquet"))
+
+
+def write_binary_parquet(binary_rows, condition, cot, model_name, data_folder='../data'):
+    # long-format binary data from the wide [model, q_number, 0/1 per run] rows of the evaluation scripts
+    rows = [{"model": row[0], "condition": condition, "cot": cot, "q_number": row[1], "run": run,
+             "correct": int(value)} for row in binary_rows for run, value in enumerate(row[2:])]
+    return write_table(rows, binary_schema(), data_path(data_folder, model_name, condition, "binary", "parquet"))
+
+
+def use_parquet(parquet_path, csv_path):
+    # whether to read the Parquet file: it exists, pyarrow is installed, and the CSV is not newer
+    if pq is None or not os.path.exists(parquet_path):
+        return False
+    if os.path.exists(csv_path) and os.path.getmtime(csv_path) > os.path.getmtime(parquet_path):
+        print(f"{csv_path} is newer than {parquet_path}, reading the CSV")
+        return False
+    return True
+
+
+def read_wide_csv(path):
+    # the rows of a wide data CSV, without the header row of the raw data CSV
+    with open(path, 'r', newline='') as file:
+        rows = list(csv.reader(file))
+    if rows and rows[0][:2] == ["model", "q_number"]:
+        rows = rows[1:]
+    return rows
+
+
+def long_from_wide(rows, condition, cot, value_column):
+    # one row per (q_number, run) from wide [model, q_number, value per run] rows
+    return pd.DataFrame([{"model": row[0], "condition": condition, "cot": cot, "q_number": row[1], "run": run,
+                          value_column: value} for row in rows for run, value in enumerate(row[2:])])
+
+
+def read_raw_data(data_folder, model_name, condition, cot=None):
+    """
+    Read the raw data of a model and condition in long format.
+
+    Parameters:
+    -----------
+    data_folder : str
+        Path to the data folder
+    model_name : str
+        Model name used in the filename, with a '_cot' suffix for Chain-of-Thought data
+    condition : str
+        Experimental condition, 'standard', 'distractor', or 'image'
+    cot : bool, optional
+        Whether the data is Chain-of-Thought data, defaults to whether model_name ends with '_cot'
+
+    Returns:
+    --------
+    pd.DataFrame
+        One row per (q_number, run). Data read from the CSV has no presentation_order or latency
+    """
+    parquet_path = data_path(data_folder, model_name, condition, "raw", "parquet")
+    csv_path = data_path(data_folder, model_name, condition, "raw", "csv")
+    if use_parquet(parquet_path, csv_path):
+        return pd.read_parquet(parquet_path)
+
+    if cot is None:
+        cot = model_name.endswith("_cot")
+    rows = read_wide_csv(csv_path)
+    return long_from_wide(rows, condition, cot, "response")
+
+
+def read_binary_data(data_folder, model_name, condition, cot=None):
+    # the binary data of a model and condition in long format, from the Parquet file if it is current, see read_raw_data
+    parquet_path = data_path(data_folder, model_name, condition, "binary", "parquet")
+    csv_path = data_path(data_folder, model_name, condition, "binary", "csv")
+    if use_parquet(parquet_path, csv_path):
+        return pd.read_parquet(parquet_path)
+
+    if cot is None:
+        cot = model_name.endswith("_cot")
+    rows = read_wide_csv(csv_path)
+    return long_from_wide(rows, condition, cot, "correct").astype({"correct": "int8"})
+
+
+def wide_rows(long_data, value_column):
+    # back to wide [model, q_number, value per run] rows, with the questions in their original order
+    rows = {}
+    for row in long_data.sort_values("run", kind="stable").itertuples(index=False):
+        rows.setdefault(row.q_number, [row.model, row.q_number]).append(getattr(row, value_column))
+    return list(rows.values())
@@ -0,0 +1,78 @@
+"""
+Concurrent query engine for the data generation scripts.
+
+The test scripts first build every (question, run) prompt and then hand the whole
+list of jobs to the engine. The engine fans the jobs out on an asyncio event loop,
+with a semaphore bounding how many requests are in flight at once, and returns the
+responses in the same order as the jobs. This lets the scripts assemble their CSV
+rows in q_number order exactly as before, while the API calls overlap in time.
+
+Usage:
+    jobs = [(prompt,), (prompt,), ...]          # one tuple of arguments per query
+    responses = run_queries(jobs, query_function, concurrency=8)
+"""
+
+import asyncio
+
+# async cleanup functions of the running event loops, e.g. closing an HTTP client that belongs to a loop,
+# called by run_async when its loop finishes
+loop_cleanups = {}
+
+
+def on_loop_exit(cleanup):
+    # call the async function cleanup() when the running event loop of run_async finishes
+    loop_cleanups.setdefault(asyncio.get_running_loop(), []).append(cleanup)
+
+
+async def run_with_cleanups(coroutine):
+    try:
+        return await coroutine
+    finally:
+        for cleanup in loop_cleanups.pop(asyncio.get_running_loop(), []):
+            await cleanup()
+
+
+def run_async(coroutine):
+    # asyncio.run, followed by the cleanups registered with on_loop_exit while it ran
+    return asyncio.run(run_with_cleanups(coroutine))
+
+
+async def gather_bounded(jobs, query, concurrency=8, on_result=None, return_exceptions=False):
+    """
+    Run an async query function once per job with at most `concurrency` calls in flight.
+
+    Parameters:
+    -----------
+    jobs : list of tuple
+        Positional arguments for each call of `query`
+    query : async callable
+        Coroutine function performing a single model query
+    concurrency : int
+        Maximum number of simultaneous queries
+    on_result : callable, optional
+        Called as on_result(index, job, result) as soon as each query finishes
+    return_exceptions : bool
+        Whether a failed query returns its exception in place of its result, instead of stopping
+        all queries. on_result is not called for a failed query
+
+    Returns:
+    --------
+    list
+        Query results, in the same order as `jobs`
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_job(index, job):
+        async with semaphore:
+            result = await query(*job)
+        if on_result is not None:
+            on_result(index, job, result)
+        return result
+
+    return await asyncio.gather(*(run_job(index, job) for index, job in enumerate(jobs)),
+                                return_exceptions=return_exceptions)
+
+
+def run_queries(jobs, query, concurrency=8, on_result=None, return_exceptions=False):
+    # synchronous entry point for the test scripts, which are not async themselves
+    return run_async(gather_bounded(jobs, query, concurrency, on_result, return_exceptions))
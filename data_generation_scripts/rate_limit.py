@@ -0,0 +1,295 @@
+"""
+Rate limiting and retries for the model backends.
+
+Each model gets a RateLimiter with two token buckets, one for requests per minute and one
+for tokens per minute. Before every query the runner takes one request and an estimate of
+the query's tokens from the buckets, waiting if the budget is used up. The buckets are kept
+in sync with the rate limit headers the providers send back, so a sweep can run close to the
+provider's limit without being throttled.
+
+Throttled (429), overloaded (529), timed out and server error (5xx) responses are retried
+with jittered exponential backoff. When the provider says how long to wait (retry-after or
+a rate limit reset header) that wait is used instead, and the whole limiter is paused so the
+other concurrent queries back off as well.
+"""
+
+import asyncio
+import random
+import re
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+# default budgets per provider as (requests per minute, tokens per minute), None means unlimited.
+# check the limits of your own API tier and override them with RateLimiter(...) if they differ
+default_limits = {
+    "openai": (500, 30000),
+    "anthropic": (50, 40000),
+    "fake": (None, None),
+}
+
+retryable_status_codes = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class ProviderHTTPError(Exception):
+    """Raised by backends that bypass the SDKs when the provider returns an error status."""
+
+    def __init__(self, status_code, headers, body):
+        super().__init__(f"Provider returned HTTP {status_code}: {body}")
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+
+class TokenBucket:
+    """A bucket of `capacity` tokens that refills continuously over one minute."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tokens = capacity
+        self.refill_rate = capacity / 60    # tokens per second
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # seconds until `amount` tokens are available, a request larger than the bucket waits for a full bucket
+        self.refill()
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.refill_rate)
+
+
+class RateLimiter:
+    """Requests per minute and tokens per minute budget for one model."""
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until = 0.0
+        self.lock = None
+        self.lock_loop = None
+
+    async def acquire(self, estimated_tokens=0):
+        # the limiter is shared between runs, so the lock is recreated for every new event loop
+        loop = asyncio.get_running_loop()
+        if self.lock_loop is not loop:
+            self.lock = asyncio.Lock()
+            self.lock_loop = loop
+
+        # the lock makes waiting queries take their budget in arrival order
+        async with self.lock:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                for bucket, amount in ((self.requests, 1), (self.tokens, estimated_tokens)):
+                    if bucket is not None:
+                        wait = max(wait, bucket.wait_time(amount))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            if self.requests is not None:
+                self.requests.tokens -= 1
+            if self.tokens is not None:
+                self.tokens.tokens -= estimated_tokens
+
+    def settle(self, estimated_tokens, used_tokens):
+        # give back the part of the estimate that the query did not use
+        if self.tokens is not None and used_tokens is not None:
+            self.tokens.refill()
+            self.tokens.tokens = min(self.tokens.capacity, self.tokens.tokens + estimated_tokens - used_tokens)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers):
+        # lower the buckets to what the provider reports as remaining, and pause until reset if nothing is left
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            remaining, reset = remaining_from_headers(headers, kind)
+            if remaining is None:
+                continue
+            if bucket is not None:
+                bucket.refill()
+                bucket.tokens = min(bucket.tokens, remaining)
+            if remaining <= 0 and reset is not None:
+                self.pause(reset)
+
+
+limiters = {}
+
+
+def get_limiter(backend, requests_per_minute=None, tokens_per_minute=None):
+    # one shared limiter per model, created with the provider defaults unless budgets are given
+    if backend.model not in limiters:
+        default_rpm, default_tpm = default_limits.get(backend.provider, (None, None))
+        limiters[backend.model] = RateLimiter(requests_per_minute or default_rpm,
+                                              tokens_per_minute or default_tpm)
+    return limiters[backend.model]
+
+
+def parse_duration(value):
+    # parse OpenAI style reset durations such as '1s', '6m0s' or '20ms' into seconds
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def parse_reset(value):
+    # reset headers are either durations (OpenAI), RFC 3339 timestamps (Anthropic), or plain seconds
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    if "T" in value:
+        try:
+            reset_time = datetime.fromisoformat(value.replace("Z", "+00:00"))
+            return max(0.0, (reset_time - datetime.now(timezone.utc)).total_seconds())
+        except ValueError:
+            return None
+    return parse_duration(value)
+
+
+def remaining_from_headers(headers, kind):
+    # returns (remaining, seconds until reset) for 'requests' or 'tokens', from OpenAI or Anthropic headers
+    for prefix in ("x-ratelimit", "anthropic-ratelimit"):
+        remaining = headers.get(f"{prefix}-remaining-{kind}") or headers.get(f"{prefix}-{kind}-remaining")
+        if remaining is not None:
+            reset = headers.get(f"{prefix}-reset-{kind}") or headers.get(f"{prefix}-{kind}-reset")
+            try:
+                return int(remaining), parse_reset(reset)
+            except ValueError:
+                return None, None
+    return None, None
+
+
+def retry_after(headers):
+    # seconds the provider asks us to wait, from retry-after-ms or retry-after (seconds or an HTTP date)
+    if headers is None:
+        return None
+    if headers.get("retry-after-ms") is not None:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def error_details(error):
+    """
+    Return (retryable, status_code, headers) for an exception raised by a backend.
+    Works with the OpenAI and Anthropic SDK errors as well as ProviderHTTPError.
+    """
+    status_code = getattr(error, "status_code", None)
+    response = getattr(error, "response", None)
+    headers = getattr(error, "headers", None) or getattr(response, "headers", None)
+
+    if status_code is not None:
+        return status_code in retryable_status_codes, status_code, headers
+
+    # connection problems and timeouts carry no status code but are worth retrying
+    connection_errors = ("APIConnectionError", "APITimeoutError", "ConnectionError", "Timeout", "ReadTimeout",
+                         "ConnectTimeout", "TimeoutError", "ConnectError", "ReadError", "WriteError",
+                         "WriteTimeout", "PoolTimeout", "RemoteProtocolError")
+    retryable = isinstance(error, (ConnectionError, asyncio.TimeoutError)) or type(error).__name__ in connection_errors
+    return retryable, None, headers
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=60.0):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def estimate_tokens(prompt, images=None, max_tokens=800, tokens_per_image=1600):
+    # rough token estimate used to draw from the tokens per minute budget before the real usage is known
+    return len(prompt) // 4 + len(images or []) * tokens_per_image + max_tokens
+
+
+def used_tokens(usage):
+    # total tokens from an OpenAI or Anthropic usage record, None if it is missing
+    if not usage:
+        return None
+    if usage.get("total_tokens") is not None:
+        return usage["total_tokens"]
+    input_tokens = usage.get("input_tokens") or usage.get("prompt_tokens")
+    output_tokens = usage.get("output_tokens") or usage.get("completion_tokens")
+    if input_tokens is None and output_tokens is None:
+        return None
+    return (input_tokens or 0) + (output_tokens or 0)
+
+
+async def query_with_retry(backend, prompt, images=None, limiter=None, max_retries=6, base_delay=1.0,
+                           max_delay=60.0):
+    """
+    Query a backend within its rate limit, retrying throttled and failed calls.
+
+    Parameters:
+    -----------
+    backend : object
+        Any backend from backends.py
+    prompt : str
+        Text prompt
+    images : list of str, optional
+        Base64-encoded images
+    limiter : RateLimiter, optional
+        Budget to draw from, defaults to the shared limiter of the backend's model
+    max_retries : int
+        Number of retries before the error is raised
+    base_delay, max_delay : float
+        Bounds in seconds for the jittered exponential backoff
+
+    Returns:
+    --------
+    QueryResult
+        The backend's result, with the number of retries it took stored in result.retries
+    """
+    if limiter is None:
+        limiter = get_limiter(backend)
+    estimated = estimate_tokens(prompt, images, backend.max_tokens)
+
+    for attempt in range(max_retries + 1):
+        await limiter.acquire(estimated)
+        try:
+            result = await backend.query(prompt, images)
+        except Exception as error:
+            retryable, status_code, headers = error_details(error)
+            if not retryable or attempt == max_retries:
+                raise
+
+            delay = retry_after(headers)
+            if delay is None and headers is not None and status_code == 429:
+                resets = [remaining_from_headers(headers, kind)[1] for kind in ("requests", "tokens")]
+                delay = max((reset for reset in resets if reset is not None), default=None)
+            if delay is None:
+                delay = backoff_delay(attempt, base_delay, max_delay)
+            else:
+                # a little jitter keeps the paused queries from retrying all at once
+                delay += random.uniform(0, base_delay)
+            if status_code == 429:
+                limiter.pause(delay)
+
+            print(f"Query failed ({status_code or type(error).__name__}), retrying in {delay:.1f}s "
+                  f"(attempt {attempt + 1} of {max_retries})")
+            await asyncio.sleep(delay)
+            continue
+
+        limiter.update_from_headers(result.headers)
+        limiter.settle(estimated, used_tokens(result.usage))
+        result.retries = attempt
+        return result
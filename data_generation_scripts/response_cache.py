@@ -0,0 +1,162 @@
+"""
+Content-addressed on-disk cache of model responses.
+
+Each response is stored as a small JSON file named by the SHA-256 hash of everything that
+determines the request: provider, model, temperature, max_tokens, streaming, prompt caching,
+the image media type, the prompt text, and the SHA-256 hashes of the images in presentation
+order. A query whose hash is already in the cache is answered from disk without touching the
+network.
+
+The cache is off by default in the runner, the experiment planner, and the work queue, since
+re-running a condition is usually meant to collect fresh answers. Pass cache=True (or a
+ResponseCache) to turn it on, e.g. to resume or repeat a deterministic run without paying for
+it again. The runs print how many answers came from the cache.
+
+The cache is kept under a size limit by evicting the least recently used entries, where a
+cache hit counts as a use. Only deterministic (temperature 0) queries are cached by default,
+since at a higher temperature every run is meant to be a fresh sample. Set
+reuse_nonzero_temperature=True to cache those as well.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+
+from backends import QueryResult
+
+
+def image_hash(image):
+    # SHA-256 of a base64-encoded image
+    return hashlib.sha256(image.encode("ascii")).hexdigest()
+
+
+def query_key(backend, prompt, images=None):
+    # hash of everything that determines the model's answer
+    key_data = {
+        "provider": backend.provider,
+        "model": backend.model,
+        "temperature": backend.temperature,
+        "max_tokens": backend.max_tokens,
+        "stream": getattr(backend, "stream", False),
+        "prompt_caching": getattr(backend, "prompt_caching", False),
+        "image_media_type": getattr(backend, "image_media_type", None) if images else None,
+        "prompt": prompt,
+        "images": [image_hash(image) for image in images or []],
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def open_cache(cache, data_folder='../data'):
+    """
+    The response cache for a cache argument: None or False (no cache), True (the cache in the data
+    folder), or a ResponseCache, which is used as it is.
+    """
+    if cache is None or cache is False:
+        return None
+    if cache is True:
+        cache = ResponseCache(os.path.join(data_folder, "response_cache"))
+    print(f"Response cache is on: identical deterministic queries are answered from {cache.cache_folder}")
+    return cache
+
+
+class ResponseCache:
+
+    def __init__(self, cache_folder='../data/response_cache', max_bytes=200 * 1024 ** 2,
+                 reuse_nonzero_temperature=False):
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self.reuse_nonzero_temperature = reuse_nonzero_temperature
+        self.in_flight = {}     # key -> future, so identical concurrent queries are only sent once
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_folder, exist_ok=True)
+        self.total_bytes = sum(os.path.getsize(path) for path in self.entry_paths())
+
+    def entry_path(self, key):
+        # two-character subfolders keep the number of files per folder small
+        return os.path.join(self.cache_folder, key[:2], f"{key}.json")
+
+    def entry_paths(self):
+        for subfolder in os.scandir(self.cache_folder):
+            if subfolder.is_dir():
+                for entry in os.scandir(subfolder.path):
+                    if entry.name.endswith(".json"):
+                        yield entry.path
+
+    def applies_to(self, backend):
+        return backend.temperature == 0 or self.reuse_nonzero_temperature
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        os.utime(path)  # mark as recently used for the LRU eviction
+        return QueryResult(entry["text"], entry.get("usage", {}), cached=True)
+
+    def put(self, key, result):
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+
+        # write to a temporary file first, so a crash never leaves a half-written entry behind
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            json.dump({"text": result.text, "usage": result.usage}, file, ensure_ascii=False)
+        os.replace(temporary_path, path)
+
+        self.total_bytes += os.path.getsize(path) - previous_size
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # delete the least recently used entries until the cache is at 90% of its size limit
+        entries = sorted((os.stat(path).st_mtime, os.path.getsize(path), path) for path in self.entry_paths())
+        for _, size, path in entries:
+            if self.total_bytes <= 0.9 * self.max_bytes:
+                break
+            os.remove(path)
+            self.total_bytes -= size
+
+    async def query(self, backend, prompt, images, query):
+        """
+        Answer from the cache if possible, otherwise await query() and store its result.
+        `query` is a coroutine function without arguments that performs the real call.
+        """
+        if not self.applies_to(backend):
+            return await query()
+
+        key = query_key(backend, prompt, images)
+        cached_result = self.get(key)
+        if cached_result is not None:
+            self.hits += 1
+            return cached_result
+
+        # an identical query is already on its way, wait for its answer instead of sending another
+        if key in self.in_flight:
+            self.hits += 1
+            result = await asyncio.shield(self.in_flight[key])
+            return QueryResult(result.text, result.usage, cached=True)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            result = await query()
+        except BaseException as error:
+            if isinstance(error, Exception):
+                future.set_exception(error)
+                future.exception()     # mark as retrieved in case no identical query is waiting
+            else:
+                future.cancel()
+            raise
+        finally:
+            del self.in_flight[key]
+
+        future.set_result(result)
+        self.put(key, result)
+        return result
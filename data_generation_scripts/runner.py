@@ -0,0 +1,434 @@
+"""
+Provider-agnostic runner for the standard, distractor, and image conditions.
+
+The runner builds the task prompts from the imported test_list, queries any backend from
+backends.py concurrently, and stores the responses in the raw data CSV used by the
+evaluation scripts. The gpt_test_*.py and claude_test_*.py scripts are thin configurations
+of this runner. It can also be run directly, configured with the variables at the bottom.
+
+Next to the raw data, a {model_name}_{condition}_metrics.csv sidecar records the timing of
+every call: latency, time to first token (for streaming backends), output tokens per second,
+and the number of retries. The usage of every new call is also appended to the telemetry
+store, see telemetry.py.
+
+With a master_seed, the option order of every cell (condition, q_number, run) is drawn from
+its own random generator, seeded from the master seed and the cell. Any subset of cells then
+gets the same prompts in any order, in any process. Without a master seed, the options are
+shuffled in sequence with the global random generator, as the original scripts did.
+"""
+
+import contextlib
+import csv
+import hashlib
+import os
+import random
+from dataclasses import dataclass
+
+from test_list_dict import test_list
+from query_engine import run_queries
+from rate_limit import get_limiter, query_with_retry
+from checkpoint import CheckpointLog, cell_key, load_records
+from response_cache import open_cache
+from image_store import load_image_store
+from image_preprocess import ImagePreprocessor
+from telemetry import TelemetryLog, generation_record
+from long_format import write_raw_parquet
+from backends import cache_read_tokens, output_tokens
+
+
+conditions = ["standard", "distractor", "image"]
+
+# the test_list keys of the text options presented per question, by condition
+option_keys = {
+    "standard": ["afforded_tool", "associated_tool1", "associated_tool2", "irrelevant_tool1"],
+    "distractor": ["afforded_tool", "associated_tool1", "associated_tool2", "associated_tool3",
+                   "associated_tool4", "irrelevant_tool1", "irrelevant_tool2", "irrelevant_tool3",
+                   "irrelevant_tool4"],
+}
+
+cot_instruction = "Evaluate each option separately before specifying your choice."
+
+# can be used to verify that the LLM understands the image contents,
+# simply replace the task prompt with imrecog_prompt when querying the model
+imrecog_prompt = "In brief terms, specify the typical function of the object shown in each of the four images."
+
+# columns of the per-call metrics sidecar CSV, taken from the job records
+metrics_columns = ["model", "condition", "cot", "q_number", "run", "streamed", "cached", "retries",
+                   "time_to_first_token", "latency", "output_tokens", "output_tokens_per_second"]
+
+
+@dataclass
+class PromptJob:
+    q_number: str
+    run: int                    # index of the model run, starting at 0
+    prompt: str
+    presentation_order: list    # option names (text conditions) or image filenames (image condition), as shown
+    images: list = None         # base64-encoded images, in presentation order
+    permutation: list = None    # presentation_order as indices into the unshuffled options
+    seed: int = None            # seed of the cell's random generator, None if the global generator was used
+
+
+def build_prompt(tasks, condition, object_list=None, cot=False):
+    """
+    Create the task prompt for one question, with the options in the given order.
+    The wording matches the prompts used to collect the original data.
+    """
+    task = tasks["task"]
+    source_tool = tasks["source_tool"]
+
+    if condition == "image":
+        normal_prompt = (f"Your task is to {task}. Normally, you would use {source_tool} to accomplish this task. "
+                         f"However, {source_tool} is not available to you. At your disposal, you have the objects "
+                         f"shown in the four images. Which one of these would you use to accomplish the task?")
+        return f"{normal_prompt} {cot_instruction}" if cot else normal_prompt
+
+    normal_prompt = (f"Your task is to {task}. Normally, you would use {source_tool} to accomplish this task. "
+                     f"However, {source_tool} is not available to you. At your disposal, you have the objects "
+                     f"listed below. Which one of these would you use to accomplish the task? \n"
+                     + " \n".join(object_list))
+
+    if not cot:
+        return normal_prompt
+    # the distractor prompt puts the CoT instruction on its own line, the standard prompt does not
+    separator = " \n" if condition == "distractor" else " "
+    return f"{normal_prompt}{separator}{cot_instruction}"
+
+
+def cell_seed(master_seed, condition, q_number, run):
+    # seed of one cell's random generator, a hash so that neighbouring cells get unrelated seeds
+    cell = f"{master_seed}:{condition}:{q_number}:{run}"
+    return int.from_bytes(hashlib.sha256(cell.encode("utf-8")).digest()[:8], "big")
+
+
+def shuffled(options, rng):
+    # the options in shuffled order, with the permutation that was applied
+    permutation = list(range(len(options)))
+    rng.shuffle(permutation)
+    return [options[index] for index in permutation], permutation
+
+
+def build_jobs(condition, model_runs, cot=False, tasks_list=test_list, preprocessor=None, master_seed=None,
+               cells=None):
+    """
+    Create the prompt for every (question, run) with a shuffled option order.
+
+    Parameters:
+    -----------
+    condition : str
+        Experimental condition, 'standard', 'distractor', or 'image'
+    model_runs : int
+        Number of runs per question
+    cot : bool
+        Whether to add the Chain-of-Thought instruction to the prompt
+    tasks_list : list of dict
+        Task specifications, defaults to test_list
+    preprocessor : ImagePreprocessor, optional
+        Shrinks the images of the image condition before they are sent
+    master_seed : int, optional
+        Seed from which every cell's option order is derived. Without it the options are shuffled
+        in sequence with the global random generator, as the original scripts did
+    cells : collection of (q_number, run), optional
+        Only build the jobs of these cells
+
+    Returns:
+    --------
+    list of PromptJob
+    """
+    if condition not in conditions:
+        raise ValueError(f"Unknown condition '{condition}', choose from {conditions}")
+
+    # the precomputed image store holds the images in base64 format, see image_store.py
+    image_store = load_image_store() if condition == "image" else None
+
+    jobs = []
+    for tasks in tasks_list:
+        question_nr = tasks["q_number"]
+
+        if condition == "image":
+            stored_images = {image.filename: image for image in image_store.images(question_nr)}
+            options = list(stored_images)   # image filenames, in filename order
+        else:
+            options = [tasks[key] for key in option_keys[condition]]
+        order = list(options)
+
+        for i in range(model_runs):
+            if master_seed is None:
+                random.shuffle(order)       # shuffle order of presentation each time, continuing from the last run
+                permutation = [options.index(option) for option in order]
+                seed = None
+            else:
+                seed = cell_seed(master_seed, condition, question_nr, i)
+                order, permutation = shuffled(options, random.Random(seed))
+
+            if cells is not None and (question_nr, i) not in cells:
+                continue
+
+            if condition == "image":
+                images = [preprocessor.encoded_image(stored_images[filename]) if preprocessor
+                          else stored_images[filename].data for filename in order]
+                jobs.append(PromptJob(question_nr, i, build_prompt(tasks, condition, cot=cot),
+                                      list(order), images, permutation, seed))
+            else:
+                jobs.append(PromptJob(question_nr, i, build_prompt(tasks, condition, order, cot),
+                                      list(order), permutation=permutation, seed=seed))
+
+    return jobs
+
+
+async def answer_job(backend, job, limiter, cache=None):
+    # one job's answer, from the response cache or from the backend within its rate limit
+    async def query():
+        return await query_with_retry(backend, job.prompt, job.images, limiter)
+
+    if cache is None:
+        return await query()
+    return await cache.query(backend, job.prompt, job.images, query)
+
+
+def print_answer(job, result):
+    # print if you want to see tasks and model answers as they are being generated
+    print(f"{job.prompt} \n\n{result.text}\n\n")
+    if result.cached:
+        print("(answer from the response cache)\n")
+    if cache_read_tokens(result.usage):
+        print(f"Prompt cache: {cache_read_tokens(result.usage)} input tokens read from the cache\n")
+
+
+def query_jobs(backend, jobs, concurrency=8, limiter=None, on_result=None, cache=None, return_exceptions=False):
+    """
+    Query the backend with all jobs concurrently within its rate limit, answering from the
+    response cache where possible. on_result(job, result) is called as soon as each answer
+    arrives, the QueryResults are returned in job order. With return_exceptions, a job that
+    failed returns its exception in place of its QueryResult, and the other jobs still finish.
+    """
+    if limiter is None:
+        limiter = get_limiter(backend)
+
+    async def query_job(job):
+        return await answer_job(backend, job, limiter, cache)
+
+    def handle_result(index, job_args, result):
+        print_answer(job_args[0], result)
+        if on_result is not None:
+            on_result(job_args[0], result)
+
+    if not getattr(backend, "prompt_caching", False):
+        return run_queries([(job,) for job in jobs], query_job, concurrency, handle_result, return_exceptions)
+
+    # with prompt caching (off by default), the first job of every question is sent ahead of the others,
+    # so the later runs of the question can read the prompt prefix it wrote to the cache. the other runs
+    # wait for all first jobs to finish, which lengthens the run
+    first_indices = sorted({job.q_number: index for index, job in reversed(list(enumerate(jobs)))}.values())
+    other_indices = sorted(set(range(len(jobs))) - set(first_indices))
+    results = [None] * len(jobs)
+    for indices in (first_indices, other_indices):
+        wave = run_queries([(jobs[index],) for index in indices], query_job, concurrency, handle_result,
+                           return_exceptions)
+        for index, result in zip(indices, wave):
+            results[index] = result
+    return results
+
+
+def tokens_per_second(tokens, latency, time_to_first_token=None):
+    # generation speed, measured from the first token when the answer was streamed
+    if not tokens or latency is None:
+        return None
+    generation_time = latency - (time_to_first_token or 0)
+    return round(tokens / generation_time, 2) if generation_time > 0 else None
+
+
+def job_record(backend, condition, cot, job, result):
+    # the checkpoint log entry for one answered job
+    tokens = output_tokens(result.usage)
+    return {
+        "model": backend.model,
+        "condition": condition,
+        "cot": cot,
+        "q_number": job.q_number,
+        "run": job.run,
+        "prompt": job.prompt,
+        "presentation_order": job.presentation_order,
+        "permutation": job.permutation,
+        "seed": job.seed,
+        "response": result.text,
+        "retries": result.retries,
+        "cached": result.cached,
+        "usage": result.usage,
+        "cache_read_tokens": cache_read_tokens(result.usage),
+        "streamed": result.time_to_first_token is not None,
+        "time_to_first_token": round(result.time_to_first_token, 4) if result.time_to_first_token is not None else None,
+        "latency": round(result.latency, 4) if result.latency is not None else None,
+        "output_tokens": tokens,
+        "output_tokens_per_second": tokens_per_second(tokens, result.latency, result.time_to_first_token),
+    }
+
+
+def query_with_checkpoint(backend, condition, cot, jobs, log_path, concurrency=8, limiter=None, cache=None,
+                          telemetry=None):
+    """
+    Query only the jobs that have no answer in the checkpoint log yet, appending each new answer
+    to the log, and its usage to the telemetry log if given, as it arrives.
+    Returns the job records for all jobs in job order.
+    """
+    records = load_records(log_path)
+    keys = [cell_key(backend.model, condition, cot, job.q_number, job.run) for job in jobs]
+    missing_jobs = [job for job, key in zip(jobs, keys) if key not in records]
+    print(f"{len(jobs) - len(missing_jobs)} of {len(jobs)} answers found in {log_path}, "
+          f"querying the remaining {len(missing_jobs)}")
+
+    with CheckpointLog(log_path) as log:
+        def store_result(job, result):
+            record = job_record(backend, condition, cot, job, result)
+            records[cell_key(backend.model, condition, cot, job.q_number, job.run)] = record
+            log.append(record)
+            if telemetry is not None:
+                telemetry.append(generation_record(backend, record, len(job.images or [])))
+
+        query_jobs(backend, missing_jobs, concurrency, limiter, store_result, cache)
+
+    return [records[key] for key in keys]
+
+
+def group_responses(model, jobs, responses):
+    # group the responses into one row per question, keeping the q_number order of the jobs
+    data_list = [["model", "q_number", "responses"]]    # column headers for the resulting CSV file
+    question_rows = {}
+    for job, response in zip(jobs, responses):
+        question_rows.setdefault(job.q_number, [model, job.q_number]).append(response)
+    data_list.extend(question_rows.values())
+    return data_list
+
+
+def write_raw_data(data_list, model_name, condition, data_folder='../data'):
+    os.makedirs(data_folder, exist_ok=True)     # ensure the data folder exists
+
+    # store output in csv in the data folder
+    filename = os.path.join(data_folder, f"{model_name}_{condition}_raw_data.csv")
+    with open(filename, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerows(data_list)
+
+    print(f"Data has been written to {filename}")
+    return filename
+
+
+def write_metrics(records, model_name, condition, data_folder='../data'):
+    # per-call timing sidecar, one row per job, next to the raw data CSV
+    os.makedirs(data_folder, exist_ok=True)
+    filename = os.path.join(data_folder, f"{model_name}_{condition}_metrics.csv")
+    with open(filename, 'w', newline='') as file:
+        # records logged before the metrics were added lack the timing columns, those stay empty
+        writer = csv.DictWriter(file, fieldnames=metrics_columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(records)
+
+    timed = [record["latency"] for record in records if record.get("latency") is not None]
+    if timed:
+        print(f"Metrics have been written to {filename}, mean latency {sum(timed) / len(timed):.2f} s")
+    return filename
+
+
+def write_outputs(backend, condition, jobs, records, model_name, data_folder='../data', parquet=False):
+    # write the raw data CSV, the metrics sidecar, and optionally the Parquet file from the job records
+    data_list = group_responses(backend.model, jobs, [record["response"] for record in records])
+
+    # view final model output
+    for element in data_list:
+        print(element)
+
+    write_raw_data(data_list, model_name, condition, data_folder)
+    write_metrics(records, model_name, condition, data_folder)
+    if parquet:
+        write_raw_parquet(records, model_name, condition, data_folder)
+    return data_list
+
+
+def run_condition(backend, condition, model_runs=10, cot=False, concurrency=8, model_name=None,
+                  data_folder='../data', limiter=None, checkpoint=True, cache=None, preprocess=None,
+                  telemetry=True, parquet=False, master_seed=None):
+    """
+    Collect model_runs answers per question from a backend in one condition and store them.
+
+    Parameters:
+    -----------
+    backend : object
+        Any backend from backends.py
+    condition : str
+        Experimental condition, 'standard', 'distractor', or 'image'
+    model_runs : int
+        Number of answers to be collected per question
+    cot : bool
+        Whether to add the Chain-of-Thought instruction to the prompt
+    concurrency : int
+        Maximum number of queries in flight at once
+    model_name : str, optional
+        Name used in the output filename, defaults to the model with a '_cot' suffix if cot is True
+    data_folder : str
+        Path to the data folder
+    limiter : RateLimiter, optional
+        Requests and tokens per minute budget, defaults to the provider defaults in rate_limit.py
+    checkpoint : bool
+        Whether to log every answer as it arrives and resume from that log when the run is restarted.
+        The log is stored next to the raw data as {model_name}_{condition}_log.jsonl
+    cache : ResponseCache or bool, optional
+        Response cache for identical queries, off by default, True uses the cache in the data folder
+    preprocess : PreprocessSettings, optional
+        Downscale and re-encode the images of the image condition before sending them, see image_preprocess.py
+    telemetry : bool
+        Whether to append the usage of every call to {data_folder}/telemetry/usage.jsonl, see telemetry.py
+    parquet : bool
+        Whether to also store the raw data in long format as {model_name}_{condition}_raw_data.parquet,
+        see long_format.py (requires pyarrow)
+    master_seed : int, optional
+        Derive every cell's option order from this seed, so the prompts are the same in every run of the
+        script. Defaults to the sequential shuffle of the original scripts
+
+    Returns:
+    --------
+    list of lists
+        The raw data rows, including the header row
+    """
+    if model_name is None:
+        model_name = f"{backend.model}_cot" if cot else backend.model
+
+    cache = open_cache(cache, data_folder)
+
+    preprocessor = None
+    if preprocess is not None:
+        preprocessor = ImagePreprocessor(preprocess)
+        backend.image_media_type = preprocess.media_type    # all preprocessed images share one format
+
+    jobs = build_jobs(condition, model_runs, cot, preprocessor=preprocessor, master_seed=master_seed)
+    telemetry_log = TelemetryLog(os.path.join(data_folder, "telemetry", "usage.jsonl")) if telemetry else None
+    with telemetry_log or contextlib.nullcontext():
+        if checkpoint:
+            log_path = os.path.join(data_folder, f"{model_name}_{condition}_log.jsonl")
+            records = query_with_checkpoint(backend, condition, cot, jobs, log_path, concurrency, limiter, cache,
+                                            telemetry_log)
+        else:
+            results = query_jobs(backend, jobs, concurrency, limiter, cache=cache)
+            records = [job_record(backend, condition, cot, job, result) for job, result in zip(jobs, results)]
+            if telemetry_log is not None:
+                for job, record in zip(jobs, records):
+                    telemetry_log.append(generation_record(backend, record, len(job.images or [])))
+
+    if cache is not None:
+        print(f"Response cache: {cache.hits} hits, {cache.misses} misses")
+    return write_outputs(backend, condition, jobs, records, model_name, data_folder, parquet)
+
+
+if __name__ == "__main__":
+    from backends import make_backend
+
+    backend_name = "fake"   # "openai", "anthropic", "requests", or "fake"
+    model = "fake-model"
+    condition = conditions[0]
+    temperature = 0
+    model_runs = 10     # number of answers to be collected per question
+    concurrency = 8     # maximum number of queries in flight at once
+    cot = False         # activate or deactivate the Chain-of-Thought prompt
+    stream = False      # stream the answers, which also records the time to first token
+    master_seed = None  # set to an int to derive every cell's option order from it
+
+    run_condition(make_backend(backend_name, model, temperature, stream=stream), condition, model_runs, cot,
+                  concurrency, master_seed=master_seed)
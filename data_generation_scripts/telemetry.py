@@ -0,0 +1,170 @@
+"""
+Usage and cost telemetry for generation and verification calls.
+
+Every call appends one usage record to a local JSON lines store (data/telemetry/usage.jsonl,
+plus one usage_{worker}.jsonl file per work queue worker, see work_queue.py):
+the kind of call (generation or verification), model, condition, cot, q_number, run, input,
+output and prompt-cached tokens, number of images, latency, time to first token, and retries.
+Answers served from the response cache are recorded too, flagged with response_cached, so
+they can be left out when sizing real API traffic.
+
+Run this script to print a summary per kind, model, condition, and cot: the number of calls,
+p50/p95/p99 latency and tokens, total tokens, and an estimated cost. The summary is what the
+concurrency and budget of larger sweeps can be sized from.
+"""
+
+import glob
+import json
+import os
+from datetime import datetime, timezone
+
+import pandas as pd
+
+from backends import cache_read_tokens, input_tokens, output_tokens
+from checkpoint import CheckpointLog
+
+
+script_folder = os.path.dirname(os.path.abspath(__file__))
+telemetry_path = os.path.join(script_folder, "..", "data", "telemetry", "usage.jsonl")
+
+# list prices in USD per million (input, output) tokens, used for the cost estimate.
+# check the providers' pricing pages, models that are not listed get no cost estimate
+prices = {
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "gpt-4o": (5.00, 15.00),
+    "gpt-4o-2024-08-06": (2.50, 10.00),
+    "claude-3-sonnet-20240229": (3.00, 15.00),
+    "claude-3-5-sonnet-20240620": (3.00, 15.00),
+}
+
+# fraction of the input price billed for input tokens read from the provider's prompt cache
+cached_input_discount = {"anthropic": 0.1, "openai": 0.5}
+
+percentiles = [0.5, 0.95, 0.99]
+
+
+def usage_record(kind, provider, model, condition, cot, q_number, run, usage, image_count=0, latency=None,
+                 time_to_first_token=None, retries=0, response_cached=False):
+    # one telemetry record, usage is the provider's usage dict of the call
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "kind": kind,
+        "provider": provider,
+        "model": model,
+        "condition": condition,
+        "cot": bool(cot),
+        "q_number": q_number,
+        "run": run,
+        "input_tokens": input_tokens(usage),
+        "output_tokens": output_tokens(usage),
+        "cached_tokens": cache_read_tokens(usage),
+        "image_count": image_count,
+        "latency": latency,
+        "time_to_first_token": time_to_first_token,
+        "retries": retries,
+        "response_cached": response_cached,
+    }
+
+
+def generation_record(backend, job_record, image_count=0):
+    # telemetry record of a generation call, from the runner's job record
+    return usage_record("generation", backend.provider, job_record["model"], job_record["condition"],
+                        job_record["cot"], job_record["q_number"], job_record["run"], job_record["usage"],
+                        image_count, job_record.get("latency"), job_record.get("time_to_first_token"),
+                        job_record.get("retries", 0), job_record.get("cached", False))
+
+
+class TelemetryLog(CheckpointLog):
+    """Append-only store of usage records, use as a context manager."""
+
+    def __init__(self, log_path=telemetry_path, sync_every=50, sync_interval=5.0):
+        super().__init__(log_path, sync_every, sync_interval)
+
+
+def load_usage(log_path=telemetry_path):
+    # all usage records of the store and its worker files as a DataFrame, skipping torn final lines
+    records = []
+    folder, filename = os.path.split(log_path)
+    stem, extension = os.path.splitext(filename)
+    paths = [log_path] + sorted(glob.glob(os.path.join(folder, f"{stem}_*{extension}")))
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return pd.DataFrame(records)
+
+
+def estimated_cost(usage):
+    # estimated USD cost per record, NaN for models without a listed price
+    input_price = usage["model"].map(lambda model: prices.get(model, (float("nan"),) * 2)[0])
+    output_price = usage["model"].map(lambda model: prices.get(model, (float("nan"),) * 2)[1])
+    discount = usage["provider"].map(cached_input_discount).fillna(1.0)
+
+    cached = usage["cached_tokens"].fillna(0)
+    billed_input = usage["input_tokens"].fillna(0) - cached + cached * discount
+    cost = (billed_input * input_price + usage["output_tokens"].fillna(0) * output_price) / 1e6
+    return cost.where(~usage["response_cached"], 0.0)     # answers from the response cache cost nothing
+
+
+def summarize(usage, include_response_cached=False):
+    """
+    Summarize the usage records per kind, model, condition, and cot.
+
+    Parameters:
+    -----------
+    usage : pd.DataFrame
+        Usage records, as returned by load_usage()
+    include_response_cached : bool
+        Whether to include answers served from the response cache, which have no latency of their own
+
+    Returns:
+    --------
+    pd.DataFrame
+        One row per group with the number of calls, latency and token percentiles, totals, and estimated cost
+    """
+    if usage.empty:
+        return pd.DataFrame()
+    if not include_response_cached:
+        usage = usage[~usage["response_cached"]]
+
+    usage = usage.assign(cost=estimated_cost(usage))
+    groups = usage.groupby(["kind", "model", "condition", "cot"], dropna=False)
+
+    summary = groups.agg(calls=("model", "size"), retries=("retries", "sum"),
+                         input_tokens=("input_tokens", "sum"), output_tokens=("output_tokens", "sum"),
+                         cached_tokens=("cached_tokens", "sum"), images=("image_count", "sum"),
+                         cost=("cost", lambda cost: cost.sum(min_count=1)))
+    for column in ["latency", "time_to_first_token", "input_tokens", "output_tokens"]:
+        quantiles = groups[column].quantile(percentiles).unstack()
+        quantiles.columns = [f"{column}_p{round(q * 100)}" for q in percentiles]
+        summary = summary.join(quantiles)
+    return summary.reset_index()
+
+
+def print_summary(log_path=telemetry_path, include_response_cached=False):
+    usage = load_usage(log_path)
+    if usage.empty:
+        print(f"No usage records found in {log_path}")
+        return
+
+    summary = summarize(usage, include_response_cached)
+    with pd.option_context("display.max_columns", None, "display.width", 200, "display.precision", 3):
+        for column_group in (["calls", "retries", "images", "input_tokens", "output_tokens", "cached_tokens", "cost"],
+                             ["latency_p50", "latency_p95", "latency_p99", "time_to_first_token_p50",
+                              "time_to_first_token_p95", "time_to_first_token_p99"],
+                             ["input_tokens_p50", "input_tokens_p95", "input_tokens_p99",
+                              "output_tokens_p50", "output_tokens_p95", "output_tokens_p99"]):
+            print(summary[["kind", "model", "condition", "cot"] + column_group].to_string(index=False))
+            print()
+    print(f"Estimated total cost: ${summary['cost'].sum():.4f} (models without a listed price are left out)")
+
+
+if __name__ == "__main__":
+    include_response_cached = False     # also count the answers served from the response cache
+
+    print_summary(telemetry_path, include_response_cached)
@@ -0,0 +1,413 @@
+"""
+SQLite work queue for sharding large sweeps across processes and machines.
+
+A sweep (one model, condition, and cot setting) is enqueued as one row per cell
+(q_number, run) in an SQLite database in WAL mode, which lets many workers read and write
+it at once. Any number of workers, in a local process pool or on several machines that share
+the data folder, lease batches of pending cells, query them, and store each answer in the
+database as it arrives. While a worker is querying it renews its leases with a heartbeat,
+and the leases of a worker that crashed or lost its connection expire and are reclaimed by
+the other workers. A cell that failed max_attempts times is marked as failed.
+
+The workers rebuild the prompts of their cells from the sweep's master seed (see build_jobs
+in runner.py), so every cell gets the same prompt whichever worker answers it. Once all cells
+of a sweep are done, the merge step writes the usual {model_name}_{condition}_raw_data.csv
+and metrics sidecar.
+
+Workers read the API keys from the environment (OPENAI_API_KEY, ANTHROPIC_API_KEY). SQLite
+locking needs a filesystem with working file locks, which most network filesystems provide
+but some (older NFS setups) do not.
+"""
+
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from backends import make_backend
+from image_store import load_image_store
+from long_format import write_raw_parquet
+from rate_limit import RateLimiter, default_limits
+from response_cache import open_cache
+from runner import PromptJob, build_jobs, group_responses, job_record, query_jobs, write_metrics, write_raw_data
+from telemetry import TelemetryLog, generation_record
+from test_list_dict import test_list
+
+
+schema = """
+CREATE TABLE IF NOT EXISTS sweeps (
+    id INTEGER PRIMARY KEY,
+    model_name TEXT NOT NULL,
+    condition TEXT NOT NULL,
+    backend_name TEXT NOT NULL,
+    model TEXT NOT NULL,
+    temperature REAL NOT NULL,
+    cot INTEGER NOT NULL,
+    model_runs INTEGER NOT NULL,
+    master_seed INTEGER NOT NULL,
+    UNIQUE (model_name, condition)
+);
+CREATE TABLE IF NOT EXISTS cells (
+    id INTEGER PRIMARY KEY,
+    sweep_id INTEGER NOT NULL REFERENCES sweeps (id),
+    position INTEGER NOT NULL,              -- order of the cell in the raw data, q_number first, then run
+    q_number TEXT NOT NULL,
+    run INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending', -- pending, leased, done, or failed
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    record TEXT,                            -- job record of the answer, as in the checkpoint log
+    UNIQUE (sweep_id, q_number, run)
+);
+CREATE INDEX IF NOT EXISTS cells_status ON cells (status, lease_expires);
+"""
+
+
+def worker_name():
+    # identifies a worker across machines
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """Connection to a work queue database, one per process or thread."""
+
+    def __init__(self, db_path='../data/work_queue.sqlite', lease_seconds=300, max_attempts=3):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        # transactions are managed explicitly, a write transaction is started with BEGIN IMMEDIATE
+        self.connection = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(schema)
+
+    def close(self):
+        self.connection.close()
+
+    def write(self, statements):
+        # run (sql, parameters) statements in one write transaction
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            cursors = [self.connection.execute(sql, parameters) for sql, parameters in statements]
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return cursors
+
+    def enqueue(self, backend_name, model, condition, model_runs=10, cot=False, master_seed=0, temperature=0,
+                model_name=None, tasks_list=test_list):
+        """
+        Add a sweep and all of its cells to the queue. Enqueueing a sweep again adds only the missing cells, and raises
+        ValueError if its settings, model_runs included, differ from the queued sweep.
+
+        Returns:
+        --------
+        int
+            The sweep id
+        """
+        if model_name is None:
+            model_name = f"{model}_cot" if cot else model
+        self.write([("INSERT OR IGNORE INTO sweeps (model_name, condition, backend_name, model, temperature, cot, "
+                     "model_runs, master_seed) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     (model_name, condition, backend_name, model, temperature, int(cot), model_runs, master_seed))])
+        sweep = self.sweep(model_name, condition)
+        # workers build the jobs from the stored model_runs, a different one would leave cells without jobs
+        if (sweep["backend_name"], sweep["model"], sweep["temperature"], bool(sweep["cot"]), sweep["master_seed"],
+                sweep["model_runs"]) != (backend_name, model, temperature, bool(cot), master_seed, model_runs):
+            raise ValueError(f"A different sweep for {model_name} {condition} is already in {self.db_path}")
+
+        if condition == "image":
+            load_image_store()      # build the image store once here, rather than in every worker at the same time
+
+        cells = [(tasks["q_number"], run) for tasks in tasks_list for run in range(model_runs)]
+        self.write([("INSERT OR IGNORE INTO cells (sweep_id, position, q_number, run) VALUES (?, ?, ?, ?)",
+                     (sweep["id"], position, q_number, run)) for position, (q_number, run) in enumerate(cells)])
+        print(f"Sweep {model_name} {condition} with {len(cells)} cells is in the queue {self.db_path}")
+        return sweep["id"]
+
+    def sweep(self, model_name, condition):
+        return self.connection.execute("SELECT * FROM sweeps WHERE model_name = ? AND condition = ?",
+                                       (model_name, condition)).fetchone()
+
+    def sweeps(self):
+        return self.connection.execute("SELECT * FROM sweeps ORDER BY id").fetchall()
+
+    def reclaim_sql(self, now):
+        # leases that have expired go back to the queue, or are failed after max_attempts
+        return ("UPDATE cells SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL "
+                "WHERE status = 'leased' AND lease_expires < ?", (self.max_attempts, now))
+
+    def lease(self, worker, batch_size=32):
+        """
+        Lease up to batch_size pending cells of one sweep for this worker.
+
+        Returns:
+        --------
+        tuple(sqlite3.Row, list of sqlite3.Row) or None
+            The sweep and its leased cells, or None if no cell is pending
+        """
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.execute(*self.reclaim_sql(now))
+            first = self.connection.execute("SELECT sweep_id FROM cells WHERE status = 'pending' "
+                                            "ORDER BY sweep_id, position LIMIT 1").fetchone()
+            if first is None:
+                self.connection.execute("COMMIT")
+                return None
+            cells = self.connection.execute("SELECT * FROM cells WHERE status = 'pending' AND sweep_id = ? "
+                                            "ORDER BY position LIMIT ?", (first["sweep_id"], batch_size)).fetchall()
+            self.connection.executemany("UPDATE cells SET status = 'leased', worker = ?, lease_expires = ?, "
+                                        "attempts = attempts + 1 WHERE id = ?",
+                                        [(worker, now + self.lease_seconds, cell["id"]) for cell in cells])
+            sweep = self.connection.execute("SELECT * FROM sweeps WHERE id = ?", (first["sweep_id"],)).fetchone()
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return sweep, cells
+
+    def heartbeat(self, worker):
+        # extend the leases of all cells this worker is still working on
+        self.write([("UPDATE cells SET lease_expires = ? WHERE status = 'leased' AND worker = ?",
+                     (time.time() + self.lease_seconds, worker))])
+
+    def complete(self, cell_id, record):
+        # store an answer, a cell whose lease expired meanwhile is still accepted if nobody answered it yet
+        self.write([("UPDATE cells SET status = 'done', worker = NULL, record = ? WHERE id = ? AND status != 'done'",
+                     (json.dumps(record, ensure_ascii=False), cell_id))])
+
+    def release(self, worker):
+        # give the unanswered cells of this worker back to the queue, e.g. after an error
+        self.write([("UPDATE cells SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                     "worker = NULL WHERE status = 'leased' AND worker = ?", (self.max_attempts, worker))])
+
+    def retry_failed(self):
+        # put the failed cells back in the queue with a fresh number of attempts
+        self.write([("UPDATE cells SET status = 'pending', attempts = 0 WHERE status = 'failed'", ())])
+
+    def progress(self):
+        # {(model_name, condition): {status: number of cells}}
+        rows = self.connection.execute("SELECT sweeps.model_name, sweeps.condition, cells.status, COUNT(*) "
+                                       "FROM cells JOIN sweeps ON sweeps.id = cells.sweep_id "
+                                       "GROUP BY sweeps.id, cells.status ORDER BY sweeps.id").fetchall()
+        progress = {}
+        for model_name, condition, status, count in rows:
+            progress.setdefault((model_name, condition), {})[status] = count
+        return progress
+
+    def unfinished(self):
+        # number of cells that are pending or leased
+        return self.connection.execute("SELECT COUNT(*) FROM cells WHERE status IN ('pending', 'leased')").fetchone()[0]
+
+    def records(self, sweep_id):
+        # job records of the sweep's answered cells, in raw data order
+        rows = self.connection.execute("SELECT record FROM cells WHERE sweep_id = ? AND status = 'done' "
+                                       "ORDER BY position", (sweep_id,)).fetchall()
+        return [json.loads(row["record"]) for row in rows]
+
+
+class Heartbeat:
+    """Background thread that renews a worker's leases, use as a context manager."""
+
+    def __init__(self, db_path, worker, lease_seconds):
+        self.db_path = db_path
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        queue = WorkQueue(self.db_path, self.lease_seconds)     # a sqlite connection stays in its own thread
+        while not self.stopped.wait(self.lease_seconds / 3):
+            queue.heartbeat(self.worker)
+        queue.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_worker(db_path='../data/work_queue.sqlite', data_folder='../data', batch_size=32, concurrency=8,
+               rate_share=1.0, lease_seconds=300, max_attempts=3, poll_interval=10, worker=None, cache=False):
+    """
+    Lease and answer cells until the queue is empty.
+
+    Parameters:
+    -----------
+    db_path : str
+        Path to the work queue database
+    data_folder : str
+        Path to the data folder, holding the response cache and telemetry
+    batch_size : int
+        Number of cells leased at once
+    concurrency : int
+        Maximum number of queries in flight at once in this worker
+    rate_share : float
+        Fraction of the provider's rate limits this worker may use, e.g. 0.25 for one of four workers
+    lease_seconds : float
+        How long a lease lasts without a heartbeat
+    max_attempts : int
+        Number of leases after which a cell is marked as failed
+    poll_interval : float
+        Seconds to wait for the leases of other workers to finish or expire, when no cell is pending
+    worker : str, optional
+        Name of the worker, defaults to hostname-pid
+    cache : bool
+        Whether to answer identical deterministic queries from the response cache in the data folder
+
+    Returns:
+    --------
+    int
+        Number of cells this worker answered
+    """
+    worker = worker or worker_name()
+    queue = WorkQueue(db_path, lease_seconds, max_attempts)
+    cache = open_cache(cache, data_folder)
+    backends = {}
+    limiters = {}
+    answered = 0
+
+    # each worker writes its own telemetry file, so the workers never interleave their lines
+    telemetry_path = os.path.join(data_folder, "telemetry", f"usage_{worker}.jsonl")
+    with TelemetryLog(telemetry_path) as telemetry:
+        while True:
+            leased = queue.lease(worker, batch_size)
+            if leased is None:
+                if queue.unfinished() == 0:
+                    break
+                time.sleep(poll_interval)   # other workers still hold leases, which may expire
+                continue
+
+            sweep, cells = leased
+            key = (sweep["backend_name"], sweep["model"], sweep["temperature"])
+            if key not in backends:
+                backends[key] = make_backend(sweep["backend_name"], sweep["model"], sweep["temperature"])
+                rpm, tpm = default_limits.get(backends[key].provider, (None, None))
+                limiters[key] = RateLimiter(rpm and rpm * rate_share, tpm and tpm * rate_share)
+            backend = backends[key]
+
+            cell_ids = {(cell["q_number"], cell["run"]): cell["id"] for cell in cells}
+
+            def store_result(job, result):
+                record = job_record(backend, sweep["condition"], bool(sweep["cot"]), job, result)
+                queue.complete(cell_ids[(job.q_number, job.run)], record)
+                telemetry.append(generation_record(backend, record, len(job.images or [])))
+
+            with Heartbeat(db_path, worker, lease_seconds):
+                try:
+                    jobs = build_jobs(sweep["condition"], sweep["model_runs"], bool(sweep["cot"]),
+                                      master_seed=sweep["master_seed"], cells=set(cell_ids))
+                    # a failed cell does not stop the others, only the failed cells stay unanswered
+                    results = query_jobs(backend, jobs, concurrency, limiters[key], store_result, cache,
+                                         return_exceptions=True)
+                    errors = [result for result in results if isinstance(result, BaseException)]
+                    answered += len(jobs) - len(errors)
+                    if errors:
+                        print(f"Worker {worker}: {len(errors)} of {len(jobs)} cells failed, e.g. {errors[0]!r}, "
+                              f"returning them to the queue")
+                except Exception as error:
+                    print(f"Worker {worker}: {error!r}, returning the unanswered cells to the queue")
+                finally:
+                    queue.release(worker)   # the cells that are still leased, each charged the attempt of its lease
+
+    queue.close()
+    print(f"Worker {worker} has answered {answered} cells")
+    if cache is not None:
+        print(f"Response cache: {cache.hits} hits, {cache.misses} misses")
+    return answered
+
+
+def run_pool(processes=4, db_path='../data/work_queue.sqlite', data_folder='../data', **worker_options):
+    # run a worker in each of several processes on this machine, sharing the rate limits between them
+    queue = WorkQueue(db_path)
+    if any(sweep["condition"] == "image" for sweep in queue.sweeps()):
+        load_image_store()      # build the image store once before the workers load it
+    queue.close()
+
+    workers = [multiprocessing.Process(target=run_worker, args=(db_path, data_folder),
+                                       kwargs={"rate_share": 1 / processes, **worker_options})
+               for _ in range(processes)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+
+def merge(db_path='../data/work_queue.sqlite', data_folder='../data', parquet=False):
+    """
+    Write the raw data CSV and metrics sidecar of every sweep whose cells are all answered.
+
+    Returns:
+    --------
+    list of str
+        The raw data CSV paths that were written
+    """
+    queue = WorkQueue(db_path)
+    progress = queue.progress()
+    written = []
+    for sweep in queue.sweeps():
+        counts = progress.get((sweep["model_name"], sweep["condition"]), {})
+        if set(counts) != {"done"}:
+            print(f"Sweep {sweep['model_name']} {sweep['condition']} is not finished yet: {counts}")
+            continue
+
+        records = queue.records(sweep["id"])
+        jobs = [PromptJob(record["q_number"], record["run"], record["prompt"], record["presentation_order"])
+                for record in records]
+        data_list = group_responses(sweep["model"], jobs, [record["response"] for record in records])
+        written.append(write_raw_data(data_list, sweep["model_name"], sweep["condition"], data_folder))
+        write_metrics(records, sweep["model_name"], sweep["condition"], data_folder)
+        if parquet:
+            write_raw_parquet(records, sweep["model_name"], sweep["condition"], data_folder)
+    queue.close()
+    return written
+
+
+def print_progress(db_path='../data/work_queue.sqlite'):
+    queue = WorkQueue(db_path)
+    for (model_name, condition), counts in queue.progress().items():
+        summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+        print(f"{model_name} {condition}: {summary}")
+    queue.close()
+
+
+if __name__ == "__main__":
+    action = "enqueue"      # "enqueue", "work" (one worker), "pool" (a worker per process), "progress", or "merge"
+    db_path = '../data/work_queue.sqlite'   # put it on a shared filesystem to run workers on several machines
+
+    # sweep to enqueue
+    backend_name = "fake"   # "openai", "anthropic", "requests", or "fake"
+    model = "fake-model"
+    condition = "standard"
+    temperature = 0
+    model_runs = 10     # number of answers to be collected per question
+    cot = False         # activate or deactivate the Chain-of-Thought prompt
+    master_seed = 0     # the option orders of all cells are derived from it
+
+    # workers
+    processes = 4       # number of worker processes for the "pool" action
+    concurrency = 8     # maximum number of queries in flight per worker
+
+    if action == "enqueue":
+        WorkQueue(db_path).enqueue(backend_name, model, condition, model_runs, cot, master_seed, temperature)
+    elif action == "work":
+        run_worker(db_path, concurrency=concurrency)
+    elif action == "pool":
+        run_pool(processes, db_path, concurrency=concurrency)
+    elif action == "progress":
+        print_progress(db_path)
+    elif action == "merge":
+        merge(db_path)
@@ -0,0 +1,255 @@
+"""
+Vectorized bootstrap confidence intervals for the binary (0/1) data.
+
+All resamples are drawn at once as NumPy arrays of shape (n_resamples, number of statistics),
+so 10,000 or more resamples for the runs and questions of hundreds of files take one array
+operation instead of a Python loop. Because the data is binary, resampling the n answers of a
+run (or question) with replacement gives exactly a Binomial(n, p) number of correct answers,
+where p is the run's (question's) share of correct answers, so the proportions are resampled
+with one rng.binomial call.
+
+The total average of a model and condition can be resampled in three ways:
+- 'questions': resample the questions, keeping each question's average
+- 'runs': resample the runs, keeping each run's average
+- 'hierarchical': resample the questions, and then the answers within each resampled question
+
+Both percentile intervals and bias-corrected and accelerated (BCa) intervals are computed.
+The BCa acceleration comes from the jackknife of the mean, which has a closed form for the
+binary data.
+
+Runs and questions with the same number of correct answers out of the same number of answers
+have the same bootstrap distribution, so each distinct (correct, answers) pair is resampled
+once, and the totals of all files with the same number of questions (runs) are resampled
+together.
+"""
+
+from statistics import NormalDist
+
+import numpy as np
+
+
+bootstrap_schemes = ["questions", "runs", "hierarchical"]
+
+# maximum number of resampled values held in memory at once when resampling totals, the files are
+# resampled in chunks that stay below it
+max_resampled_values = 5_000_000
+
+normal = NormalDist()
+normal_cdf = np.vectorize(normal.cdf, otypes=[float])
+normal_quantile = np.vectorize(normal.inv_cdf, otypes=[float])
+
+
+def resample_proportions(successes, trials, n_resamples=10000, rng=None):
+    """
+    Bootstrap the share of correct answers of many runs or questions at once.
+
+    Parameters:
+    -----------
+    successes : array of int
+        Number of correct answers of each run or question
+    trials : array of int
+        Number of answers of each run or question
+    n_resamples : int
+        Number of bootstrap resamples
+    rng : np.random.Generator, optional
+        Random generator, defaults to np.random.default_rng()
+
+    Returns:
+    --------
+    np.ndarray
+        Resampled proportions, shape (n_resamples, number of runs or questions)
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    trials = np.asarray(trials, dtype=np.int64)
+    proportions = np.asarray(successes) / trials
+    return rng.binomial(trials, proportions, size=(n_resamples, len(trials))) / trials
+
+
+def resample_totals(successes, trials, n_resamples=10000, rng=None, within=False):
+    """
+    Bootstrap the total averages of many files at once from per-unit counts, by resampling the units
+    (questions or runs) of each file. With within=True the answers within each resampled unit are
+    resampled as well (hierarchical).
+
+    Parameters:
+    -----------
+    successes : 2D array of int
+        Number of correct answers per file (rows) and unit (columns)
+    trials : 2D array of int
+        Number of answers per file and unit
+    n_resamples : int
+        Number of bootstrap resamples
+    rng : np.random.Generator, optional
+        Random generator, defaults to np.random.default_rng()
+    within : bool
+        Whether to resample the answers within the resampled units as well
+
+    Returns:
+    --------
+    np.ndarray
+        Resampled total averages, shape (n_resamples, number of files)
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    trials = np.asarray(trials, dtype=np.int64)
+    proportions = np.asarray(successes) / trials
+    n_files, n_units = trials.shape
+    units = rng.integers(0, n_units, size=(n_resamples, n_files, n_units))
+    files = np.arange(n_files)[None, :, None]
+    resampled = proportions[files, units]
+    if within:
+        # units whose answers are all correct or all incorrect stay the same, only the others are drawn
+        mixed = (resampled > 0) & (resampled < 1)
+        unit_trials = trials[files, units][mixed]
+        resampled[mixed] = rng.binomial(unit_trials, resampled[mixed]) / unit_trials
+    return resampled.mean(axis=2)
+
+
+def binary_acceleration(successes, trials):
+    # BCa acceleration of the mean of k correct answers out of n, from its jackknife in closed form
+    successes = np.asarray(successes, dtype=float)
+    trials = np.asarray(trials, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        proportion = successes / trials
+        # leaving out a correct answer lowers the mean to (k - 1) / (n - 1), leaving out an incorrect one
+        # raises it to k / (n - 1), and the jackknife values average to the mean itself
+        difference_correct = proportion - (successes - 1) / (trials - 1)
+        difference_incorrect = proportion - successes / (trials - 1)
+        cubes = successes * difference_correct ** 3 + (trials - successes) * difference_incorrect ** 3
+        squares = successes * difference_correct ** 2 + (trials - successes) * difference_incorrect ** 2
+        acceleration = cubes / (6 * squares ** 1.5)
+    return np.nan_to_num(acceleration)     # 0 when all answers are equal
+
+
+def mean_acceleration(values):
+    # BCa acceleration of the mean of unit averages per row (e.g. the question averages of a file), from its jackknife
+    values = np.asarray(values, dtype=float)
+    n_units = values.shape[1]
+    jackknife = (values.sum(axis=1, keepdims=True) - values) / (n_units - 1)
+    differences = jackknife.mean(axis=1, keepdims=True) - jackknife
+    with np.errstate(divide="ignore", invalid="ignore"):
+        acceleration = (differences ** 3).sum(axis=1) / (6 * (differences ** 2).sum(axis=1) ** 1.5)
+    return np.nan_to_num(acceleration)     # 0 when all units are equal
+
+
+def column_quantiles(ordered, levels):
+    # quantile levels[j] of column j of the sorted resamples, linearly interpolated like np.quantile
+    positions = np.clip(levels, 0, 1) * (len(ordered) - 1)
+    lower = np.floor(positions).astype(int)
+    upper = np.minimum(lower + 1, len(ordered) - 1)
+    columns = np.arange(ordered.shape[1])
+    return ordered[lower, columns] + (positions - lower) * (ordered[upper, columns] - ordered[lower, columns])
+
+
+def intervals(resamples, estimates, accelerations, confidence=0.95):
+    """
+    Percentile and bias-corrected and accelerated (BCa) bootstrap intervals per column of the resamples.
+
+    Parameters:
+    -----------
+    resamples : np.ndarray
+        Bootstrap resamples, shape (n_resamples, number of statistics)
+    estimates : array of float
+        The statistics on the original data
+    accelerations : array of float
+        BCa acceleration of every statistic
+    confidence : float
+        Confidence level of the intervals
+
+    Returns:
+    --------
+    dict
+        ci_low, ci_high (percentile) and bca_low, bca_high arrays, one value per statistic
+    """
+    ordered = np.sort(np.asarray(resamples, dtype=float), axis=0)
+    n_resamples, n_statistics = ordered.shape
+    estimates = np.asarray(estimates, dtype=float)
+    accelerations = np.asarray(accelerations, dtype=float)
+    alpha = 1 - confidence
+
+    # bias correction: the share of resamples below the estimate, counting ties as half
+    below = (ordered < estimates).sum(axis=0) + 0.5 * (ordered == estimates).sum(axis=0)
+    share_below = np.clip(below / n_resamples, 1 / (2 * n_resamples), 1 - 1 / (2 * n_resamples))
+    bias = normal_quantile(share_below)
+
+    bounds = {}
+    for side, level in [("low", alpha / 2), ("high", 1 - alpha / 2)]:
+        bounds[f"ci_{side}"] = column_quantiles(ordered, np.full(n_statistics, level))
+        z = bias + normal.inv_cdf(level)
+        bounds[f"bca_{side}"] = column_quantiles(ordered, normal_cdf(bias + z / (1 - accelerations * z)))
+    return {key: bounds[key] for key in ["ci_low", "ci_high", "bca_low", "bca_high"]}
+
+
+def proportion_intervals(successes, trials, n_resamples=10000, confidence=0.95, rng=None):
+    """
+    Percentile and BCa intervals of the share of correct answers of many runs or questions.
+
+    Parameters:
+    -----------
+    successes : array of int
+        Number of correct answers of each run or question
+    trials : array of int
+        Number of answers of each run or question
+    n_resamples : int
+        Number of bootstrap resamples
+    confidence : float
+        Confidence level of the intervals
+    rng : np.random.Generator, optional
+        Random generator
+
+    Returns:
+    --------
+    dict
+        ci_low, ci_high (percentile) and bca_low, bca_high arrays, one value per run or question
+    """
+    # resample every distinct (successes, trials) pair once
+    pairs, inverse = np.unique(np.column_stack([successes, trials]).astype(np.int64), axis=0, return_inverse=True)
+    unique_successes, unique_trials = pairs[:, 0], pairs[:, 1]
+    resamples = resample_proportions(unique_successes, unique_trials, n_resamples, rng)
+    bounds = intervals(resamples, unique_successes / unique_trials,
+                       binary_acceleration(unique_successes, unique_trials), confidence)
+    return {key: values[inverse.ravel()] for key, values in bounds.items()}
+
+
+def total_intervals(question_successes, question_trials, run_successes, run_trials, scheme="hierarchical",
+                    n_resamples=10000, confidence=0.95, rng=None):
+    """
+    Percentile and BCa intervals of the total averages of files with the same number of questions and runs.
+
+    Parameters:
+    -----------
+    question_successes, question_trials : 2D array of int
+        Number of correct answers and of answers per file (rows) and question (columns)
+    run_successes, run_trials : 2D array of int
+        Number of correct answers and of answers per file (rows) and run (columns)
+    scheme : str
+        'questions', 'runs', or 'hierarchical', see the module docstring
+    n_resamples : int
+        Number of bootstrap resamples
+    confidence : float
+        Confidence level of the intervals
+    rng : np.random.Generator, optional
+        Random generator
+
+    Returns:
+    --------
+    dict
+        ci_low, ci_high (percentile) and bca_low, bca_high arrays, one value per file
+    """
+    if scheme not in bootstrap_schemes:
+        raise ValueError(f"Unknown bootstrap scheme '{scheme}', use one of {bootstrap_schemes}")
+    if scheme == "runs":
+        successes, trials = np.asarray(run_successes), np.asarray(run_trials)
+    else:
+        successes, trials = np.asarray(question_successes), np.asarray(question_trials)
+
+    rng = np.random.default_rng() if rng is None else rng
+    unit_averages = successes / trials
+    chunk_size = max(1, max_resampled_values // (n_resamples * successes.shape[1]))
+    chunks = []
+    for start in range(0, len(successes), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        resamples = resample_totals(successes[chunk], trials[chunk], n_resamples, rng,
+                                    within=scheme == "hierarchical")
+        chunks.append(intervals(resamples, unit_averages[chunk].mean(axis=1),
+                                mean_acceleration(unit_averages[chunk]), confidence))
+    return {key: np.concatenate([chunk[key] for chunk in chunks]) for key in chunks[0]}
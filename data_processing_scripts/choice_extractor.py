@@ -0,0 +1,309 @@
+"""
+Deterministic extraction of the chosen option from a model's answer.
+
+The extractor matches an answer against all nine option names of its question in test_list
+(afforded_tool, associated_tool1-4, irrelevant_tool1-4) and returns the chosen option with a
+confidence score. Before matching, answers and option names are normalized: lowercased,
+punctuation and articles removed, and plurals reduced to the singular. An option matches when
+its normalized name appears in the text, or fuzzily when a window of words is similar enough
+(difflib), or by its head noun alone ("the gloves" for "leather gloves") when no other option
+of the question shares that noun.
+
+The final-answer sentence ("I would use ...", "My answer is ...") decides when there is one,
+so options that are only discussed along the way in a CoT answer do not count. Negated mentions
+are ignored, both after a negation ("not the umbrella", "rather than the rake") and before one
+("the umbrella would not be suitable"), and a negation carries across a list of options up to the
+end of the clause ("not the blender, the map or the scythe"). A negated verb ("I would not use")
+does not mark a final answer. When the deciding final-answer sentence contains a negation or only
+rejects options, the extraction gets a low confidence, so the answer goes to the LLM verifier.
+
+The automated evaluation uses the extractor first and only asks the LLM verifier about the
+answers below its confidence threshold. The extracted choices also give the distribution of
+afforded, associated, and irrelevant choices per model and condition.
+"""
+
+import difflib
+import os
+import re
+import sys
+from dataclasses import dataclass
+
+# the task specifications are shared with the data generation scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_generation_scripts"))
+from test_list_dict import test_list    # noqa: E402
+
+
+option_keys = ["afforded_tool", "associated_tool1", "associated_tool2", "associated_tool3", "associated_tool4",
+               "irrelevant_tool1", "irrelevant_tool2", "irrelevant_tool3", "irrelevant_tool4"]
+
+articles = {"a", "an", "the", "some", "my", "your", "this", "that", "these", "those"}
+negations = {"not", "never", "no", "instead", "rather", "than", "over", "without", "wouldnt", "dont", "cant",
+             "shouldnt", "couldnt", "wont", "isnt", "arent"}
+
+# negations after a mention ("the umbrella is not suitable", "the rake wouldn't work"), in normalized words
+trailing_negations = {"isnt", "arent", "wasnt", "werent", "wouldnt", "wont", "cant", "cannot", "couldnt", "shouldnt",
+                      "doesnt", "dont"}
+adverbs = {"also", "probably", "likely", "certainly", "definitely", "really", "then", "therefore", "however"}
+# words that start a new clause, after which a negation no longer refers to the mention
+clause_words = {"since", "because", "but", "while", "whereas", "although", "unlike", "than", "as", "and", "or", "so"}
+# words that join the options of a list, which a negation carries across ('not the blender, the map or the scythe')
+list_words = {"or", "and", "nor", "either", "neither"}
+# token that normalize puts at the end of a sentence or clause (.;:!? and line breaks) when asked to
+boundary = "|"
+
+# phrases that mark a sentence as the final answer, rather than the discussion of an option
+# a negated verb ('I would not use the map') is not a cue, the sentence rejects rather than chooses
+answer_cue = re.compile(r"(\b(would|will|'d|'ll|i)\s+(probably\s+|likely\s+|then\s+)?"
+                        r"(choose|use|pick|select|go with|opt for|take)\b"
+                        r"|\bmy (final )?(answer|choice|pick|selection)\b|\bbest (option|choice|bet)\b"
+                        r"|\bmost (suitable|appropriate|effective|practical|useful)\b|\bfinal answer\b|\banswer\s*:"
+                        r"|\bchoice\s*:|\bin conclusion\b)")
+
+fuzzy_cutoff = 0.85         # minimum difflib similarity of a fuzzy match
+head_noun_score = 0.8       # score of a match on the head noun alone
+answer_confidence = 0.95    # confidence of a single option named in a final-answer sentence
+mention_confidence = 0.85   # confidence of a single option named anywhere, without a final-answer sentence
+ambiguous_confidence = 0.4  # confidence when several options are named in the deciding text
+
+
+@dataclass
+class Extraction:
+    choice: str         # test_list key of the chosen option, e.g. 'afforded_tool', None if nothing matched
+    option: str         # name of the chosen option
+    confidence: float   # 0 to 1
+    evidence: str       # the sentence or text the choice was taken from
+
+    @property
+    def category(self):
+        # 'afforded', 'associated', 'irrelevant', or None
+        return self.choice.split("_")[0] if self.choice else None
+
+    @property
+    def correct(self):
+        return self.choice == "afforded_tool"
+
+
+def singular(word):
+    # crude singular form, applied to answers and option names alike so they still match
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith(("ses", "xes", "ches", "shes")):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def normalize(text, boundaries=False):
+    # list of lowercase singular words without punctuation and articles, with a boundary token at the
+    # end of each sentence or clause if boundaries is set
+    text = text.lower().replace("'", "")
+    if boundaries:
+        text = re.sub(r"[.;:!?\n]+", f" {boundary} ", text)
+    words = re.findall(r"[a-z0-9]+|" + re.escape(boundary), text)
+    return [singular(word) for word in words if word not in articles]
+
+
+def question_options(q_number, tasks_list=test_list):
+    # {option key: option name} of a question
+    tasks = next(tasks for tasks in tasks_list if tasks["q_number"] == q_number)
+    return {key: tasks[key] for key in option_keys if key in tasks}
+
+
+# verbs that a trailing 'not' negates, in normalized (singular) form
+negatable_verbs = {singular(word) for word in ["is", "are", "was", "were", "would", "will", "could", "should", "can",
+                                               "does", "do", "might", "may", "seems"]}
+
+
+def negated(words, start, end):
+    # whether the words right before a mention, or the verb right after it, negate it
+    for word in reversed(words[max(0, start - 3):start]):
+        if word == boundary:
+            break
+        if word in negations:
+            return True
+    following = words[end:end + 5]
+    for index, word in enumerate(following):
+        if word in clause_words or word == boundary:
+            return False
+        if word in trailing_negations:
+            return True
+        if word in negatable_verbs:
+            # 'would not', 'is probably not'
+            rest = following[index + 1:index + 3]
+            return bool(rest) and (rest[0] in ("not", "never") or
+                                   (rest[0] in adverbs and rest[1:] in (["not"], ["never"])))
+    return False
+
+
+def find_mentions(words, options, rejected=None):
+    """
+    Find the options mentioned in a normalized text.
+
+    Parameters:
+    -----------
+    words : list of str
+        The normalized text
+    options : dict
+        {option key: option name} of the question
+    rejected : set, optional
+        Filled with the keys of the options that are mentioned negated
+
+    Returns:
+    --------
+    dict
+        {option key: (match score, position of the last accepted mention)}, negated mentions left out.
+        A negation carries across a list of options up to the end of the clause, so in 'not the blender,
+        the map or the scythe' all three are negated
+    """
+    option_words = {key: normalize(name) for key, name in options.items()}
+    head_nouns = [name[-1] for name in option_words.values() if name]
+    found = []      # (start, size, key, score) of every match
+
+    def add(key, score, start, size):
+        found.append((start, size, key, score))
+
+    for key, target in option_words.items():
+        size = len(target)
+        if size == 0:
+            continue
+        matcher = difflib.SequenceMatcher(b=" ".join(target))     # caches the option name
+        for start in range(len(words) - size + 1):
+            window = words[start:start + size]
+            if window == target:
+                add(key, 1.0, start, size)
+                continue
+            # fuzzy match on the same number of words, e.g. typos or compounds ('tabletennis racket'),
+            # with the cheap upper bounds ruling out most windows first
+            matcher.set_seq1(" ".join(window))
+            if matcher.real_quick_ratio() >= fuzzy_cutoff and matcher.quick_ratio() >= fuzzy_cutoff:
+                ratio = matcher.ratio()
+                if ratio >= fuzzy_cutoff:
+                    add(key, ratio, start, size)
+
+        # the head noun alone, if no other option of the question ends in the same noun
+        if size > 1 and not any(match[2] == key for match in found) and head_nouns.count(target[-1]) == 1:
+            for start, word in enumerate(words):
+                if word == target[-1]:
+                    add(key, head_noun_score, start, 1)
+
+    mentions = {}
+    negated_end = None      # end of the last negated mention, to carry its negation along a list
+    for start, size, key, score in sorted(found):
+        listed = negated_end is not None and all(word in list_words for word in words[negated_end:start])
+        if listed or negated(words, start, start + size):
+            negated_end = max(negated_end or 0, start + size)
+            if rejected is not None:
+                rejected.add(key)
+        elif score >= mentions.get(key, (0, -1))[0]:
+            mentions[key] = (score, start)
+    return mentions
+
+
+def split_sentences(text):
+    return [sentence for sentence in re.split(r"(?<=[.!?])\s+|\n+", text) if sentence.strip()]
+
+
+def decide(mentions, confidence, evidence, options):
+    # the extraction for a piece of text, given the options mentioned in it
+    if not mentions:
+        return None
+    if len(mentions) == 1:
+        key, (score, _) = next(iter(mentions.items()))
+        return Extraction(key, options[key], round(confidence * score, 3), evidence)
+    # several options: take the one mentioned last, which is most often the conclusion, with low confidence
+    key = max(mentions, key=lambda option_key: mentions[option_key][1])
+    return Extraction(key, options[key], ambiguous_confidence * mentions[key][0], evidence)
+
+
+def extract_choice(response, q_number, tasks_list=test_list):
+    """
+    Extract the option chosen in an answer.
+
+    Parameters:
+    -----------
+    response : str
+        The model's answer
+    q_number : str
+        Question number, e.g. 'Q1'
+    tasks_list : list of dict
+        Task specifications, defaults to test_list
+
+    Returns:
+    --------
+    Extraction
+        The chosen option and the confidence of the extraction, choice is None if no option was found
+    """
+    options = question_options(q_number, tasks_list)
+
+    # the last final-answer sentence that names an option decides. A final-answer sentence that only
+    # rejects options ('I would use anything but the umbrella') leaves the choice uncertain, and so does
+    # one that contains a negation ('I would use the curtains, not the umbrella or the bowl')
+    uncertain = False
+    for sentence in reversed(split_sentences(response)):
+        if answer_cue.search(sentence.lower()):
+            words = normalize(sentence, boundaries=True)
+            rejected = set()
+            extraction = decide(find_mentions(words, options, rejected), answer_confidence, sentence, options)
+            if extraction is not None:
+                uncertain = uncertain or any(word in negations or word in trailing_negations for word in words)
+                break
+            uncertain = uncertain or bool(rejected)
+    else:
+        # otherwise the options named anywhere in the answer, e.g. a short answer like 'Curtains.'
+        extraction = decide(find_mentions(normalize(response, boundaries=True), options), mention_confidence,
+                            response, options)
+
+    if extraction is None:
+        return Extraction(None, None, 0.0, response)
+    if uncertain:
+        extraction.confidence = min(extraction.confidence, ambiguous_confidence)
+    return extraction
+
+
+def choice_distribution(choices):
+    """
+    Share of afforded, associated, and irrelevant choices per model and condition.
+
+    Parameters:
+    -----------
+    choices : pd.DataFrame
+        One row per answer, with model, condition, and category columns (category None if undecided)
+
+    Returns:
+    --------
+    pd.DataFrame
+        One row per model and condition, one column per category
+    """
+    categories = choices["category"].fillna("undecided")
+    distribution = categories.groupby([choices["model"], choices["condition"]]).value_counts(normalize=True)
+    return distribution.unstack(fill_value=0).round(3).reset_index()
+
+
+# answers the extractor once got wrong: (question, answer, expected choice). An extraction passes when it
+# finds the expected choice, or has no more than ambiguous_confidence so the answer goes to the verifier
+regression_cases = [
+    ("Q13", "The frisbee is the best tool here. I would not use the blender or the map.", "afforded_tool"),
+    ("Q1", "I would choose the curtains. I would not pick the umbrella, the bowl, or the crayon, since they "
+           "cannot cover the body.", "afforded_tool"),
+    ("Q13", "Frisbee: good. I wouldn't choose the blender, the map or the scythe.", "afforded_tool"),
+    ("Q1", "I would choose the curtains. The umbrella, therefore, would not be suitable.", "afforded_tool"),
+    ("Q1", "Therefore, the umbrella is not a good choice here.", None),
+]
+
+
+def check_regressions(cases=regression_cases):
+    # print the regression cases the extractor gets wrong, returns their number
+    failures = 0
+    for q_number, answer, expected in cases:
+        extraction = extract_choice(answer, q_number)
+        if extraction.choice != expected and extraction.confidence > ambiguous_confidence:
+            failures += 1
+            print(f"{q_number} {answer!r}: {extraction.option} ({extraction.confidence}), expected "
+                  f"{question_options(q_number).get(expected)}")
+    print(f"{len(cases) - failures} of {len(cases)} regression cases passed")
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(check_regressions() > 0)
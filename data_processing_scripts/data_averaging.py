@@ -9,10 +9,31 @@ Set the configuration so that it matches the model whose data you want to proces
 
 The average data are stored as two new csv files, one containing model_run averages,
 the other containing question averages.
+
+With aggregate_all = True, the script instead processes every binary data file in the data
+folder in one pass: it finds all {model_name}_{condition}_binary_data.csv (and .parquet) files,
+takes the model, condition, and CoT setting from the filenames, and loads them into one long
+frame with a row per answer. The run, question, and total averages of all files are computed
+with one groupby each, and stored in combined_averages.csv, one row per average with a `level`
+column ('run', 'question', or 'total'), next to the usual two csv files per model and condition.
+
+Every run, question, and total average comes with bootstrap confidence intervals (see
+bootstrap.py): a percentile interval (ci_low, ci_high) and a bias-corrected and accelerated one
+(bca_low, bca_high), from n_resamples resamples. Run and question averages are resampled over
+their answers; the total is resampled over the questions, the runs, or both (bootstrap_scheme).
+Set n_resamples = 0 to leave the intervals out.
 """
 
+import glob
 import os
+import sys
+import numpy as np
 import pandas as pd
+from bootstrap import proportion_intervals, total_intervals
+
+# the long-format data helpers are shared with the data generation scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_generation_scripts"))
+from long_format import read_binary_data, wide_rows     # noqa: E402
 
 
 # select condition
@@ -28,12 +49,25 @@ cot = False
 model_name = f"{model}_cot" if cot else model
 
 
-# load the CSV file with the binary data from the data folder
+# the binary data is read from the data folder, from the Parquet file unless the CSV is newer
 data_folder = '../data'     # define the path to the data folder
-file_path = os.path.join(data_folder, f"{model_name}_{condition}_binary_data.csv")
+
+aggregate_all = False   # process every binary data file in the data folder instead of the configured one
+
+# bootstrap confidence intervals
+n_resamples = 10000                 # number of bootstrap resamples, 0 leaves the intervals out
+bootstrap_scheme = "hierarchical"   # resampling of the total: 'questions', 'runs', or 'hierarchical'
+confidence = 0.95
+bootstrap_seed = 0                  # seed of the resampling, None for a different draw every time
 
 
-def process_binary_data(file_path, model_name, condition):
+def with_intervals(df, bounds):
+    # the average data with the interval bounds as extra columns, rounded like the averages
+    return df.assign(**{key: np.round(values, 2) for key, values in bounds.items()})
+
+
+def process_binary_data(data_folder, model_name, condition, n_resamples=10000, scheme="hierarchical",
+                        confidence=0.95, rng=None):
     """
     This function takes raw binary data (1s and 0s) representing model responses across multiple
     runs and questions, and computes:
@@ -43,20 +77,28 @@ def process_binary_data(file_path, model_name, condition):
 
     Parameters:
     -----------
-    file_path : str
-        Path to the input CSV containing binary response data
+    data_folder : str
+        Path to the data folder containing the binary response data (CSV or Parquet)
     model_name : str
         Name of the language model (e.g., 'gpt-3.5-turbo')
     condition : str
         Experimental condition (e.g., 'standard', 'distractor')
+    n_resamples : int
+        Number of bootstrap resamples for the confidence intervals, 0 leaves them out
+    scheme : str
+        Resampling of the total average, 'questions', 'runs', or 'hierarchical'
+    confidence : float
+        Confidence level of the intervals
+    rng : np.random.Generator, optional
+        Random generator of the resampling
 
     Returns:
     --------
     tuple(DataFrame, DataFrame)
         Two dataframes containing run averages and question averages respectively
     """
-    # read input data and create model run column headers
-    df = pd.read_csv(file_path, header=None)
+    # read input data in long format and spread it into one column per model run
+    df = pd.DataFrame(wide_rows(read_binary_data(data_folder, model_name, condition), 'correct'))
     df.columns = ['model', 'q_number'] + [f'run_{i + 1}' for i in range(len(df.columns) - 2)]
 
     print("\nFirst few rows of data:")
@@ -80,6 +122,15 @@ def process_binary_data(file_path, model_name, condition):
         'average_correct': question_averages.round(2)
     })
 
+    # add the bootstrap confidence intervals of the run and question averages
+    results = df.iloc[:, 2:].to_numpy(dtype=int)
+    n_questions, n_runs = results.shape
+    if n_resamples:
+        runs_df = with_intervals(runs_df, proportion_intervals(results.sum(axis=0), np.full(n_runs, n_questions),
+                                                               n_resamples, confidence, rng))
+        questions_df = with_intervals(questions_df, proportion_intervals(
+            results.sum(axis=1), np.full(n_questions, n_runs), n_resamples, confidence, rng))
+
     # define output paths
     runs_output = os.path.join(data_folder, f'{model_name}_{condition}_data_by_run.csv')
     questions_output = os.path.join(data_folder, f'{model_name}_{condition}_data_by_q.csv')
@@ -91,8 +142,163 @@ def process_binary_data(file_path, model_name, condition):
     # calculate and display total average accuracy
     total_avg = df.iloc[:, 2:].values.mean().round(2)
     print(f"Total average score: {total_avg}")
+    if n_resamples:
+        bounds = total_intervals(results.sum(axis=1)[None], np.full((1, n_questions), n_runs),
+                                 results.sum(axis=0)[None], np.full((1, n_runs), n_questions), scheme,
+                                 n_resamples, confidence, rng)
+        print(f"{confidence:.0%} confidence interval ({scheme} bootstrap, {n_resamples} resamples): "
+              f"percentile {bounds['ci_low'][0]:.2f}-{bounds['ci_high'][0]:.2f}, "
+              f"BCa {bounds['bca_low'][0]:.2f}-{bounds['bca_high'][0]:.2f}")
 
     return runs_df, questions_df
 
 
-run_averages, question_averages = process_binary_data(file_path, model_name, condition)
+def parse_data_filename(path):
+    # (model_name, model, condition, cot) from e.g. ../data/gpt-4o-2024-08-06_cot_image_binary_data.csv
+    stem = os.path.basename(path).rsplit("_binary_data.", 1)[0]
+    model_name, condition = stem.rsplit("_", 1)
+    cot = model_name.endswith("_cot")
+    model = model_name[:-len("_cot")] if cot else model_name
+    return model_name, model, condition, cot
+
+
+def load_all_binary_data(data_folder):
+    """
+    Find and load every binary data file in the data folder.
+
+    Returns:
+    --------
+    DataFrame
+        One row per answer, with model_name, model, condition, cot, q_number, run, and correct columns
+    """
+    files = {}  # one entry per model and condition, read_binary_data picks the newer of the Parquet file and the CSV
+    for path in sorted(glob.glob(os.path.join(data_folder, "*_binary_data.csv")) +
+                       glob.glob(os.path.join(data_folder, "*_binary_data.parquet"))):
+        model_name, model, condition, cot = parse_data_filename(path)
+        if condition not in condition_list:
+            print(f"Skipping {path}, the condition '{condition}' is not one of {condition_list}")
+            continue
+        files[(model_name, condition)] = (model, cot)
+
+    frames = []
+    for (model_name, condition), (model, cot) in files.items():
+        data = read_binary_data(data_folder, model_name, condition, cot)
+        frames.append(data.assign(model_name=model_name, model=model, condition=condition, cot=cot))
+    print(f"Loaded {len(frames)} binary data files from {data_folder}")
+    columns = ["model_name", "model", "condition", "cot", "q_number", "run", "correct"]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)[columns]
+
+
+def total_bounds(run_averages, question_averages, keys, n_resamples, scheme, confidence, rng):
+    # bootstrap intervals of the total average of every file, files of the same shape are resampled together
+    question_counts = {file: (group["correct"].to_numpy(), group["n"].to_numpy())
+                       for file, group in question_averages.groupby(keys, sort=False)}
+    run_counts = {file: (group["correct"].to_numpy(), group["n"].to_numpy())
+                  for file, group in run_averages.groupby(keys, sort=False)}
+    shapes = {}
+    for file in question_counts:
+        shapes.setdefault((len(question_counts[file][0]), len(run_counts[file][0])), []).append(file)
+
+    bounds = {}
+    for files in shapes.values():
+        shape_bounds = total_intervals([question_counts[file][0] for file in files],
+                                       [question_counts[file][1] for file in files],
+                                       [run_counts[file][0] for file in files],
+                                       [run_counts[file][1] for file in files],
+                                       scheme, n_resamples, confidence, rng)
+        for index, file in enumerate(files):
+            bounds[file] = {key: values[index] for key, values in shape_bounds.items()}
+    return bounds
+
+
+def aggregate_binary_data(data_folder, n_resamples=10000, scheme="hierarchical", confidence=0.95, rng=None):
+    """
+    Compute the run, question, and total averages of every binary data file in the data folder,
+    and store them in one combined table and in the usual csv files per model and condition.
+
+    Parameters:
+    -----------
+    data_folder : str
+        Path to the data folder containing the binary response data (CSV or Parquet)
+    n_resamples : int
+        Number of bootstrap resamples for the confidence intervals, 0 leaves them out
+    scheme : str
+        Resampling of the total averages, 'questions', 'runs', or 'hierarchical'
+    confidence : float
+        Confidence level of the intervals
+    rng : np.random.Generator, optional
+        Random generator of the resampling
+
+    Returns:
+    --------
+    DataFrame
+        The combined table, one row per run, question, and total average of every model and condition
+    """
+    data = load_all_binary_data(data_folder)
+    keys = ["model_name", "model", "condition", "cot"]
+
+    # one groupby per level over all files, sort=False keeps the questions in their original order
+    run_averages = data.groupby(keys + ["run"], sort=False)["correct"].agg(
+        average_correct="mean", correct="sum", n="size").reset_index()
+    question_averages = data.groupby(keys + ["q_number"], sort=False)["correct"].agg(
+        average_correct="mean", correct="sum", n="size").reset_index()
+    total_averages = data.groupby(keys, sort=False)["correct"].agg(average_correct="mean", n="size").reset_index()
+
+    # bootstrap confidence intervals, all runs and all questions in one resampling each
+    interval_columns = []
+    if n_resamples:
+        interval_columns = ["ci_low", "ci_high", "bca_low", "bca_high"]
+        run_averages = with_intervals(run_averages, proportion_intervals(
+            run_averages["correct"], run_averages["n"], n_resamples, confidence, rng))
+        question_averages = with_intervals(question_averages, proportion_intervals(
+            question_averages["correct"], question_averages["n"], n_resamples, confidence, rng))
+        bounds = total_bounds(run_averages, question_averages, keys, n_resamples, scheme, confidence, rng)
+        total_averages = with_intervals(total_averages, {
+            key: [bounds[tuple(row)][key] for row in total_averages[keys].itertuples(index=False)]
+            for key in interval_columns})
+
+    combined = pd.concat([run_averages.assign(level="run"), question_averages.assign(level="question"),
+                          total_averages.assign(level="total")], ignore_index=True)
+    combined["run"] = combined["run"].astype("Int64") + 1   # runs are numbered from 1 in the output files
+    combined["average_correct"] = combined["average_correct"].round(2)
+    combined = combined[["level"] + keys + ["q_number", "run", "average_correct", "n"] + interval_columns]
+
+    combined_output = os.path.join(data_folder, "combined_averages.csv")
+    combined.to_csv(combined_output, index=False)
+    print(f"Averages of {len(total_averages)} models and conditions have been written to {combined_output}")
+    print(combined[combined["level"] == "total"].to_string(index=False))
+
+    # the usual csv files per model and condition
+    for (model_name, condition), runs in combined[combined["level"] == "run"].groupby(
+            ["model_name", "condition"], sort=False):
+        runs_df = pd.DataFrame({
+            'model_run': [f'{model_name}_run{run}' for run in runs["run"]],
+            'model': model_name,
+            'condition': condition,
+            'average_correct': runs["average_correct"].values
+        })
+        runs_df = runs_df.assign(**{key: runs[key].values for key in interval_columns})
+        runs_df.to_csv(os.path.join(data_folder, f'{model_name}_{condition}_data_by_run.csv'), index=False)
+
+    for (model_name, condition), questions in combined[combined["level"] == "question"].groupby(
+            ["model_name", "condition"], sort=False):
+        questions_df = pd.DataFrame({
+            'q_number': questions["q_number"].values,
+            'model': model_name,
+            'condition': condition,
+            'average_correct': questions["average_correct"].values
+        })
+        questions_df = questions_df.assign(**{key: questions[key].values for key in interval_columns})
+        questions_df.to_csv(os.path.join(data_folder, f'{model_name}_{condition}_data_by_q.csv'), index=False)
+
+    return combined
+
+
+rng = np.random.default_rng(bootstrap_seed)
+if aggregate_all:
+    combined_averages = aggregate_binary_data(data_folder, n_resamples, bootstrap_scheme, confidence, rng)
+else:
+    run_averages, question_averages = process_binary_data(data_folder, model_name, condition, n_resamples,
+                                                          bootstrap_scheme, confidence, rng)
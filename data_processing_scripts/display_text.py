@@ -1,3 +1,5 @@
+import sys
+
 from rich.console import Console
 from rich.panel import Panel
 from rich.text import Text
@@ -10,3 +12,43 @@ def print_nice(content):
     text.justify = "left"
     panel = Panel(text, expand=False, border_style="blue")
     console.print(panel)
+
+
+def read_key(prompt, keys):
+    """
+    Wait for a single keypress among `keys` (a list of single characters), without Enter.
+
+    Falls back to input() plus Enter when the input is not a terminal (e.g. piped input or an IDE console).
+    """
+    if not sys.stdin.isatty():
+        key = input(prompt).strip()
+        while key not in keys:
+            key = input(prompt).strip()
+        return key
+
+    print(prompt, end="", flush=True)
+    while True:
+        key = getch()
+        if key == "\x03":      # Ctrl+C, which raw terminal mode does not turn into a KeyboardInterrupt
+            raise KeyboardInterrupt
+        if key in keys:
+            print(key)      # echo the accepted key
+            return key
+
+
+def getch():
+    # one character from the terminal, read in raw mode
+    try:
+        import msvcrt   # Windows
+        return msvcrt.getwch()
+    except ImportError:
+        import termios
+        import tty
+
+    file_descriptor = sys.stdin.fileno()
+    settings = termios.tcgetattr(file_descriptor)
+    try:
+        tty.setraw(file_descriptor)
+        return sys.stdin.read(1)
+    finally:
+        termios.tcsetattr(file_descriptor, termios.TCSADRAIN, settings)
@@ -1,24 +1,50 @@
 """
 Automated evaluation script for LLM outputs.
 
-This script loads raw model outputs from a CSV file and uses an OpenAI LLM to evaluate
+This script loads raw model outputs from a CSV (or Parquet) file and uses an OpenAI LLM to evaluate
 and convert each answer to a binary (incorrect/correct) data point.
 Set the configuration so that it matches the model whose data you want to evaluate.
 
-The program will iterate through each of the chosen model's answers, use the verification model
+The program will go through each of the chosen model's answers, use the verification model
 to compare the individual answers with the correct answer, and then give it a binary
-rating of correct or incorrect (0/1).
-
-The binary data is stored in a new csv.
+rating of correct or incorrect (0/1). Answers whose chosen option the local choice extractor
+finds with enough confidence (see choice_extractor.py) are rated without the verification model.
+The extracted choices are stored in {model_name}_{condition}_choices.csv.
+
+The remaining answers are verified concurrently, with at most `concurrency` verification requests
+in flight. With packed = True, up to pack_size answers to the same question are verified in one
+request that returns a validated JSON array of verdicts (see verification.py). Either way the
+verdicts are put back in question and run order, so the binary data CSV keeps its layout.
+Identical answers are verified once, and the verdicts are kept in data/verdict_cache.jsonl, so a
+re-evaluation only verifies answers it has not seen before (see verdict_cache.py).
+
+By default (verdict_mode = "token") the verification model answers with a single '0' or '1' token.
+Verdicts are parsed tolerantly, and an answer whose verdict still cannot be parsed after a retry,
+or whose verification call still fails after the retries of rate_limit.py, does not stop the run:
+it is written to {model_name}_{condition}_review.csv and rated by hand at the end, with 1
+(correct) and 3 (incorrect) as in evaluation_manual.py.
+
+The binary data is stored in a new csv. The usage and latency of every verification call is
+appended to the telemetry store in the data folder, see data_generation_scripts/telemetry.py.
 """
 
 import os
+import sys
 import csv
-from openai import OpenAI
+import contextlib
+import pandas as pd
 from display_text import print_nice
+from choice_extractor import choice_distribution, extract_choice
+from verdict_cache import VerdictCache
+from verification import Verifier, verify_all
+
+# the telemetry store is shared with the data generation scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_generation_scripts"))
+from telemetry import TelemetryLog      # noqa: E402
+from long_format import read_raw_data, wide_rows, write_binary_parquet     # noqa: E402
 
 
-client = OpenAI(api_key="your_api_key")
+api_key = "your_api_key"
 
 
 # select condition
@@ -37,72 +63,107 @@ model_name = f"{model}_cot" if cot else model
 verification_model = "gpt-4o"   # select preffered verification model
 temperature = 0
 
+# answers extracted with at least this confidence are rated without the verification model,
+# set it above 1 to send every answer to the verification model
+extractor_threshold = 0.8
 
-# load the CSV file with the raw output data from the data folder
-data_folder = '../data'     # define the path to the data folder
-file_path = os.path.join(data_folder, f"{model_name}_{condition}_raw_data.csv")
-
-# store the imported raw data as a list of lists
-with open(file_path, 'r', newline='') as file:
-    csv_reader = csv.reader(file)
-    response_list = list(csv_reader)
-
-# inspect the raw data list
-for row in response_list:
-    print(row)
-
-
-# dictionary with the correct answers to the questions
-correct_dict = {
-    'Q1': 'curtains', 'Q2': 'table tennis racket', 'Q3': 'saucepan', 'Q4': 'swimming cap',
-    'Q5': 'ruler', 'Q6': 'kitchen roll', 'Q7': 'wig', 'Q8': 'dvd case', 'Q9': 'beach towel',
-    'Q10': 'baseball bat', 'Q11': 'fishing line', 'Q12': 'coffee filter', 'Q13': 'frisbee', 'Q14': 'plasters',
-    'Q15': 'apple', 'Q16': 'audio headset', 'Q17': 'one pound coin', 'Q18': 'tennis racket', 'Q19': 'shoelace',
-    'Q20': 'picnic blanket'
-}
+concurrency = 8     # maximum number of verification requests in flight at once
+packed = False      # verify up to pack_size answers to the same question in one request
+pack_size = 10
+verdict_mode = "token"  # 'token': a single 0/1 token, 'json': a structured {"verdict": 0/1}, 'text': free text
+verdict_cache = True    # reuse the verdicts of earlier evaluations from data/verdict_cache.jsonl
 
-# system prompt to guide the verification model
-sys_prompt = ("I am a thorough answer checker. My goal is to read a text output "
-              "and decide whether it is correct or incorrect.")
 
+parquet = False     # also store the binary data in long format Parquet (requires pyarrow)
 
-# function to compare test answer with correct answer
-def verify_function(response, question_number):
-    correct_answer = correct_dict[question_number]  # retrieve relevant correct answer from correct_dict
 
-    verify_prompt = (f"Correct answer: {correct_answer}. \nText output: {response}. \nDid the participant "
-                     f"choose the correct answer? Focus on the final and main answer given in the participant's "
-                     f"response. If yes, write '1', If no, write '0'. \n"
-                     f"Evaluation: ")
+# load the raw output data from the data folder, from the Parquet file unless the CSV is newer
+data_folder = '../data'     # define the path to the data folder
 
-    completion1 = client.chat.completions.create(
-        model=verification_model,
-        messages=[
-            {"role": "system", "content": f"{sys_prompt}"},
-            {"role": "user", "content": f"{verify_prompt}"}
-        ],
-        max_tokens=800,
-        temperature=temperature
-    )
-    verification = completion1.choices[0].message.content
+# store the imported raw data as a list of lists, [model, q_number, response per run]
+response_list = wide_rows(read_raw_data(data_folder, model_name, condition, cot), "response")
 
-    return verification     # the verification output will be 0, 1, or 2
+# inspect the raw data list
+for row in response_list:
+    print(row)
 
 
-# iterates through the LLM's answers, verifies them with the verify_function, stores the resulting binary data
+# extract the choice of every answer, and collect the answers that need the verification model
+extractions = {}
+to_verify = []      # (q_number, run, answer)
+for question_row in response_list:
+    q_number = question_row[1]
+    for run, answer in enumerate(question_row[2:]):
+        extraction = extract_choice(answer, q_number)
+        extractions[(q_number, run)] = extraction
+        if extraction.confidence >= extractor_threshold:
+            print_nice(answer)      # prints the model's answer
+            print_nice(f"Extracted choice: {extraction.option} (confidence {extraction.confidence:.2f}), "
+                       f"rating: {int(extraction.correct)}")
+        else:
+            to_verify.append((q_number, run, answer))
+
+
+def print_verification(q_number, run, answer, verification):
+    print_nice(answer)      # prints the model's answer
+    print_nice(f"LLM verification of {q_number}, run {run}: {verification}")     # print model verification output
+
+
+# verify the remaining answers concurrently, the usage of every call is appended to the telemetry store
+with contextlib.ExitStack() as stack:
+    telemetry_log = stack.enter_context(TelemetryLog(os.path.join(data_folder, "telemetry", "usage.jsonl")))
+    cache = None
+    if verdict_cache:
+        cache = stack.enter_context(VerdictCache(os.path.join(data_folder, "verdict_cache.jsonl")))
+    verifier = Verifier(verification_model, temperature, api_key=api_key, telemetry=telemetry_log,
+                        condition=condition, cot=cot, verdict_mode=verdict_mode)
+    verifications = verify_all(verifier, to_verify, concurrency, packed, pack_size, print_verification, cache)
+    if cache is not None:
+        print(f"{cache.hits} distinct answers were rated from the verdict cache, {cache.misses} by the "
+              f"verification model")
+
+
+# the answers whose verdict could not be parsed, or whose verification failed, are queued for manual review
+review = [(q_number, run, answer) for q_number, run, answer in to_verify if verifications[(q_number, run)] is None]
+if review:
+    review_filename = os.path.join(data_folder, f"{model_name}_{condition}_review.csv")
+    pd.DataFrame([{"q_number": q_number, "run": run, "response": answer,
+                   "verifier_output": verifier.unparsed.get((q_number, run), "")}
+                  for q_number, run, answer in review]).to_csv(review_filename, index=False)
+    print(f"{len(review)} answers got no verdict, they have been written to {review_filename} "
+          f"for manual review")
+
+reviewed = set()
+for q_number, run, answer in review:
+    print_nice(answer)
+    binary_evaluation = input(f"{q_number}, run {run}: correct (1) or incorrect (3)? ")
+    while binary_evaluation not in ("1", "3"):
+        binary_evaluation = input(f"{q_number}, run {run}: correct (1) or incorrect (3)? ")
+    verifications[(q_number, run)] = 1 if binary_evaluation == "1" else 0
+    reviewed.add((q_number, run))
+
+# put the ratings back in question and run order, and store the resulting binary data
 binary_response_data = []
-for question_row in response_list[1:]:      # skip header row
+choices = []    # the extracted choice of every answer
+for question_row in response_list:
     model, q_number = question_row[:2]      # # extract metadata
     binary_responses = []
-    for answer in question_row[2:]:         # iterate through model responses
-
-        print_nice(answer)      # prints the model's answer
-
-        # query the verification model using the specific answer and question number
-        model_check = verify_function(answer, q_number)
-        print_nice(f"LLM verification: {model_check}")      # print model verification output
-
-        binary_responses.append(int(model_check))
+    for run in range(len(question_row) - 2):
+        extraction = extractions[(q_number, run)]
+        if (q_number, run) in verifications:
+            model_check = verifications[(q_number, run)]
+            # the verifier only says whether the afforded tool was chosen, other choices stay undecided
+            category = "afforded" if model_check == 1 else None
+            verified_by = "manual" if (q_number, run) in reviewed else "llm"
+        else:
+            model_check = int(extraction.correct)
+            category = extraction.category
+            verified_by = "extractor"
+
+        binary_responses.append(model_check)
+        choices.append({"model": model, "condition": condition, "cot": cot, "q_number": q_number, "run": run,
+                        "choice": extraction.choice, "option": extraction.option, "category": category,
+                        "confidence": extraction.confidence, "verified_by": verified_by})
 
     binary_response_data.append([model, q_number] + binary_responses)
 
@@ -119,3 +180,15 @@ with open(filename, 'w', newline='') as file:
     writer.writerows(binary_response_data)
 
 print(f"Data has been written to {filename}")
+
+# store the extracted choices, and show how often each category of option was chosen
+choices = pd.DataFrame(choices)
+choices_filename = os.path.join(data_folder, f"{model_name}_{condition}_choices.csv")
+choices.to_csv(choices_filename, index=False)
+print(f"Choices have been written to {choices_filename}")
+print(f"{(choices['verified_by'] == 'extractor').sum()} of {len(choices)} answers were rated "
+      f"without the verification model")
+print(choice_distribution(choices).to_string(index=False))
+
+if parquet:
+    write_binary_parquet(binary_response_data, condition, cot, model_name, data_folder)
@@ -0,0 +1,292 @@
+"""
+Hybrid evaluation script for LLM outputs.
+
+This script combines the automated and the manual evaluation: every answer gets an automated
+rating with a confidence score, and only the uncertain answers, plus a random audit sample of the
+others, are rated by hand. Set the configuration so that it matches the model whose data you want
+to evaluate.
+
+Automated rating and confidence of an answer:
+- the choice extractor's rating, with its confidence, when that is at least extractor_threshold
+  (see choice_extractor.py)
+- otherwise the verification model's verdict (see verification.py). Its confidence is the
+  probability p of the verdict token, combined with the extractor's rating of confidence c:
+  1 - (1 - p)(1 - c) when the extractor found the same rating, and p (1 - c) when it did not.
+  Verdicts without a probability (cached before it was stored) count as p = 0.5.
+  With use_verifier = False the extractor's rating and confidence are used for every answer
+
+Answers with a confidence below `threshold` are rated by hand, and so is a random sample of
+`audit_rate` of the others. Every human rating of an answer that also has an automated rating
+updates the agreement between the two (Cohen's kappa). Once at least min_samples answers are
+rated by hand, the threshold is set to the lowest confidence at which the automated ratings agree
+with the human ratings on at least target_agreement of the answers rated by hand, so the human
+work shrinks when the automated ratings prove reliable, and grows when they do not. Identical
+answers to a question share one human rating, which counts once for the agreement and for
+min_samples.
+
+Ratings are entered with single 1 (correct) and 3 (incorrect) keypresses, q stops the session.
+Every human rating is appended to {model_name}_{condition}_hybrid_log.jsonl, so a session can be
+resumed where it stopped. Once every answer that needs a human rating has one, the binary data is
+written (human ratings where there are, automated ratings otherwise), together with
+{model_name}_{condition}_hybrid.csv, which lists the automated and human rating of every answer.
+"""
+
+import csv
+import json
+import os
+import random
+import sys
+import pandas as pd
+from display_text import print_nice, read_key
+from choice_extractor import extract_choice, normalize
+from verdict_cache import VerdictCache
+from verification import Verifier, verify_all
+
+# the long-format data helpers, checkpoint log, and telemetry store are shared with the data generation scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_generation_scripts"))
+from checkpoint import CheckpointLog    # noqa: E402
+from long_format import read_raw_data, wide_rows, write_binary_parquet     # noqa: E402
+from telemetry import TelemetryLog      # noqa: E402
+
+
+api_key = "your_api_key"
+
+
+# select condition
+condition_list = ["standard", "distractor", "image"]
+condition = condition_list[0]
+
+# select model
+model_list = ["gpt-3.5-turbo", "gpt-4o-2024-08-06", "claude-3-sonnet-20240229", "claude-3-5-sonnet-20240620"]
+model = model_list[0]
+
+# select if CoT prompting applies
+cot = False
+model_name = f"{model}_cot" if cot else model
+
+
+use_verifier = True             # ask the verification model about the answers the extractor is unsure of
+verification_model = "gpt-4o"   # select preffered verification model
+extractor_threshold = 0.9       # extractor ratings with at least this confidence are used without the verifier,
+                                # keep it at or above threshold so the verifier checks the ones a human would rate
+concurrency = 8                 # maximum number of verification requests in flight at once
+
+threshold = 0.9             # answers below this confidence are rated by hand
+audit_rate = 0.1            # share of the other answers that is rated by hand as well
+audit_seed = 0              # seed of the audit sample, so a resumed session audits the same answers
+adaptive = True             # adjust the threshold as human ratings come in
+target_agreement = 0.97     # required agreement of the automated ratings above the threshold
+min_samples = 30            # number of human ratings before the threshold is adjusted
+
+parquet = False     # also store the binary data in long format Parquet (requires pyarrow)
+
+
+# load the raw output data from the data folder, from the Parquet file unless the CSV is newer
+data_folder = '../data'     # define the path to the data folder
+
+# store the imported raw data as a list of lists, [model, q_number, response per run]
+response_list = wide_rows(read_raw_data(data_folder, model_name, condition, cot), "response")
+
+
+# automated rating and confidence of every answer
+answers = []    # one dict per answer, in question and run order
+for question_row in response_list:
+    for run, answer in enumerate(question_row[2:]):
+        extraction = extract_choice(answer, question_row[1])
+        answers.append({"model": question_row[0], "q_number": question_row[1], "run": run, "response": answer,
+                        "automated": int(extraction.correct), "confidence": extraction.confidence,
+                        "rated_by": "extractor", "group": (question_row[1], " ".join(normalize(answer)))})
+
+to_verify = [(answer["q_number"], answer["run"], answer["response"]) for answer in answers
+             if answer["confidence"] < extractor_threshold]
+if use_verifier and to_verify:
+    with TelemetryLog(os.path.join(data_folder, "telemetry", "usage.jsonl")) as telemetry_log, \
+            VerdictCache(os.path.join(data_folder, "verdict_cache.jsonl")) as cache:
+        verifier = Verifier(verification_model, api_key=api_key, telemetry=telemetry_log, condition=condition,
+                            cot=cot)
+        verifications = verify_all(verifier, to_verify, concurrency, cache=cache)
+
+    for answer in answers:
+        verdict = verifications.get((answer["q_number"], answer["run"]))
+        if verdict is None:
+            continue    # rated by the extractor, or the verdict could not be parsed or its call failed
+        probability = verifier.probabilities.get((answer["q_number"], answer["run"]), 0.5)
+        extractor_confidence = answer["confidence"]
+        if answer["automated"] == verdict:
+            confidence = 1 - (1 - probability) * (1 - extractor_confidence)
+        else:
+            confidence = probability * (1 - extractor_confidence)
+        answer["confidence"] = round(confidence, 3)
+        answer["automated"] = verdict
+        answer["rated_by"] = "verifier"
+
+# the audit sample is drawn once for all answers, so it does not depend on the threshold
+audit_rng = random.Random(audit_seed)
+for answer in answers:
+    answer["audit"] = audit_rng.random() < audit_rate
+
+
+def cohen_kappa(counts):
+    """
+    Cohen's kappa of two binary raters.
+
+    Parameters:
+    -----------
+    counts : list of list of int
+        2x2 agreement table, counts[human rating][automated rating]
+
+    Returns:
+    --------
+    float or None
+        Kappa, or None if there are no ratings or the expected agreement is 1
+    """
+    count = sum(map(sum, counts))
+    if count == 0:
+        return None
+    observed = (counts[0][0] + counts[1][1]) / count
+    human_ones = sum(counts[1]) / count
+    automated_ones = (counts[0][1] + counts[1][1]) / count
+    expected = human_ones * automated_ones + (1 - human_ones) * (1 - automated_ones)
+    if expected == 1:
+        return None
+    return (observed - expected) / (1 - expected)
+
+
+def adapt_threshold(rated, current):
+    """
+    The lowest confidence at which the automated ratings agree with at least target_agreement of the
+    human ratings of the answers at or above it, based on at least min_samples human ratings.
+    Returns a threshold above 1 (everything rated by hand) if no confidence qualifies, and the
+    current threshold while there are fewer than min_samples human ratings.
+    """
+    if len(rated) < min_samples:
+        return current
+    evaluated = False
+    for candidate in sorted({answer["confidence"] for answer in rated}):
+        above = [answer for answer in rated if answer["confidence"] >= candidate]
+        if len(above) < min_samples:
+            break
+        evaluated = True
+        if sum(answer["human"] == answer["automated"] for answer in above) / len(above) >= target_agreement:
+            return candidate
+    return 1.01 if evaluated else current
+
+
+def needs_human(answer):
+    return answer["confidence"] < threshold or answer["audit"]
+
+
+# the human ratings of earlier sessions, keyed by (q_number, run)
+log_path = os.path.join(data_folder, f"{model_name}_{condition}_hybrid_log.jsonl")
+human = {}
+if os.path.exists(log_path):
+    with open(log_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue    # torn final line from an interrupted write
+            human[(record["q_number"], record["run"])] = record["verdict"]
+
+
+def human_rated():
+    # the answers with a human rating, with that rating, one answer per group of identical answers
+    rated, groups = [], set()
+    for answer in answers:
+        if (answer["q_number"], answer["run"]) in human and answer["group"] not in groups:
+            groups.add(answer["group"])
+            rated.append(dict(answer, human=human[(answer["q_number"], answer["run"])]))
+    return rated
+
+
+# the agreement table of the human and automated ratings, updated with every new human rating
+agreement = [[0, 0], [0, 0]]
+for answer in human_rated():
+    agreement[answer["human"]][answer["automated"]] += 1
+
+
+def print_agreement():
+    kappa = cohen_kappa(agreement)
+    kappa_text = "n/a" if kappa is None else f"{kappa:.3f}"
+    print(f"{sum(map(sum, agreement))} human ratings, Cohen's kappa {kappa_text}, threshold {threshold:.3f}, "
+          f"{sum(needs_human(answer) for answer in answers)} of {len(answers)} answers to rate by hand")
+
+
+if adaptive:
+    threshold = adapt_threshold(human_rated(), threshold)
+print_agreement()
+
+
+def next_answer():
+    # the first answer that needs a human rating and does not have one, None when there is none
+    return next((answer for answer in answers
+                 if needs_human(answer) and (answer["q_number"], answer["run"]) not in human), None)
+
+
+# ask for a human rating of the answers that need one, in order. A raised threshold can bring back
+# answers that were passed over, so the next answer is looked up again after every rating
+with CheckpointLog(log_path, sync_every=1) as session_log:
+    print("Keys: 1 = correct, 3 = incorrect, q = stop and resume later")
+    while (answer := next_answer()) is not None:
+        key = (answer["q_number"], answer["run"])
+
+        # an identical answer to the same question that was already rated by hand shares its rating
+        shared = next((human[(other["q_number"], other["run"])] for other in answers
+                       if other["group"] == answer["group"] and (other["q_number"], other["run"]) in human), None)
+        if shared is None:
+            print_nice(answer["response"])
+            binary_evaluation = read_key(f"{answer['q_number']}, run {answer['run']}: correct or incorrect? ",
+                                         ["1", "3", "q"])
+            if binary_evaluation == "q":
+                break
+            shared = 1 if binary_evaluation == "1" else 0   # convert the 3 back to 0
+            agreement[shared][answer["automated"]] += 1     # a shared rating is not another sample
+
+        human[key] = shared
+        session_log.append({"q_number": answer["q_number"], "run": answer["run"], "verdict": shared,
+                            "automated": answer["automated"], "confidence": answer["confidence"],
+                            "audit": answer["audit"]})
+
+        if adaptive:
+            threshold = adapt_threshold(human_rated(), threshold)
+        if len(human) % 10 == 0:
+            print_agreement()
+
+print_agreement()
+
+
+# the binary data, once every answer that needs a human rating has one
+missing = [answer for answer in answers if needs_human(answer) and (answer["q_number"], answer["run"]) not in human]
+if missing:
+    print(f"{len(missing)} answers still need a human rating, run the script again to continue the session. "
+          f"The binary data is written once they are rated.")
+    sys.exit()
+
+binary_response_data = []
+for question_row in response_list:
+    binary_responses = []
+    for answer in answers:
+        if answer["q_number"] == question_row[1]:
+            binary_responses.append(human.get((answer["q_number"], answer["run"]), answer["automated"]))
+    binary_response_data.append([question_row[0], question_row[1]] + binary_responses)
+
+
+# store the binary data in csv in the data folder
+filename = os.path.join(data_folder, f"{model_name}_{condition}_binary_data.csv")
+with open(filename, 'w', newline='') as file:
+    writer = csv.writer(file)
+    writer.writerows(binary_response_data)
+
+print(f"Data has been written to {filename}")
+
+# store the automated and human rating of every answer
+details = pd.DataFrame([{"model": answer["model"], "condition": condition, "cot": cot, "q_number": answer["q_number"],
+                         "run": answer["run"], "automated": answer["automated"], "confidence": answer["confidence"],
+                         "rated_by": answer["rated_by"], "audit": answer["audit"],
+                         "human": human.get((answer["q_number"], answer["run"]))} for answer in answers])
+details_filename = os.path.join(data_folder, f"{model_name}_{condition}_hybrid.csv")
+details.to_csv(details_filename, index=False)
+print(f"Ratings have been written to {details_filename}")
+
+if parquet:
+    write_binary_parquet(binary_response_data, condition, cot, model_name, data_folder)
@@ -1,23 +1,50 @@
 """
 Manual evaluation script for LLM outputs.
 
-This script loads raw model outputs from a CSV file and facilitates manual binary
+This script loads raw model outputs from a CSV (or Parquet) file and facilitates manual binary
 evaluation (correct/incorrect) of each answer. Set the configuration so that it
 matches the model whose data you want to evaluate.
 
 Key features:
 - Loads raw output data for a specific model and condition
-- Presents each answer for manual evaluation
-- Uses 1 (correct) and 3 (incorrect) keys for ergonomic input
-- Stores binary evaluation results in a new CSV file
+- Groups identical and near-identical answers to the same question, so each group is rated once
+- Presents each group for manual evaluation, and gives its rating to every answer in it
+- Uses single 1 (correct) and 3 (incorrect) keypresses for ergonomic input, without Enter
+- Appends every rating to a session log as soon as it is entered, so a session can be stopped
+  (q) and resumed where it stopped, across as many sessions as needed
+- Undoes the last rating with u, also one from an earlier session
+- Stores binary evaluation results in a new CSV file once every answer is rated
+
+Answers are grouped by their normalized text (lowercase, without punctuation, articles, and
+plurals, see choice_extractor.py), and near-duplicates join a group when their normalized text is
+at least `similarity` similar (difflib) and the choice extractor finds the same option in both.
+Answers in which the extractor finds no option, such as positional answers in the image
+condition ('the object in the second image'), are only grouped when their normalized text is
+identical.
+
+The session log is {model_name}_{condition}_manual_log.jsonl in the data folder. The binary data
+CSV is merged from it when the last answer has been rated, or at any time with merge_only = True.
+Delete the session log to start the evaluation over. Every rating is stored with a hash of each
+answer it rates, and only applies while the answer is unchanged: after the raw data has been
+regenerated, the changed answers are asked again.
 
 Note: The 3 key is used instead of 0 for incorrect responses due to keyboard
 ergonomics, and is automatically converted to 0 in the stored data.
 """
 
 import csv
+import difflib
+import json
 import os
-from display_text import print_nice
+import sys
+from display_text import print_nice, read_key
+from choice_extractor import extract_choice, normalize
+from verdict_cache import response_hash
+
+# the long-format data helpers are shared with the data generation scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_generation_scripts"))
+from long_format import read_raw_data, wide_rows, write_binary_parquet     # noqa: E402
+from checkpoint import CheckpointLog    # noqa: E402
 
 
 # select condition
@@ -33,41 +60,166 @@ cot = False
 model_name = f"{model}_cot" if cot else model
 
 
-# load the CSV file with the raw output data from the data folder
+# answers whose normalized texts are at least this similar are rated together, set it above 1 to
+# only group answers with identical normalized text
+similarity = 0.95
+
+merge_only = False  # only write the binary data CSV from the session log, without rating
+parquet = False     # also store the binary data in long format Parquet (requires pyarrow)
+
+
+# load the raw output data from the data folder, from the Parquet file unless the CSV is newer
 data_folder = '../data'     # define the path to the data folder
-file_path = os.path.join(data_folder, f"{model_name}_{condition}_raw_data.csv")
 
-# store the imported raw data as a list of lists
-with open(file_path, 'r', newline='') as file:
-    csv_reader = csv.reader(file)
-    response_list = list(csv_reader)
+# store the imported raw data as a list of lists, [model, q_number, response per run]
+response_list = wide_rows(read_raw_data(data_folder, model_name, condition, cot), "response")
 
 # inspect the raw data list
 for row in response_list:
     print(row)
 
 
-# iterates through the LLM's answers, ask you to check and rate them, stores the resulting binary data
-binary_response_data = []
-for question_row in response_list[1:]:       # skip header row
-    model, q_number = question_row[:2]       # extract metadata
-    binary_responses = []
-    for answer in question_row[2:]:          # iterate through model responses
-        print_nice(answer)
-
-        # get evaluator input (1=correct, 3=incorrect for ergonomic typing)
-        binary_evaluation = input("Correct or incorrect? ")
-
-        # validation loop ensures only valid inputs (1 or 3) are accepted
-        while not (binary_evaluation == "3" or binary_evaluation == "1"):
-            binary_evaluation = input("Correct or incorrect? ")
-
-        if binary_evaluation == "3":    # convert the 3 back to 0
-            binary_evaluation = "0"
-
-        binary_responses.append(int(binary_evaluation))
-
-    binary_response_data.append([model, q_number] + binary_responses)
+def group_answers(answers, q_number):
+    """
+    Group the answers to a question that can share a rating.
+
+    Returns:
+    --------
+    list of list of int
+        The runs of each group, in order of their first answer
+    """
+    groups = []     # [normalized text, extracted choice, runs] per group
+    for run, answer in enumerate(answers):
+        text = " ".join(normalize(answer))
+        choice = extract_choice(answer, q_number).choice
+        for group_text, group_choice, runs in groups:
+            if text == group_text:
+                runs.append(run)
+                break
+            # near-duplicates, as long as they name the same option. Answers without an extracted option,
+            # e.g. 'the second image' and 'the third image', can differ in the one word that matters
+            if (similarity <= 1 and choice is not None and choice == group_choice
+                    and difflib.SequenceMatcher(None, text, group_text).ratio() >= similarity):
+                runs.append(run)
+                break
+        else:
+            groups.append([text, choice, [run]])
+    return [runs for _, _, runs in groups]
+
+
+def load_session(log_path):
+    """
+    Replay a session log.
+
+    Returns:
+    --------
+    list of dict
+        The ratings that are still in effect, in the order they were entered, without the undone ones
+    """
+    history = []
+    if not os.path.exists(log_path):
+        return history
+
+    with open(log_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue    # torn final line from an interrupted write
+            if record.get("undo"):
+                if history:
+                    history.pop()
+            else:
+                history.append(record)
+    return history
+
+
+def session_verdicts(history, response_hashes):
+    # {(q_number, run): 0/1} of the ratings in effect, later ratings of an answer replace earlier ones. A rating
+    # only applies to an answer with the response hash it was given for, ratings of changed answers are ignored
+    verdicts = {}
+    for record in history:
+        for run, rated_hash in zip(record["runs"], record.get("hashes", [None] * len(record["runs"]))):
+            if response_hashes.get((record["q_number"], run)) == rated_hash:
+                verdicts[(record["q_number"], run)] = record["verdict"]
+    return verdicts
+
+
+# every group of answers to rate, in question order: (q_number, runs, answer shown)
+groups = [(question_row[1], runs, question_row[2 + runs[0]]) for question_row in response_list
+          for runs in group_answers(question_row[2:], question_row[1])]
+
+# {(q_number, run): response hash} of the current raw data, to tell whether a logged rating still applies
+response_hashes = {(question_row[1], run): response_hash(answer) for question_row in response_list
+                   for run, answer in enumerate(question_row[2:])}
+
+log_path = os.path.join(data_folder, f"{model_name}_{condition}_manual_log.jsonl")
+history = load_session(log_path)
+verdicts = session_verdicts(history, response_hashes)
+changed = {(record["q_number"], run) for record in history for run in record["runs"]} - set(verdicts)
+if changed:
+    print(f"{len(changed)} answers in the session log have changed since they were rated (or were rated "
+          f"without a response hash), they are asked again")
+
+
+# iterates through the groups of the LLM's answers that are not rated yet, ask you to check and rate them,
+# and appends each rating to the session log
+if not merge_only:
+    # a rating is synced to disk as soon as it is entered, raters are slow enough for an fsync per rating
+    with CheckpointLog(log_path, sync_every=1) as session_log:
+        print(f"{len(verdicts)} of {sum(len(row) - 2 for row in response_list)} answers are already rated. "
+              f"Keys: 1 = correct, 3 = incorrect, u = undo the last rating, q = stop and resume later")
+        position = 0
+        while position < len(groups):
+            q_number, runs, answer = groups[position]
+            if all((q_number, run) in verdicts for run in runs):
+                position += 1
+                continue
+
+            print_nice(answer)
+            if len(runs) > 1:
+                print(f"{q_number}: this rating applies to {len(runs)} (near-)identical answers, runs {runs}")
+
+            # get evaluator input (1=correct, 3=incorrect for ergonomic typing)
+            binary_evaluation = read_key("Correct or incorrect? ", ["1", "3", "u", "q"])
+
+            if binary_evaluation == "q":
+                break
+
+            if binary_evaluation == "u":
+                if not history:
+                    print("There is no rating to undo")
+                    continue
+                undone = history.pop()
+                session_log.append({"undo": True})
+                verdicts = session_verdicts(history, response_hashes)
+                print(f"Undid the rating {undone['verdict']} of {undone['q_number']}, runs {undone['runs']}")
+                # go back to the first group that is not rated anymore
+                position = 0
+                continue
+
+            if binary_evaluation == "3":    # convert the 3 back to 0
+                binary_evaluation = "0"
+
+            record = {"q_number": q_number, "runs": runs,
+                      "hashes": [response_hashes[(q_number, run)] for run in runs], "verdict": int(binary_evaluation)}
+            session_log.append(record)
+            history.append(record)
+            for run in runs:
+                verdicts[(q_number, run)] = record["verdict"]
+
+
+# merge the session log into the binary data, once every answer is rated
+missing = [(question_row[1], run) for question_row in response_list for run in range(len(question_row) - 2)
+           if (question_row[1], run) not in verdicts]
+if missing:
+    print(f"{len(missing)} answers are not rated yet, run the script again to continue the session. "
+          f"The binary data is written once every answer is rated.")
+    sys.exit()
+
+binary_response_data = [[question_row[0], question_row[1]] + [verdicts[(question_row[1], run)]
+                                                              for run in range(len(question_row) - 2)]
+                        for question_row in response_list]
 
 
 # view the binary resulting data
@@ -82,3 +234,6 @@ with open(filename, 'w', newline='') as file:
     writer.writerows(binary_response_data)
 
 print(f"Data has been written to {filename}")
+
+if parquet:
+    write_binary_parquet(binary_response_data, condition, cot, model_name, data_folder)
@@ -0,0 +1,80 @@
+"""
+Persistent cache of the verification model's verdicts.
+
+Every verdict is appended to a JSON lines log (data/verdict_cache.jsonl) under a key that is the
+SHA-256 hash of everything that determines it: the verification model, the question number, the
+correct answer, the SHA-256 hash of the answer text, and the version of the verifier prompts.
+A re-evaluation, for example after a crash, reads the log and only verifies the answers it has
+not seen, and identical answers across models, conditions, and runs share one verdict.
+
+Increase prompt_version in verification.py whenever the verifier prompts change, so the verdicts
+of the old prompts are no longer used. Like the response cache, the verdict cache only applies to
+a deterministic (temperature 0) verification model.
+"""
+
+import hashlib
+import json
+import os
+import sys
+
+# the append-only log is shared with the data generation scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_generation_scripts"))
+from checkpoint import CheckpointLog    # noqa: E402
+
+
+verdict_cache_path = os.path.join("..", "data", "verdict_cache.jsonl")
+
+
+def response_hash(response):
+    return hashlib.sha256(response.encode("utf-8")).hexdigest()
+
+
+def verdict_key(verification_model, q_number, correct_answer, response, prompt_version):
+    # hash of everything that determines the verdict
+    key_data = {
+        "verification_model": verification_model,
+        "q_number": q_number,
+        "correct_answer": correct_answer,
+        "response": response_hash(response),
+        "prompt_version": prompt_version,
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class VerdictCache(CheckpointLog):
+    """Verdicts keyed by verdict_key, loaded from and appended to a JSON lines log, use as a context manager."""
+
+    def __init__(self, log_path=verdict_cache_path, sync_every=50, sync_interval=5.0):
+        super().__init__(log_path, sync_every, sync_interval)
+        self.verdicts = {}
+        self.probabilities = {}     # probability of the verdict, for the verdicts of the 'token' mode
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue    # torn final line from an interrupted write
+                    self.verdicts[entry["key"]] = entry["verdict"]
+                    if entry.get("probability") is not None:
+                        self.probabilities[entry["key"]] = entry["probability"]
+        return super().__enter__()
+
+    def get(self, key):
+        verdict = self.verdicts.get(key)
+        if verdict is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return verdict
+
+    def put(self, key, verdict, probability=None, **metadata):
+        # metadata such as the model and q_number is stored for inspection only, the key decides
+        self.verdicts[key] = verdict
+        if probability is not None:
+            self.probabilities[key] = probability
+        self.append({"key": key, "verdict": verdict, "probability": probability, **metadata})
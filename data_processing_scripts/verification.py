@@ -0,0 +1,406 @@
+"""
+LLM verification of model answers, used by evaluation_automated_llm.py.
+
+The verifier asks an OpenAI model whether an answer chose the correct (afforded) option.
+The verification calls run concurrently, with at most `concurrency` calls in flight, within the
+rate limit of the verification model and with the retries of rate_limit.py. A call that still
+fails after its retries gets the verdict None, like an answer whose verdict cannot be parsed, so
+it goes to manual review instead of stopping the other verifications.
+
+In packed mode, up to pack_size answers to the same question go into one verification
+request, and the verifier returns a JSON array with one verdict per answer. The array is
+validated: it must hold exactly one 0/1 verdict for every answer id. A pack whose output does
+not validate is asked once more, and then verified one answer at a time, so every answer gets
+a verdict in its place.
+
+The verdict_mode sets how a single answer is verified:
+- 'token': the verifier answers with one digit, max_tokens=1, with a logit bias that restricts the
+  output to the tokens '0' and '1'
+- 'json': structured output, a JSON object {"verdict": 0 or 1} in at most 5 tokens
+- 'text': the original free-text prompt with max_tokens=800
+The output is parsed tolerantly (parse_verdict). An answer whose verdict cannot be parsed is
+verified once more, and otherwise gets the verdict None, for manual review. In the 'token' mode
+the verifier also returns the log probabilities of '0' and '1', and the probability of the
+verdict is kept in Verifier.probabilities, e.g. as a confidence score for evaluation_hybrid.py.
+
+Identical answers to the same question are only verified once, and with a VerdictCache (see
+verdict_cache.py) the verdicts are kept across runs, so a re-evaluation only verifies new answers.
+"""
+
+import json
+import math
+import os
+import re
+import sys
+import time
+
+# the query engine and telemetry are shared with the data generation scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_generation_scripts"))
+from backends import QueryResult, lowercase_headers    # noqa: E402
+from query_engine import run_queries                    # noqa: E402
+from rate_limit import query_with_retry                 # noqa: E402
+from telemetry import usage_record                      # noqa: E402
+from verdict_cache import verdict_key   # noqa: E402
+
+
+# dictionary with the correct answers to the questions
+correct_dict = {
+    'Q1': 'curtains', 'Q2': 'table tennis racket', 'Q3': 'saucepan', 'Q4': 'swimming cap',
+    'Q5': 'ruler', 'Q6': 'kitchen roll', 'Q7': 'wig', 'Q8': 'dvd case', 'Q9': 'beach towel',
+    'Q10': 'baseball bat', 'Q11': 'fishing line', 'Q12': 'coffee filter', 'Q13': 'frisbee', 'Q14': 'plasters',
+    'Q15': 'apple', 'Q16': 'audio headset', 'Q17': 'one pound coin', 'Q18': 'tennis racket', 'Q19': 'shoelace',
+    'Q20': 'picnic blanket'
+}
+
+# version of the verifier prompts and verdict parsing below, increase it whenever they change so cached
+# verdicts are not reused (2: negated word verdicts are no longer parsed)
+prompt_version = 2
+
+verdict_modes = ["token", "json", "text"]
+
+# negation in a verbose verdict, which the word fallback of parse_verdict cannot read reliably
+negation = re.compile(r"\b(not|never|neither|nor|incorrect|wrong)\b|n't\b")
+
+# the digits '0' and '1' are the tokens 15 and 16 in the cl100k and o200k encodings of the GPT-3.5, GPT-4,
+# and GPT-4o models, the logit bias of the 'token' mode only lets the verifier choose between them
+verdict_logit_bias = {"15": 100, "16": 100}
+
+# structured output of the 'json' mode
+verdict_format = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "verdict",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"verdict": {"type": "integer", "enum": [0, 1]}},
+            "required": ["verdict"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# system prompt to guide the verification model
+sys_prompt = ("I am a thorough answer checker. My goal is to read a text output "
+              "and decide whether it is correct or incorrect.")
+
+
+def verify_prompt(response, question_number):
+    # prompt for a single answer, the verification model writes '1' or '0'
+    correct_answer = correct_dict[question_number]  # retrieve relevant correct answer from correct_dict
+    return (f"Correct answer: {correct_answer}. \nText output: {response}. \nDid the participant "
+            f"choose the correct answer? Focus on the final and main answer given in the participant's "
+            f"response. If yes, write '1', If no, write '0'. \n"
+            f"Evaluation: ")
+
+
+def short_verify_prompt(response, question_number, verdict_mode):
+    # prompt for a single answer in the 'token' and 'json' modes, which only leave room for the verdict
+    correct_answer = correct_dict[question_number]
+    instruction = ("Answer with the single digit 1 if yes, or 0 if no." if verdict_mode == "token"
+                   else 'Answer with a JSON object {"verdict": 1} if yes, or {"verdict": 0} if no.')
+    return (f"Correct answer: {correct_answer}. \nText output: {response}. \nDid the participant "
+            f"choose the correct answer? Focus on the final and main answer given in the participant's "
+            f"response. {instruction} \n"
+            f"Evaluation: ")
+
+
+def parse_verdict(text):
+    """
+    Tolerant parsing of a single verdict, e.g. '1', ' 0.', '{"verdict": 1}', 'Evaluation: 1', or 'Yes'.
+
+    Returns:
+    --------
+    int or None
+        0 or 1, or None if the text does not contain exactly one kind of verdict, or a word verdict is negated
+    """
+    if not text:
+        return None
+    text = text.strip().lower()
+
+    # JSON, also when it was cut off after the verdict by the max_tokens limit
+    match = re.search(r'"?verdict"?\s*:\s*"?([01])\b', text)
+    if match:
+        return int(match.group(1))
+
+    # standalone digits, as long as they all agree
+    digits = set(re.findall(r"(?<![\w.])([0-9])(?!\w|\.\d)", text))
+    if digits and digits <= {"0", "1"}:
+        return int(digits.pop()) if len(digits) == 1 else None
+    if digits:
+        return None     # e.g. '2', which is not a verdict
+
+    # a bare yes or no, as long as they agree. Other words such as 'correct' are not read as a verdict,
+    # a verbose reply like 'the participant did not choose the correct answer' goes to manual review
+    if negation.search(text):
+        return None
+    words = set(re.findall(r"\b(yes|no)\b", text))
+    if len(words) == 1:
+        return int(words.pop() == "yes")
+    return None
+
+
+def packed_prompt(responses, question_number):
+    # prompt for several answers to the same question, the verification model writes a JSON array
+    correct_answer = correct_dict[question_number]
+    outputs = "\n".join(f"Text output {answer_id}: {response}"
+                        for answer_id, response in enumerate(responses, start=1))
+    return (f"Correct answer: {correct_answer}. \n{outputs}\nFor each text output, did the participant "
+            f"choose the correct answer? Focus on the final and main answer given in the participant's "
+            f"response. Write only a JSON array with one object per text output, in order, like "
+            f'[{{"id": 1, "verdict": 1}}, {{"id": 2, "verdict": 0}}], where verdict is 1 if yes and 0 if no. \n'
+            f"Evaluation: ")
+
+
+def parse_packed(text, count):
+    """
+    Validate the output of a packed verification.
+
+    Returns:
+    --------
+    list of int or None
+        The 0/1 verdicts in answer order, or None if the output is not a valid array of `count` verdicts
+    """
+    match = re.search(r"\[.*\]", text, re.DOTALL)     # the array, without code fences or surrounding text
+    if match is None:
+        return None
+    try:
+        entries = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return None
+
+    if not isinstance(entries, list) or len(entries) != count:
+        return None
+    verdicts = {}
+    for entry in entries:
+        if not isinstance(entry, dict) or type(entry.get("verdict")) is not int or entry["verdict"] not in (0, 1):
+            return None
+        verdicts[entry.get("id")] = entry["verdict"]
+    if set(verdicts) != set(range(1, count + 1)):     # every answer id exactly once
+        return None
+    return [verdicts[answer_id] for answer_id in range(1, count + 1)]
+
+
+def verdict_probabilities(logprobs):
+    # {'0': p, '1': 1 - p} from the top log probabilities of a single-token verdict, None if they are missing
+    if logprobs is None or not logprobs.content:
+        return None
+    weights = {candidate.token.strip(): math.exp(candidate.logprob) for candidate in logprobs.content[0].top_logprobs
+               if candidate.token.strip() in ("0", "1")}
+    total = sum(weights.values())
+    if total == 0:
+        return None
+    return {digit: round(weights.get(digit, 0) / total, 4) for digit in ("0", "1")}
+
+
+class VerificationCall:
+    """One verification request, with the backend interface that query_with_retry rate limits and retries."""
+
+    provider = "openai"
+
+    def __init__(self, verifier, max_tokens, options):
+        self.verifier = verifier
+        self.model = verifier.model
+        self.max_tokens = max_tokens
+        self.options = options
+        self.choice = None  # the first choice of the completion, with its message and log probabilities
+
+    async def query(self, prompt, images=None):
+        started = time.monotonic()
+        # the raw response gives access to the rate limit headers
+        raw_response = await self.verifier.client.chat.completions.with_raw_response.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": sys_prompt},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=self.max_tokens,
+            temperature=self.verifier.temperature,
+            **self.options
+        )
+        completion = raw_response.parse()
+        self.choice = completion.choices[0]
+        usage = completion.usage.model_dump() if completion.usage else {}
+        return QueryResult(self.choice.message.content, usage, lowercase_headers(raw_response.headers),
+                           latency=time.monotonic() - started)
+
+
+class Verifier:
+    """Concurrent verification calls to an OpenAI model, with their usage appended to a telemetry log."""
+
+    def __init__(self, model="gpt-4o", temperature=0, max_tokens=800, api_key=None, telemetry=None,
+                 condition=None, cot=False, verdict_mode="token", limiter=None):
+        from openai import AsyncOpenAI
+
+        # api_key defaults to os.environ.get("OPENAI_API_KEY"), retries are handled by rate_limit.py
+        self.client = AsyncOpenAI(api_key=api_key, max_retries=0)
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.telemetry = telemetry
+        self.condition = condition
+        self.cot = cot
+        self.verdict_mode = verdict_mode
+        self.limiter = limiter  # RateLimiter, defaults to the shared limiter of the model (rate_limit.get_limiter)
+        # {(q_number, run): last verifier output, or the error of the failed call} of the answers without a verdict
+        self.unparsed = {}
+        self.probabilities = {}     # {(q_number, run): probability of the verdict}, 'token' mode only
+
+    def prompt_id(self, packed=False):
+        # versions the verdicts in the verdict cache by prompt version and the prompt they come from, the packed
+        # prompt or the single-answer prompt of the verdict mode
+        return f"{prompt_version}-packed" if packed else f"{prompt_version}-{self.verdict_mode}"
+
+    async def complete(self, prompt, q_number, run, max_tokens, **options):
+        # the verifier's first choice, with its message and log probabilities
+        call = VerificationCall(self, max_tokens, options)
+        result = await query_with_retry(call, prompt, limiter=self.limiter)
+        if self.telemetry is not None:
+            self.telemetry.append(usage_record("verification", "openai", self.model, self.condition, self.cot,
+                                               q_number, run, result.usage, latency=result.latency,
+                                               retries=result.retries))
+        return call.choice
+
+    async def verify_once(self, response, q_number, run):
+        # the verifier's output for one answer in the verdict mode, with the probability of each verdict
+        # in the 'token' mode, {'0': p, '1': 1 - p}, and None in the other modes
+        if self.verdict_mode == "token":
+            choice = await self.complete(short_verify_prompt(response, q_number, "token"), q_number, run, 1,
+                                         logit_bias=verdict_logit_bias, logprobs=True, top_logprobs=2)
+            return choice.message.content, verdict_probabilities(choice.logprobs)
+        if self.verdict_mode == "json":
+            choice = await self.complete(short_verify_prompt(response, q_number, "json"), q_number, run, 5,
+                                         response_format=verdict_format)
+        else:
+            choice = await self.complete(verify_prompt(response, q_number), q_number, run, self.max_tokens)
+        return choice.message.content, None
+
+    async def verify(self, response, q_number, run=None):
+        # the verdict for one answer, 0 or 1, or None if it could not be parsed twice in a row
+        for _ in range(2):
+            text, probabilities = await self.verify_once(response, q_number, run)
+            verdict = parse_verdict(text)
+            if verdict is not None:
+                if probabilities is not None:
+                    self.probabilities[(q_number, run)] = probabilities[str(verdict)]
+                return verdict
+        self.unparsed[(q_number, run)] = text
+        return None
+
+    async def verify_packed(self, responses, q_number, runs):
+        # verdicts for several answers to the same question, in order, from one request where possible
+        for _ in range(2):
+            text = (await self.complete(packed_prompt(responses, q_number), q_number, None,
+                                        self.max_tokens + 20 * len(responses))).message.content
+            verdicts = parse_packed(text, len(responses))
+            if verdicts is not None:
+                return verdicts
+        print(f"Packed verification of {q_number} did not validate, verifying its answers one at a time")
+        return [await self.verify(response, q_number, run) for response, run in zip(responses, runs)]
+
+
+def verify_all(verifier, items, concurrency=8, packed=False, pack_size=10, on_result=None, cache=None):
+    """
+    Verify many answers concurrently, verifying identical answers to the same question only once.
+
+    Parameters:
+    -----------
+    verifier : Verifier
+        The verification model
+    items : list of tuple
+        (q_number, run, response) for every answer to verify
+    concurrency : int
+        Maximum number of verification requests in flight at once
+    packed : bool
+        Whether to put up to pack_size answers to the same question into one request
+    pack_size : int
+        Maximum number of answers per packed request
+    on_result : callable, optional
+        Called as on_result(q_number, run, response, verdict) as soon as an answer is verified
+    cache : VerdictCache, optional
+        Persistent verdict cache, answers with a cached verdict are not sent to the verifier
+
+    Returns:
+    --------
+    dict
+        {(q_number, run): verdict}, the verdict is 0, 1, or None if it could not be parsed or its verification
+        call failed after all retries (the error is kept in verifier.unparsed)
+    """
+    verifications = {}
+    if cache is not None and verifier.temperature != 0:
+        cache = None    # verdicts of a non-deterministic verifier are not reused
+
+    # one verification per distinct answer to a question, shared by all runs with that answer
+    duplicates = {}
+    for q_number, run, response in items:
+        key = verdict_key(verifier.model, q_number, correct_dict[q_number], response, verifier.prompt_id(packed))
+        duplicates.setdefault(key, []).append((q_number, run, response))
+
+    def store(key, verification, probability=None):
+        for q_number, run, response in duplicates[key]:
+            verifications[(q_number, run)] = verification
+            if probability is not None:
+                verifier.probabilities[(q_number, run)] = probability
+            if on_result is not None:
+                on_result(q_number, run, response, verification)
+
+    unique = []     # (key, q_number, response) of the answers to send to the verifier
+    for key, answers in duplicates.items():
+        verification = cache.get(key) if cache is not None else None
+        if verification is not None:
+            store(key, verification, cache.probabilities.get(key))
+        else:
+            q_number, _, response = answers[0]
+            unique.append((key, q_number, response))
+
+    def store_failed(keys, error):
+        # the answers of a call that still failed after its retries get no verdict, they go to manual review
+        for key in keys:
+            for q_number, run, _ in duplicates[key]:
+                verifier.unparsed[(q_number, run)] = f"verification failed: {error!r}"
+            store(key, None)
+        print(f"Verification of {len(keys)} answers failed, they go to manual review: {error!r}")
+
+    def store_new(key, q_number, verification):
+        probability = verifier.probabilities.get((q_number, duplicates[key][0][1]))
+        if cache is not None and verification is not None:
+            cache.put(key, verification, probability, verification_model=verifier.model, q_number=q_number,
+                      prompt_version=verifier.prompt_id(packed))
+        store(key, verification, probability)
+
+    if not packed:
+        def handle_single(index, job, verification):
+            key, q_number, _ = job
+            store_new(key, q_number, verification)
+
+        async def verify_single(key, q_number, response):
+            return await verifier.verify(response, q_number, duplicates[key][0][1])
+
+        results = run_queries(unique, verify_single, concurrency, handle_single, return_exceptions=True)
+        for (key, _, _), result in zip(unique, results):
+            if isinstance(result, Exception):
+                store_failed([key], result)
+        return verifications
+
+    # group the answers by question, keeping their order, and cut each group into packs
+    questions = {}
+    for key, q_number, response in unique:
+        questions.setdefault(q_number, []).append((key, response))
+    packs = [(q_number, answers[start:start + pack_size]) for q_number, answers in questions.items()
+             for start in range(0, len(answers), pack_size)]
+
+    def handle_pack(index, job, verdicts):
+        q_number, answers = job
+        for (key, _), verdict in zip(answers, verdicts):
+            store_new(key, q_number, verdict)
+
+    async def verify_pack(q_number, answers):
+        keys, responses = zip(*answers)
+        runs = [duplicates[key][0][1] for key in keys]
+        return await verifier.verify_packed(list(responses), q_number, runs)
+
+    results = run_queries(packs, verify_pack, concurrency, handle_pack, return_exceptions=True)
+    for (_, answers), result in zip(packs, results):
+        if isinstance(result, Exception):
+            store_failed([key for key, _ in answers], result)
+    return verifications